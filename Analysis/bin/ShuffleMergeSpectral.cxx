@@ -2,7 +2,10 @@
 */
 
 #include <fstream>
+#include <iomanip>
+#include <limits>
 #include <random>
+#include <sstream>
 #include <string>
 #include <iostream>
 #include <boost/algorithm/string.hpp>
@@ -78,14 +81,29 @@ struct Arguments {
                                              "(option is relevant only for the case of `--lastbin-takeall True`)",1.0};
     run::Argument<bool> lastbin_takeall{"lastbin-takeall", "to take all events from the last bin up to acceptable disbalance,"
                                         "specified with `--lastbin-disbalance`",false};
-    run::Argument<std::string> compression_algo{"compression-algo","ZLIB, LZMA, LZ4","LZMA"};
+    run::Argument<std::string> compression_algo{"compression-algo","ZLIB, LZMA, LZ4, ZSTD","LZMA"};
     run::Argument<unsigned> compression_level{"compression-level", "compression level of output file", 9};
     run::Argument<unsigned> parity{"parity","take only even:0, take only odd:1, take all entries:3", 3};
     run::Argument<bool> refill_spectrum{"refill-spectrum", "If true - spectrums of the input data will be recalculated on flight, "
                                         "only events that correspond to the current job will be considered.", false};
     run::Argument<bool> enable_emptybin{"enable-emptybin", "In case of empty pt-eta bin, the probability in this bin will be set to 0", false};
+    run::Argument<std::string> save_plan{"save-plan", "directory to store the plan of all --n-jobs jobs: entry ranges, "
+                                         "tau type probabilities and spectrum probability histograms. "
+                                         "No output tuple is produced.", ""};
+    run::Argument<std::string> plan{"plan", "directory with the plan created with --save-plan: the job takes its entry range "
+                                    "and the probabilities from the plan instead of reading the spectrums", ""};
 };
 
+using PlanPath = boost::property_tree::ptree::path_type;
+
+// decimal representation of a probability stored in the plan, which is read back as exactly the same double
+std::string ToPlanString(const double value)
+{
+    std::ostringstream ss;
+    ss << std::setprecision(std::numeric_limits<double>::max_digits10) << value;
+    return ss.str();
+}
+
 struct SourceDesc {
     using Tau = tau_tuple::Tau;
     using TauTuple = tau_tuple::TauTuple;
@@ -198,13 +216,15 @@ struct EntryDesc {
     std::pair<size_t, size_t> point_entry;
     std::pair<size_t, size_t> point_exit;
     size_t total_entries;
+    std::vector<size_t> files_entries;
 
     EntryDesc(const PropertyConfigReader::Item& item,
               const std::string& base_spectrum_dir,
               const std::string& input_paths,
               const std::string& prefix,
               const size_t job_idx, const size_t n_jobs,
-              const bool refill_spectrum)
+              const bool refill_spectrum,
+              const boost::property_tree::ptree* plan = nullptr)
     {
         using boost::regex;
         using boost::regex_match;
@@ -232,7 +252,6 @@ struct EntryDesc {
 
         std::string ifile;
         std::string dir_name, file_name, spectrum_file, file_path;
-        std::vector<size_t> files_entries;
 
         // For every datagroup in cfg file EntryDesc iterates
         // through filelist.txt and for matched (to datagroup):
@@ -259,7 +278,7 @@ struct EntryDesc {
           data_set_names.push_back(dir_name);
           data_set_names_hashes.push_back(std::hash<std::string>{}(dir_name));
 
-          if(!refill_spectrum){
+          if(!refill_spectrum && !plan){
             spectrum_file = base_spectrum_dir + "/" + dir_name + ".root";
             spectrum_files.insert(spectrum_file);
           }
@@ -270,7 +289,7 @@ struct EntryDesc {
               % name % file_pattern_str;
         }
 
-        if(!refill_spectrum){
+        if(!refill_spectrum && !plan){
           std::cout << name << std::endl;
           for (const auto spectrum_file : spectrum_files){
             if(!is_regular_file(spectrum_file))
@@ -282,13 +301,53 @@ struct EntryDesc {
         if(job_idx >= n_jobs)
           throw exception("Wrong job_idx! The index should be > 0 and < n_jobs");
         
-        sumBasedSplit(files_entries, job_idx, n_jobs,point_entry, point_exit, total_entries);
+        if(plan) {
+          // the entry ranges are valid only for the same files and tau types of the group
+          const auto group = plan->get_child_optional(PlanPath("groups/" + name, '/'));
+          if(!group)
+            throw exception("The plan was created without the data group '%1%'.") % name;
+          if(group->get_child("files") != PlanFiles())
+            throw exception("The plan was created for different files or numbers of entries in '%1%'.") % name;
+          if(group->get<std::string>("types") != PlanTypes())
+            throw exception("The plan was created for tau types '%1%' in '%2%', while '%3%' are configured.")
+                  % group->get<std::string>("types") % name % PlanTypes();
+          // entry range of the job precomputed with --save-plan
+          const auto& split = plan->get_child(PlanPath("jobs/" + std::to_string(job_idx) + "/" + name, '/'));
+          point_entry = std::make_pair(split.get<size_t>("entry_file"), split.get<size_t>("entry"));
+          point_exit = std::make_pair(split.get<size_t>("exit_file"), split.get<size_t>("exit"));
+          total_entries = split.get<size_t>("step");
+        } else {
+          sumBasedSplit(files_entries, job_idx, n_jobs,point_entry, point_exit, total_entries);
+        }
         
         std::cout <<  name << ": " <<
                      "Entry point-> " << point_entry.first << " " << point_entry.second << ", " <<
                      "Exit point-> " << point_exit.first << " " << point_exit.second << ", " <<
                      "Total entries-> " << total_entries << std::endl; 
     }
+
+    // files of the group with their numbers of entries, as stored in the plan
+    boost::property_tree::ptree PlanFiles() const
+    {
+        boost::property_tree::ptree files;
+        for(size_t n = 0; n < data_files.size(); ++n) {
+            boost::property_tree::ptree file;
+            file.put("path", data_files.at(n));
+            file.put("entries", files_entries.at(n));
+            files.push_back(std::make_pair("", file));
+        }
+        return files;
+    }
+
+    std::string PlanTypes() const
+    {
+        std::ostringstream ss;
+        for(const TauType& type : tau_types) {
+            if(type != *tau_types.begin()) ss << ",";
+            ss << ToString(type);
+        }
+        return ss.str();
+    }
 };
 
 class SpectrumHists {
@@ -341,6 +400,22 @@ public:
       }
     }
 
+    void LoadProbability(const std::string& path_prob_file)
+    {
+      // probabilities stored by SaveHists
+      TFile file(path_prob_file.c_str());
+      if(file.IsZombie())
+        throw exception("Probability file '%1%' is not opened.") % path_prob_file;
+      for (TauType type: ttypes){
+        TH2D* hist_prob = dynamic_cast<TH2D*>(file.Get((ToString(type)+"_prob").c_str()));
+        if (!hist_prob)
+          throw exception("TauType: '%1%' is not available at '%2%'")
+          % ToString(type) % path_prob_file;
+        ttype_prob[type] = std::shared_ptr<TH2D>(dynamic_cast<TH2D*>(hist_prob->Clone()));
+        ttype_prob[type]->SetDirectory(nullptr);
+      }
+    }
+
     void AddHist_refill(const std::shared_ptr<SourceDesc>& SpectrumSource)
     {
       while(SpectrumSource->DoNextStep()) {
@@ -502,39 +577,85 @@ public:
                      const std::vector<double>& eta_bins, Generator& _gen,
                      const std::set<std::string>& disabled_branches, bool verbose,
                      const std::map<TauType, Double_t>& tau_ratio, const Double_t exp_disbalance,
-                     const bool lastbin_takeall_, const bool refill_spectrum, const bool enable_emptybin) :
+                     const bool lastbin_takeall_, const bool refill_spectrum, const bool enable_emptybin,
+                     const std::string& plan_dir = "") :
                      pt_max(pt_bins.back()), pt_min(pt_bins[0]), eta_max(eta_bins.back()),
                      pt_threshold(pt_bins.end()[-2]), lastbin_takeall(lastbin_takeall_), gen(&_gen)
     {
       if(verbose) std::cout << "Loading Data Groups..." << std::endl;
       LoadDataGroups(entries, pt_bins, eta_bins, disabled_branches, exp_disbalance,
-                     refill_spectrum, enable_emptybin);
+                     refill_spectrum, enable_emptybin, !plan_dir.empty());
 
-      if(verbose) std::cout << "Calculating probabilities..." << std::endl;
-      for(auto spectrum: spectrums)
-        spectrum.second->CalculateProbability();
+      if(plan_dir.empty()) {
+        if(verbose) std::cout << "Calculating probabilities..." << std::endl;
+        for(auto spectrum: spectrums)
+          spectrum.second->CalculateProbability();
 
-      if(verbose) std::cout << "Saving histograms..." << std::endl;
-      for(auto spectrum: spectrums) spectrum.second->SaveHists("./out");
+        if(verbose) std::cout << "Saving histograms..." << std::endl;
+        for(auto spectrum: spectrums) spectrum.second->SaveHists("./out");
+      } else {
+        if(verbose) std::cout << "Loading probabilities from the plan..." << std::endl;
+        LoadPlan(plan_dir);
+      }
 
       if(verbose) std::cout << "Writing hash table..." << std::endl;
       WriteHashTables("./out",entries);
 
 
       dist_uniform = Uniform(0.0, 1.0);
-      ttype_prob = TauTypeProb(spectrums, tau_ratio);
-
-      // Probability of data group
-      // is taken proportionally to number
-      // of entries per considered (for DataGroups) TauTypes
-      for(auto spectrum: spectrums){
-        datagroup_probs.push_back((double)spectrum.second->GetEntries());
-        datagroup_names.push_back(spectrum.second->GetGroupName());
+      if(plan_dir.empty()) {
+        ttype_prob = TauTypeProb(spectrums, tau_ratio);
+
+        // Probability of data group
+        // is taken proportionally to number
+        // of entries per considered (for DataGroups) TauTypes
+        for(auto spectrum: spectrums){
+          datagroup_probs.push_back((double)spectrum.second->GetEntries());
+          datagroup_names.push_back(spectrum.second->GetGroupName());
+        }
       }
       dist_dataset = Discret(datagroup_probs.begin(), datagroup_probs.end());
 
       n_entries = 0;
-      for(auto spectrum: spectrums) n_entries+=spectrum.second->GetEntries();
+      for(double group_entries: datagroup_probs) n_entries+=static_cast<size_t>(group_entries);
+    }
+
+    // Stores everything the jobs derive from the spectrums and the file list:
+    // the probability histograms, the tau type and data group probabilities (plan.json)
+    // and the entry ranges of all n_jobs jobs, together with the settings and
+    // the files of each data group they were derived from.
+    void SavePlan(const std::string& output, const std::vector<EntryDesc>& entries, const size_t n_jobs,
+                  const boost::property_tree::ptree& settings) const
+    {
+      if(!boost::filesystem::exists(output)) boost::filesystem::create_directories(output);
+      for(auto spectrum: spectrums) spectrum.second->SaveHists(output);
+
+      boost::property_tree::ptree plan;
+      plan.put("n_jobs", n_jobs);
+      plan.add_child("settings", settings);
+      for(const EntryDesc& desc: entries) {
+        plan.put(PlanPath("groups/" + desc.name + "/types", '/'), desc.PlanTypes());
+        plan.add_child(PlanPath("groups/" + desc.name + "/files", '/'), desc.PlanFiles());
+      }
+      for(const auto& type_prob: ttype_prob)
+        plan.put(PlanPath("tau_type_prob/" + ToString(type_prob.first), '/'), ToPlanString(type_prob.second));
+      for(size_t n = 0; n < datagroup_names.size(); ++n)
+        plan.put(PlanPath("datagroups/" + datagroup_names.at(n), '/'), ToPlanString(datagroup_probs.at(n)));
+      for(size_t job_idx = 0; job_idx < n_jobs; ++job_idx) {
+        for(const EntryDesc& desc: entries) {
+          std::pair<size_t, size_t> point_entry, point_exit;
+          size_t step;
+          sumBasedSplit(desc.files_entries, job_idx, n_jobs, point_entry, point_exit, step);
+          const std::string prefix = "jobs/" + std::to_string(job_idx) + "/" + desc.name + "/";
+          plan.put(PlanPath(prefix + "entry_file", '/'), point_entry.first);
+          plan.put(PlanPath(prefix + "entry", '/'), point_entry.second);
+          plan.put(PlanPath(prefix + "exit_file", '/'), point_exit.first);
+          plan.put(PlanPath(prefix + "exit", '/'), point_exit.second);
+          plan.put(PlanPath(prefix + "step", '/'), step);
+        }
+      }
+      std::ofstream json_file(output + "/plan.json", std::ios::out);
+      boost::property_tree::write_json(json_file, plan);
     }
 
     bool DoNextStep()
@@ -565,6 +686,23 @@ public:
     }
 
 private:
+    void LoadPlan(const std::string& plan_dir)
+    {
+      for(auto spectrum: spectrums)
+        spectrum.second->LoadProbability(plan_dir + "/" + spectrum.first + ".root");
+
+      boost::property_tree::ptree plan;
+      boost::property_tree::read_json(plan_dir + "/plan.json", plan);
+      for(const auto& type_prob: plan.get_child("tau_type_prob"))
+        ttype_prob[Parse<TauType>(type_prob.first)] = type_prob.second.get_value<double>();
+      // full precision and the same order as in the spectrums map,
+      // so that the sampling is identical to the job without a plan
+      for(auto spectrum: spectrums){
+        datagroup_probs.push_back(plan.get<double>(PlanPath("datagroups/" + spectrum.first, '/')));
+        datagroup_names.push_back(spectrum.first);
+      }
+    }
+
     void WriteHashTables(const std::string& output,
                          const std::vector<EntryDesc>& entries)
     {
@@ -608,7 +746,7 @@ private:
     void LoadDataGroups(const std::vector<EntryDesc>& entries,
                         const std::vector<double>& pt_bins, const std::vector<double>& eta_bins,
                         const std::set<std::string>& disabled_branches, const double exp_disbalance,
-                        const bool refill_spectrum, const bool enable_emptybin)
+                        const bool refill_spectrum, const bool enable_emptybin, const bool from_plan)
     {
       for(const EntryDesc& dsc: entries) {
 
@@ -621,7 +759,9 @@ private:
         spectrums[dsc.name] = std::make_shared<SpectrumHists>(dsc.name, pt_bins,
                                                               eta_bins, exp_disbalance, lastbin_takeall,
                                                               enable_emptybin, dsc.tau_types);
-        if(refill_spectrum) {
+        if(from_plan) {
+          continue;
+        } else if(refill_spectrum) {
           std::cout << "ReFilling spectrums for - " <<  dsc.name << std::endl;
           const std::set<std::string> enabled_branches =
                                       {"tau_pt", "tau_eta", "sampleType",
@@ -738,7 +878,7 @@ public:
     ShuffleMergeSpectral(const Arguments& _args) :
         args(_args), pt_bins(ParseBins(args.pt_bins())),
         eta_bins(ParseBins(args.eta_bins())), tau_ratio(ParseTauTypesR(args.tau_ratio())),
-        max_entries(args.max_entries()),parity(args.parity()), compression(compAlg(args.compression_algo()))
+        max_entries(args.max_entries()),parity(args.parity()), compression(root_ext::ParseCompressionAlgorithm(args.compression_algo()))
     {
       bool verbose = 1;
 		  if(args.n_threads() > 1) ROOT::EnableImplicitMT(args.n_threads());
@@ -751,6 +891,10 @@ public:
       disabled_branches.insert("dataset_id");
       disabled_branches.insert("dataset_group_id");
 
+      if(args.refill_spectrum() && !(args.plan().empty() && args.save_plan().empty()))
+        throw exception("--refill-spectrum can not be used together with --plan or --save-plan, "
+                        "since the spectrums are refilled from the entries of a single job.");
+
       PrintBins("pt bins", pt_bins);
       PrintBins("eta bins", eta_bins);
       const auto all_entries = LoadEntries(args.cfg());
@@ -759,7 +903,7 @@ public:
         for (auto dsc: all_entries) {
           std::cout << "entry group -> " << dsc.name << std::endl;
           std::cout << "files: " << dsc.data_files.size() << " ";
-          if(!args.refill_spectrum())
+          if(!args.refill_spectrum() && args.plan().empty())
             std::cout << "spectrums: " << dsc.spectrum_files.size();
           std::cout << std::endl;
         }
@@ -776,6 +920,18 @@ public:
     {
       Generator gen(args.seed());
 
+      if(!args.save_plan().empty()) {
+        for(const auto& e : entries) {
+          DataSetProcessor processor(e.second, pt_bins, eta_bins,
+                                     gen, disabled_branches, true, tau_ratio,
+                                     args.lastbin_disbalance(), args.lastbin_takeall(),
+                                     args.refill_spectrum(), args.enable_emptybin());
+          processor.SavePlan(args.save_plan(), e.second, args.n_jobs(), PlanSettings());
+        }
+        std::cout << "Plan for " << args.n_jobs() << " jobs has been saved in " << args.save_plan() << std::endl;
+        return;
+      }
+
       for(const auto& e : entries) {
         const std::string& file_name = e.first;
         const std::vector<EntryDesc>& entry_list = e.second;
@@ -789,7 +945,7 @@ public:
         DataSetProcessor processor(entry_list, pt_bins, eta_bins,
                                    gen, disabled_branches, true, tau_ratio,
                                    args.lastbin_disbalance(), args.lastbin_takeall(),
-                                   args.refill_spectrum(), args.enable_emptybin());
+                                   args.refill_spectrum(), args.enable_emptybin(), args.plan());
 
         size_t n_processed = 0;
         std::cout << "starting loops:" <<std::endl;
@@ -822,14 +978,59 @@ private:
         PropertyConfigReader reader;
         std::cout << cfg_file_name << std::endl;
         reader.Parse(cfg_file_name);
+        std::shared_ptr<boost::property_tree::ptree> plan;
+        if(!args.plan().empty()) {
+            plan = std::make_shared<boost::property_tree::ptree>();
+            boost::property_tree::read_json(args.plan() + "/plan.json", *plan);
+            if(plan->get<size_t>("n_jobs") != args.n_jobs())
+                throw exception("The plan in '%1%' was created for %2% jobs, while --n-jobs is %3%.")
+                      % args.plan() % plan->get<size_t>("n_jobs") % args.n_jobs();
+            const boost::property_tree::ptree no_settings;
+            const auto& plan_settings = plan->get_child("settings", no_settings);
+            for(const auto& setting : PlanSettings()) {
+                const auto stored = plan_settings.get_child_optional(setting.first);
+                if(!stored || *stored != setting.second)
+                    throw exception("The plan in '%1%' was created with a different '%2%', "
+                                    "it should be recreated with --save-plan.") % args.plan() % setting.first;
+            }
+        }
         for(const auto& item : reader.GetItems()){
             entries.emplace_back(item.second,  args.path_spectrum(), args.input(),
                                  args.prefix(), args.job_idx(), args.n_jobs(),
-                                 args.refill_spectrum());
+                                 args.refill_spectrum(), plan.get());
         }
+        if(plan && plan->get_child("groups").size() != entries.size())
+            throw exception("The plan in '%1%' was created for %2% data groups, while %3% are configured.")
+                  % args.plan() % plan->get_child("groups").size() % entries.size();
         return entries;
     }
 
+    // arguments and input files the plan depends on (besides the files of each data group)
+    boost::property_tree::ptree PlanSettings() const
+    {
+        boost::property_tree::ptree settings;
+        settings.put("cfg", args.cfg());
+        settings.put("input", args.input());
+        settings.put("prefix", args.prefix());
+        settings.put("pt-bins", args.pt_bins());
+        settings.put("eta-bins", args.eta_bins());
+        settings.put("input-spec", args.path_spectrum());
+        settings.put("tau-ratio", args.tau_ratio());
+        settings.put("lastbin-disbalance", ToPlanString(args.lastbin_disbalance()));
+        settings.put("lastbin-takeall", args.lastbin_takeall());
+        settings.put("enable-emptybin", args.enable_emptybin());
+
+        std::ifstream input_files(args.input(), std::ifstream::in);
+        if(!input_files)
+            throw exception("The input file %1% could not be opened") % args.input();
+        boost::property_tree::ptree input_lines;
+        std::string line;
+        while(std::getline(input_files, line))
+            input_lines.push_back(std::make_pair("", boost::property_tree::ptree(line)));
+        settings.add_child("input-files", input_lines);
+        return settings;
+    }
+
     static std::map<TauType, Double_t> ParseTauTypesR(const std::string& bins_str)
     {
       std::map<TauType, Double_t> tau_ratio;
@@ -872,13 +1073,6 @@ private:
         std::cout << ".\n";
     }
 
-    static ROOT::ECompressionAlgorithm compAlg(const std::string& comp_string) {
-      if(comp_string=="ZLIB") return ROOT::kZLIB;
-      if(comp_string=="LZMA") return ROOT::kLZMA;
-      if(comp_string=="LZ4") return ROOT::kLZ4;
-      throw exception("Invalid Compression Algorithm!");
-    }
-
 private:
     Arguments args;
     std::map<std::string, std::vector<EntryDesc>> entries;
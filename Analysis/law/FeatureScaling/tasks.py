@@ -0,0 +1,63 @@
+## see https://github.com/riga/law/tree/master/examples/htcondor_at_cern
+
+import law
+import os
+import yaml
+from glob import glob
+
+from framework import Task, HTCondorWorkflow, run_command
+import luigi
+
+def feature_scaling_command(cfg, var_types, args):
+  script = os.path.join(os.getenv('ANALYSIS_PATH'), '..', '..', 'Training', 'python', 'feature_scaling.py')
+  return ' '.join(['python', script, '--cfg', str(cfg)] + ['--var_types'] + str(var_types).split() + args)
+
+class FeatureScaling(Task, HTCondorWorkflow, law.LocalWorkflow):
+  ## map step: each job accumulates sums and quantiles for its range of input files
+  cfg         = luigi.Parameter(description = 'yaml configuration file of the feature scaling (Scaling_setup and Features_all fields)')
+  output_path = luigi.Parameter(description = 'output directory of the per job partial results')
+  n_jobs      = luigi.IntParameter(description = 'number of HTCondor jobs to run')
+  var_types   = luigi.Parameter(default = '-1', description = 'space separated variable types to process, -1 for all')
+
+  def create_branch_map(self):
+    if not os.path.exists(os.path.abspath(self.output_path)):
+      os.makedirs(os.path.abspath(self.output_path))
+    with open(self.cfg) as f:
+      setup_dict = yaml.load(f, Loader = yaml.FullLoader)['Scaling_setup']
+    file_range = setup_dict['file_range']
+    n_files = len(glob(setup_dict['file_path']))
+    first, last = (0, n_files) if file_range == -1 else (file_range[0], min(file_range[1], n_files))
+    ## contiguous file ranges, so that the merged result keeps the order of the input files
+    n_jobs = max(min(self.n_jobs, last - first), 1)
+    bounds = [first + (last - first) * i // n_jobs for i in range(n_jobs + 1)]
+    return {i: (bounds[i], bounds[i+1]) for i in range(n_jobs)}
+
+  def output(self):
+    return law.LocalFileTarget(os.path.abspath('/'.join([self.output_path, 'partial_{}.json'.format(self.branch)])))
+
+  def run(self):
+    output_name = self.output().path
+    tmp_name    = output_name + '.tmp'
+    command = feature_scaling_command(self.cfg, self.var_types,
+      ['--file-range'    , str(self.branch_data[0]), str(self.branch_data[1]),
+       '--partial-output', tmp_name])
+    run_command(command, 'job {}'.format(self.branch))
+    os.rename(tmp_name, output_name)
+
+class FeatureScalingMerge(Task):
+  ## reduce step: merges the partial results into scaling_params_v*.json, log snapshots and quantile_params_v*.json
+  cfg         = FeatureScaling.cfg
+  output_path = FeatureScaling.output_path
+  n_jobs      = FeatureScaling.n_jobs
+  var_types   = FeatureScaling.var_types
+
+  def requires(self):
+    return FeatureScaling.req(self)
+
+  def output(self):
+    return self.local_target('merged.txt')
+
+  def run(self):
+    partial_outputs = [target.path for target in self.input()['collection'].targets.values()]
+    retcode = run_command(feature_scaling_command(self.cfg, self.var_types, ['--reduce'] + partial_outputs), 'merge')
+    self.output().dump('Task ended with code %s\n' %retcode)
@@ -4,67 +4,162 @@ import six
 import law
 import subprocess
 import os
+import json
+import math
 import re
 import sys
 
-from framework import Task, HTCondorWorkflow
+from framework import Task, HTCondorWorkflow, run_command
 import luigi
 
+def get_entries(path, tree):
+  import ROOT
+  root_file = ROOT.TFile.Open(path)
+  if not root_file or root_file.IsZombie():
+    return -1
+  root_tree = root_file.Get(tree)
+  entries = root_tree.GetEntries() if root_tree else 0
+  root_file.Close()
+  return entries
+
 class HaddFiles(Task, HTCondorWorkflow, law.LocalWorkflow):
   class InputFile:
-    def __init__(self, path, size):
+    def __init__(self, path, size, entries = 0):
       self.path = path
       self.size = size
+      self.entries = entries
   class FileBatch:
     def __init__(self, dataset):
       self.files = []
       self.dataset = dataset
     def size(self):
       return sum([ff.size for ff in self.files])
+    def entries(self):
+      return sum([ff.entries for ff in self.files])
 
   ## '_' will be converted to '-' for the shell command invocation
   input_path  = luigi.Parameter(description = 'input path with tuples for all the samples')
   output_path = luigi.Parameter(description = 'output directory')
   output_size = luigi.FloatParameter(description = 'output file size in GB', default = 10.)
+  tree        = luigi.Parameter(description = 'name of the tree used to count the entries', default = 'taus')
+  backend     = luigi.ChoiceParameter(choices = ['hadd', 'merger'], default = 'hadd',
+                                      description = 'hadd or MergeRootFiles (multithreaded, selectable compression)')
+  n_threads   = luigi.IntParameter(description = 'number of threads of the merger backend', default = 1)
+  compression_algo  = luigi.Parameter(description = 'compression of the merger backend: ZLIB, LZMA, LZ4, ZSTD', default = 'ZLIB')
+  compression_level = luigi.IntParameter(description = 'compression level of the merger backend', default = 9)
+
+  def plan_file(self):
+    return '/'.join([self.output_path, 'hadd_plan.json'])
+
+  def list_datasets(self):
+    datasets = {}
+    for ds in sorted(os.listdir(self.input_path)):
+      dataset_path = '/'.join([self.input_path, ds])
+      if os.path.isdir(dataset_path):
+        datasets[ds] = sorted(['/'.join([dataset_path, fil]) for fil in os.listdir(dataset_path)
+                               if os.path.isfile('/'.join([dataset_path, fil]))])
+    return datasets
+
+  def pack_dataset(self, ds, files):
+    ## files are packed by size into the smallest number of batches below output_size:
+    ## largest first, each into the least filled batch (LPT), which balances the job runtimes
+    ## and avoids the small tail batches of a sequential split
+    max_size = self.output_size*1.e+9
+    total_size = sum([ff.size for ff in files])
+    n_batches = min(max(int(math.ceil(total_size / max_size)), 1), max(len(files), 1))
+    files = sorted(files, key = lambda ff: (-ff.size, -ff.entries, ff.path))
+    while True:
+      batches = [self.FileBatch(dataset = ds) for _ in range(n_batches)]
+      for ff in files:
+        batch = min(batches, key = lambda bb: (bb.size(), bb.entries()))
+        batch.files.append(ff)
+      if n_batches >= len(files) or all([bb.size() <= max_size for bb in batches]):
+        return [bb for bb in batches if len(bb.files)]
+      n_batches += 1
+
+  def create_plan(self, datasets):
+    batches, skipped = [], []
+    for ds, dataset_files in datasets.items():
+      files = [self.InputFile(path = ff, size = os.path.getsize(ff), entries = get_entries(ff, self.tree))
+               for ff in dataset_files]
+      for ff in files:
+        if ff.entries < 0:
+          print ('[WARNING] {} cannot be opened and is skipped'.format(ff.path))
+          skipped.append(ff.path)
+      batches += self.pack_dataset(ds, [ff for ff in files if ff.entries >= 0])
+    plan = {
+      'input_path' : self.input_path,
+      'output_size': self.output_size,
+      'tree'       : self.tree,
+      'skipped'    : skipped,
+      'batches'    : [{'dataset': bb.dataset, 'entries': bb.entries(),
+                       'files': [{'path': ff.path, 'size': ff.size, 'entries': ff.entries} for ff in bb.files]}
+                      for bb in batches],
+    }
+    with open(self.plan_file() + '.tmp', 'w') as plan_file:
+      json.dump(plan, plan_file, indent = 2)
+    os.rename(self.plan_file() + '.tmp', self.plan_file())
+    return plan
+
+  def load_plan(self, datasets):
+    ## the plan is reused as long as the inputs and the settings are unchanged, so that the branch
+    ## numbering stays the same for all jobs and the entries are counted only once
+    if not os.path.isfile(self.plan_file()):
+      return None
+    with open(self.plan_file()) as plan_file:
+      plan = json.load(plan_file)
+    planned_files = sorted([ff['path'] for bb in plan['batches'] for ff in bb['files']] + plan['skipped'])
+    if plan['input_path'] != self.input_path or plan['output_size'] != self.output_size or \
+       plan['tree'] != self.tree or planned_files != sorted(sum(datasets.values(), [])):
+      return None
+    return plan
 
   def create_branch_map(self):
-    batches = []
-    datasets = [fol for fol in os.listdir(self.input_path) if os.path.isdir('/'.join([self.input_path, fol]))]
+    if not os.path.exists(self.output_path):
+      os.makedirs(self.output_path)
+    datasets = self.list_datasets()
     for ds in datasets:
       if not os.path.exists('/'.join([self.output_path, ds])):
         os.mkdir('/'.join([self.output_path, ds]))
 
-      batches.append(self.FileBatch(dataset = ds))
-
-      dataset_path  = '/'.join([self.input_path, ds])
-      dataset_files = ['/'.join([dataset_path, fil]) for fil in os.listdir(dataset_path) if os.path.isfile('/'.join([dataset_path, fil]))]
-
-      for ff in dataset_files:
-        if batches[-1].size() > self.output_size*1.e+9:
-          batches.append(self.FileBatch(dataset = ds))
-        batches[-1].files.append(self.InputFile(path = ff, size = os.path.getsize(ff)))
+    plan = self.load_plan(datasets)
+    if plan is None:
+      plan = self.create_plan(datasets)
 
+    batches = []
+    for bb in plan['batches']:
+      batches.append(self.FileBatch(dataset = bb['dataset']))
+      batches[-1].files = [self.InputFile(path = ff['path'], size = ff['size'], entries = ff['entries'])
+                           for ff in bb['files']]
     return dict(enumerate(batches))
 
   def output(self):
-    return self.local_target("empty_file_{}.txt".format(self.branch))
+    return law.LocalFileTarget('/'.join([self.output_path, self.branch_data.dataset, 'HaddFile_{}.root'.format(self.branch)]))
+
+  def complete(self):
+    ## a batch is complete only if its output has all the entries of the inputs
+    if not self.is_branch():
+      return super(HaddFiles, self).complete()
+    output = self.output()
+    return output.exists() and get_entries(output.path, self.tree) == self.branch_data.entries()
 
   def run(self):
-    quote = lambda x: str('\"{}\"'.format(str(x)))
-    command = 'hadd -O -ff -k {OUT} {IN}'.format(
-      OUT = '/'.join([self.output_path, self.branch_data.dataset, 'HaddFile_{}.root'.format(self.branch)]),
-      IN  = ' '.join([ff.path for ff in self.branch_data.files])
-    )
-
-    print ('>> {}'.format(command))
-    proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-
-    sys.stdout.write(stdout + '\n')
-    #sys.stderr.write(stderr + '\n')
-    sys.stdout.write(stderr + '\n')
-
-    retcode = proc.returncode
-    if proc.returncode != 0:
-      raise Exception('job {} return code is {}'.format(self.branch, retcode))
+    ## the merger writes into a temporary file, which is moved to the output once it is complete
+    output_name = self.output().path
+    tmp_name    = output_name + '.tmp.root'
+    input_files = [ff.path for ff in self.branch_data.files]
+    if self.backend == 'hadd':
+      command = 'hadd -O -ff -k {OUT} {IN}'.format(OUT = tmp_name, IN = ' '.join(input_files))
+    else:
+      command = 'MergeRootFiles --output {OUT} --input-files {IN} --n-threads {N} --compression-algo {ALGO} --compression-level {LEVEL}'.format(
+        OUT = tmp_name, IN = ','.join(input_files), N = self.n_threads, ALGO = self.compression_algo, LEVEL = self.compression_level
+      )
+
+    ## the output is streamed to the job log, so that the progress per file can be followed
+    run_command(command, 'job {}'.format(self.branch))
+
+    entries = get_entries(tmp_name, self.tree)
+    if entries != self.branch_data.entries():
+      raise Exception('job {}: output has {} entries, while {} are expected'.format(self.branch, entries, self.branch_data.entries()))
+    os.rename(tmp_name, output_name)
 
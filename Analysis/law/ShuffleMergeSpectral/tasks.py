@@ -6,11 +6,43 @@ import subprocess
 import os
 import re
 import sys
+import json
 import shutil
 
-from framework import Task, HTCondorWorkflow
+from framework import Task, HTCondorWorkflow, run_command
 import luigi
 
+def shuffle_merge_command(task, output_name, args):
+  quote = lambda x: str('\"{}\"'.format(str(x)))
+  return ' '.join(['ShuffleMergeSpectral',
+    '--cfg'               , str(task.cfg)             ,
+    '--input'             , str(task.input_path)      ,
+    '--output'            , output_name               ,
+    '--pt-bins'           , quote(str(task.pt_bins))  ,
+    '--eta-bins'          , quote(str(task.eta_bins)) ,
+    '--input-spec'        , str(task.input_spec)      ,
+    '--n-jobs'            , str(task.n_jobs)          ,
+    '--tau-ratio'         , quote(str(task.tau_ratio))] + args +\
+    ## optional arguments
+    ['--mode'             , str(task.mode)                    ] * (task.mode               != '') +\
+    ['--seed'             , str(task.seed)                    ] * (task.seed               != '') +\
+    ['--prefix'           , str(task.prefix)                  ] * (task.prefix             != '') +\
+    ['--n-threads'        , str(task.n_threads)               ] * (task.n_threads          != '') +\
+    ['--disabled-branches', quote(str(task.disabled_branches))] * (task.disabled_branches  != '') +\
+    ['--lastbin-disbalance',str(task.lastbin_disbalance)      ] * (task.lastbin_disbalance != '') +\
+    ['--compression-algo' , str(task.compression_algo)        ] * (task.compression_algo   != '') +\
+    ['--compression-level', str(task.compression_level)       ] * (task.compression_level  != '') +\
+    ['--parity'           , str(task.parity)                  ] * (task.parity             != '') +\
+    ['--max-entries'      , str(task.max_entries)             ] * (task.max_entries        != '') +\
+    ['--enable-emptybin'  , str(task.enable_emptybin)         ] * (task.enable_emptybin    != '') +\
+    ['--refill-spectrum' , str(task.refill_spectrum)         ] * (task.refill_spectrum    != '')  )
+
+def move(src, dest):
+  if os.path.exists(dest):
+    if os.path.isdir(dest): shutil.rmtree(dest)
+    else: os.remove(dest)
+  shutil.move(src, dest)
+
 class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
   ## '_' will be converted to '-' for the shell command invocation
   cfg               = luigi.Parameter(description = 'configuration file with the list of input sources')
@@ -26,7 +58,7 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
   prefix            = luigi.Parameter(description = 'Prefix to place before the input file path read from --input.'
                                                     'It can include a remote server to use with xrootd.', default = "")
   mode              = luigi.Parameter(default = '', description = 'merging mode: MergeAll or MergePerEntry')
-  compression_algo  = luigi.Parameter(default = '', description = 'ZLIB, LZMA, LZ4')
+  compression_algo  = luigi.Parameter(default = '', description = 'ZLIB, LZMA, LZ4, ZSTD')
   compression_level = luigi.Parameter(default = '', description = 'compression level of output file')
   disabled_branches = luigi.Parameter(default = '', description = 'disabled-branches list of branches to disabled in the input tuples')
   parity            = luigi.Parameter(default = '', description = 'take only even:0, take only odd:1, take all entries:3')
@@ -37,6 +69,19 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
   enable_emptybin   = luigi.Parameter(default = '', description = 'enable empty pt-eta bins in the spectrum')
   refill_spectrum   = luigi.Parameter(default = '', description = 'to recalculated spectrums of the input data on flight')
 
+  def use_plan(self):
+    ## with --refill-spectrum the spectrums are filled from the entries of each job, so no common plan is possible
+    return str(self.refill_spectrum).lower() in ['', '0', 'false', 'no', 'off']
+
+  def workflow_requires(self):
+    reqs = super(ShuffleMergeSpectral, self).workflow_requires()
+    if self.use_plan():
+      reqs['plan'] = ShuffleMergeSpectralPlan.req(self)
+    return reqs
+
+  def requires(self):
+    return ShuffleMergeSpectralPlan.req(self) if self.use_plan() else []
+
   def create_branch_map(self):
     self.output_dir = '/'.join([self.output_path, 'tmp'])
     ## create the .root file output directory
@@ -46,16 +91,13 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
     if not os.path.exists(os.path.abspath('/'.join([self.output_dir, '..', 'hashes']))):
       os.makedirs(os.path.abspath('/'.join([self.output_dir, '..', 'hashes'])))
 
+    ## the (file, entry) range of each job is taken from the plan
     return {i: i for i in range(self.n_jobs)}
 
   def output(self):
-    return self.local_target("empty_file_{}.txt".format(self.branch))
-
-  def move(self, src, dest):
-    if os.path.exists(dest):
-      if os.path.isdir(dest): shutil.rmtree(dest)
-      else: os.remove(dest)
-    shutil.move(src, dest)
+    ## the output file is moved last, so a branch with an output is finished and is not rerun on retries
+    file_name = '_'.join(['ShuffleMergeSpectral', str(self.branch)]) + '.root'
+    return law.LocalFileTarget(os.path.abspath('/'.join([self.output_path, file_name])))
 
   def run(self):
     self.output_dir = '/'.join([self.output_path, 'tmp'])
@@ -65,45 +107,94 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
     if not (self.mode == 'MergeAll' or self.mode == ''):
       raise Exception('Only --mode MergeAll is supported by the law tool')
 
-    quote = lambda x: str('\"{}\"'.format(str(x)))
-    command = ' '.join(['ShuffleMergeSpectral',
-      '--cfg'               , str(self.cfg)             ,
-      '--input'             , str(self.input_path)      ,
-      '--output'            , output_name               ,
-      '--pt-bins'           , quote(str(self.pt_bins))  ,
-      '--eta-bins'          , quote(str(self.eta_bins)) ,
-      '--input-spec'        , str(self.input_spec)      ,
-      '--n-jobs'            , str(self.n_jobs)          ,
-      '--job-idx'           , str(self.branch_data)     ,
-      '--tau-ratio'         , quote(str(self.tau_ratio))] +\
-      ## optional arguments
-      ['--mode'             , str(self.mode)                    ] * (not self.mode               is '') +\
-      ['--seed'             , str(self.seed)                    ] * (not self.seed               is '') +\
-      ['--prefix'           , str(self.prefix)                  ] * (not self.prefix             is '') +\
-      ['--n-threads'        , str(self.n_threads)               ] * (not self.n_threads          is '') +\
-      ['--disabled-branches', quote(str(self.disabled_branches))] * (not self.disabled_branches  is '') +\
-      ['--lastbin-disbalance',str(self.lastbin_disbalance)      ] * (not self.lastbin_disbalance is '') +\
-      ['--compression-algo' , str(self.compression_algo)        ] * (not self.compression_algo   is '') +\
-      ['--compression-level', str(self.compression_level)       ] * (not self.compression_level  is '') +\
-      ['--parity'           , str(self.parity)                  ] * (not self.parity             is '') +\
-      ['--max-entries'      , str(self.max_entries)             ] * (not self.max_entries        is '') +\
-      ['--enable-emptybin'  , str(self.enable_emptybin)         ] * (not self.enable_emptybin    is '') +\
-      ['--refill-spectrum' , str(self.refill_spectrum)         ] * (not self.refill_spectrum    is '')  )
-
-    print ('>> {}'.format(command))
-    proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-
-    sys.stdout.write(str(stdout) + '\n')
-    sys.stderr.write(str(stderr) + '\n')
-
-    retcode = proc.returncode
-
-    if retcode != 0:
-      raise Exception('job {} return code is {}'.format(self.branch, retcode))
-    else:
-      self.move(os.path.abspath(output_name), os.path.abspath('/'.join([self.output_dir, '..', file_name])))
-      self.move(os.path.abspath('./out'    ), os.path.abspath('/'.join([self.output_dir, '..', 'hashes', 'out_{}'.format(self.branch)])))
-      print('Output file and hash tables moved to {}\n'.format(os.path.abspath('/'.join([self.output_dir, '..']))))
-      taskout = self.output()
-      taskout.dump('Task ended with code %s\n' %retcode)
+    args = ['--job-idx', str(self.branch_data)]
+    if self.use_plan():
+      args += ['--plan', os.path.dirname(self.input().path)]
+    run_command(shuffle_merge_command(self, output_name, args), 'job {}'.format(self.branch))
+
+    move(os.path.abspath('./out'    ), os.path.abspath('/'.join([self.output_dir, '..', 'hashes', 'out_{}'.format(self.branch)])))
+    move(os.path.abspath(output_name), self.output().path)
+    print('Output file and hash tables moved to {}\n'.format(os.path.abspath('/'.join([self.output_dir, '..']))))
+
+class ShuffleMergeSpectralPlan(Task):
+  ## planning step: entry ranges of all the jobs, tau type probabilities and
+  ## probability histograms are computed once from the spectrums
+  cfg               = ShuffleMergeSpectral.cfg
+  input_path        = ShuffleMergeSpectral.input_path
+  output_path       = ShuffleMergeSpectral.output_path
+  pt_bins           = ShuffleMergeSpectral.pt_bins
+  eta_bins          = ShuffleMergeSpectral.eta_bins
+  input_spec        = ShuffleMergeSpectral.input_spec
+  tau_ratio         = ShuffleMergeSpectral.tau_ratio
+  n_jobs            = ShuffleMergeSpectral.n_jobs
+  prefix            = ShuffleMergeSpectral.prefix
+  mode              = ShuffleMergeSpectral.mode
+  compression_algo  = ShuffleMergeSpectral.compression_algo
+  compression_level = ShuffleMergeSpectral.compression_level
+  disabled_branches = ShuffleMergeSpectral.disabled_branches
+  parity            = ShuffleMergeSpectral.parity
+  max_entries       = ShuffleMergeSpectral.max_entries
+  n_threads         = ShuffleMergeSpectral.n_threads
+  lastbin_disbalance= ShuffleMergeSpectral.lastbin_disbalance
+  seed              = ShuffleMergeSpectral.seed
+  enable_emptybin   = ShuffleMergeSpectral.enable_emptybin
+  refill_spectrum   = ShuffleMergeSpectral.refill_spectrum
+
+  def output(self):
+    return law.LocalFileTarget(os.path.abspath('/'.join([self.output_path, 'plan', 'plan.json'])))
+
+  def plan_settings(self):
+    ## settings stored in plan.json by ShuffleMergeSpectral --save-plan (empty parameters take the ShuffleMergeSpectral.cxx defaults)
+    with open(self.input_path) as f:
+      input_files = [line.rstrip('\n') for line in f]
+    return {
+      'cfg'               : str(self.cfg),
+      'input'             : str(self.input_path),
+      'prefix'            : str(self.prefix),
+      'pt-bins'           : str(self.pt_bins),
+      'eta-bins'          : str(self.eta_bins),
+      'input-spec'        : str(self.input_spec),
+      'tau-ratio'         : str(self.tau_ratio),
+      'lastbin-disbalance': float(self.lastbin_disbalance) if self.lastbin_disbalance != '' else 1.0,
+      'lastbin-takeall'   : False,
+      'enable-emptybin'   : str(self.enable_emptybin).lower() == 'true',
+      'input-files'       : input_files,
+    }
+
+  def complete(self):
+    ## a plan made for a different number of jobs, other settings or input files is recreated
+    output = self.output()
+    if not output.exists():
+      return False
+    with open(output.path) as f:
+      plan = json.load(f)
+    if int(plan['n_jobs']) != self.n_jobs:
+      return False
+    stored = plan.get('settings', {})
+    for name, value in self.plan_settings().items():
+      if name not in stored:
+        return False
+      if isinstance(value, bool):
+        stored_value = stored[name] == 'true'
+      elif isinstance(value, float):
+        stored_value = float(stored[name])
+      elif isinstance(value, list):
+        ## an empty list is stored as an empty string
+        stored_value = stored[name] if stored[name] != '' else []
+      else:
+        stored_value = stored[name]
+      if stored_value != value:
+        print('[INFO] the plan in {} was created with a different {}, it will be recreated'.format(os.path.dirname(output.path), name))
+        return False
+    return True
+
+  def run(self):
+    plan_dir = os.path.dirname(self.output().path)
+    tmp_dir  = plan_dir + '_tmp'
+    if os.path.exists(tmp_dir):
+      shutil.rmtree(tmp_dir)
+    ## no output tuple is produced with --save-plan
+    args = ['--job-idx', '0', '--save-plan', tmp_dir]
+    run_command(shuffle_merge_command(self, '/'.join([tmp_dir, 'unused.root']), args), 'plan')
+    move(os.path.abspath('./out'), os.path.abspath('/'.join([tmp_dir, 'hashes'])))
+    move(tmp_dir, plan_dir)
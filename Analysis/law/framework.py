@@ -10,7 +10,9 @@ and only needs to be defined once per user / group / etc.
 
 
 import os
+import sys
 import math
+import subprocess
 
 import luigi
 import law
@@ -21,6 +23,24 @@ import law
 law.contrib.load("htcondor")
 
 
+def run_command(command, name):
+  """
+  Runs a shell command streaming its output line by line to the job log, raises if the return code is not 0.
+  """
+  print ('>> {}'.format(command))
+  sys.stdout.flush()
+  proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines = True)
+  for line in proc.stdout:
+    sys.stdout.write(line)
+    sys.stdout.flush()
+  proc.wait()
+
+  retcode = proc.returncode
+  if retcode != 0:
+    raise Exception('{} return code is {}'.format(name, retcode))
+  return retcode
+
+
 class Task(law.Task):
   """
   Base task that we use to force a version parameter on all inheriting tasks, and that provides
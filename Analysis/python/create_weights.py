@@ -2,7 +2,8 @@ import argparse
 
 parser = argparse.ArgumentParser(description='Create uniform (pt, eta) weights.')
 parser.add_argument('--input', required=True, type=str, help="Input tuples")
-parser.add_argument('--output', required=True, type=str, help="Output file")
+parser.add_argument('--output', required=True, type=str,
+                    help="Output weight store directory (or .h5 file for the legacy pandas HDF5 format)")
 args = parser.parse_args()
 
 from common import *
@@ -10,10 +10,6 @@ import tensorflow as tf
 from tensorflow.python.framework.graph_io import write_graph
 from tensorflow.tools.graph_transforms import TransformGraph
 
-input_nodes = ["main_input"]#  [model.inputs[0].name]
-output_nodes = ["main_output/Softmax"]#["output_node"]
-#node_wrapper = tf.identity(model.outputs[0], name=output_nodes[0])
-
 def load_graph(graph_filename):
     with tf.gfile.GFile(graph_filename, 'rb') as f:
         graph_def = tf.GraphDef()
@@ -27,6 +23,13 @@ graph = load_graph(args.input)
 sess = tf.Session(graph=graph)
 ops = sess.graph.get_operations()
 
+# inputs are the placeholders and outputs are the nodes which are not used by any other node
+consumed_nodes = set(x.op.name for op in ops for x in op.inputs)
+input_nodes = [ op.name for op in ops if op.type == 'Placeholder' ]
+output_nodes = [ op.name for op in ops if op.name not in consumed_nodes and op.type not in [ 'Placeholder', 'Const', 'NoOp' ] ]
+print("Inputs:", input_nodes)
+print("Outputs:", output_nodes)
+
 transforms = [
     "quantize_weights"
 ]
@@ -2,24 +2,28 @@
 This file is part of https://github.com/hh-italian-group/TauMLTools. */
 
 #include "TauMLTools/Core/interface/RootFilesMerger.h"
+#include "TauMLTools/Core/interface/RootExt.h"
 #include "TauMLTools/Core/interface/program_main.h"
 
 struct Arguments {
     run::Argument<std::string> output{"output", "output root file"};
-    run::Argument<std::vector<std::string>> input_dirs{"input-dir", "input directory"};
+    run::Argument<std::vector<std::string>> input_dirs{"input-dir", "input directory", {}};
+    run::Argument<std::string> input_files{"input-files", "comma separated list of input files", ""};
     run::Argument<std::string> file_name_pattern{"file-name-pattern", "regex expression to match file names",
                                                  "^.*\\.root$"};
     run::Argument<std::string> exclude_list{"exclude-list", "comma separated list of files to exclude", ""};
     run::Argument<std::string> exclude_dir_list{"exclude-dir-list",
                                                 "comma separated list of directories to exclude", ""};
     run::Argument<unsigned> n_threads{"n-threads", "number of threads", 1};
+    run::Argument<std::string> compression_algo{"compression-algo", "ZLIB, LZMA, LZ4, ZSTD", "ZLIB"};
+    run::Argument<int> compression_level{"compression-level", "compression level of the output file", 9};
 };
 
 class MergeRootFiles : public analysis::RootFilesMerger {
 public:
     MergeRootFiles(const Arguments& args) :
-        RootFilesMerger(args.output(), args.input_dirs(), args.file_name_pattern(), args.exclude_list(),
-                        args.exclude_dir_list(), args.n_threads(), ROOT::kZLIB, 9)
+        RootFilesMerger(args.output(), GetInputFiles(args), args.n_threads(),
+                        root_ext::ParseCompressionAlgorithm(args.compression_algo()), args.compression_level())
     {
     }
 
@@ -27,7 +31,20 @@ public:
     {
         Process(true, true);
     }
+
+private:
+    static std::vector<std::string> GetInputFiles(const Arguments& args)
+    {
+        std::vector<std::string> files = analysis::SplitValueList(args.input_files(), true, ",");
+        if(!args.input_dirs().empty()) {
+            const auto dir_files = FindInputFiles(args.input_dirs(), args.file_name_pattern(), args.exclude_list(),
+                                                  args.exclude_dir_list());
+            files.insert(files.end(), dir_files.begin(), dir_files.end());
+        }
+        if(files.empty())
+            throw analysis::exception("No input files.");
+        return files;
+    }
 };
 
 PROGRAM_MAIN(MergeRootFiles, Arguments)
-
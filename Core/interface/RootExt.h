@@ -22,6 +22,7 @@ std::shared_ptr<TFile> CreateRootFile(const std::string& file_name,
                                              ROOT::ECompressionAlgorithm compression = ROOT::kZLIB,
                                              int compression_level = 9);
 std::shared_ptr<TFile> OpenRootFile(const std::string& file_name);
+ROOT::ECompressionAlgorithm ParseCompressionAlgorithm(const std::string& name);
 
 void WriteObject(const TObject& object, TDirectory* dir, const std::string& name = "");
 
@@ -68,6 +68,8 @@ public:
                     const std::string& file_name_pattern, const std::string& exclude_list,
                     const std::string& exclude_dir_list, unsigned n_threads, ROOT::ECompressionAlgorithm compression,
                     int compression_level);
+    RootFilesMerger(const std::string& output, const std::vector<std::string>& input_files, unsigned n_threads,
+                    ROOT::ECompressionAlgorithm compression, int compression_level);
 
     virtual ~RootFilesMerger() {}
 
@@ -35,6 +35,15 @@ std::shared_ptr<TFile> OpenRootFile(const std::string& file_name)
     return file;
 }
 
+ROOT::ECompressionAlgorithm ParseCompressionAlgorithm(const std::string& name)
+{
+    if(name == "ZLIB") return ROOT::kZLIB;
+    if(name == "LZMA") return ROOT::kLZMA;
+    if(name == "LZ4") return ROOT::kLZ4;
+    if(name == "ZSTD") return ROOT::kZSTD;
+    throw analysis::exception("Invalid compression algorithm '%1%'.") % name;
+}
+
 void WriteObject(const TObject& object, TDirectory* dir, const std::string& name)
 {
     if(!dir)
@@ -18,6 +18,21 @@ This file is part of https://github.com/hh-italian-group/TauMLTools. */
 #include "TauMLTools/Core/interface/TextIO.h"
 
 namespace {
+// reports the progress of TChain::Merge, the chain notifies it each time the next file is opened
+class MergeProgress : public TObject {
+public:
+    MergeProgress(const TChain& _chain) : chain(_chain) {}
+    Bool_t Notify() override
+    {
+        const TFile* file = chain.GetCurrentFile();
+        std::cout << "  [" << chain.GetTreeNumber() + 1 << "/" << chain.GetNtrees() << "] "
+                  << (file ? file->GetName() : "") << std::endl;
+        return kTRUE;
+    }
+private:
+    const TChain& chain;
+};
+
 void CollectInputFiles(const boost::filesystem::path& dir, std::vector<std::string>& files,
                        const boost::regex& pattern, const std::set<std::string>& exclude,
                        const std::set<std::string>& exclude_dirs)
@@ -85,7 +100,14 @@ RootFilesMerger::RootFilesMerger(const std::string& output, const std::vector<st
                 const std::string& file_name_pattern, const std::string& exclude_list,
                 const std::string& exclude_dir_list, unsigned n_threads, ROOT::ECompressionAlgorithm compression,
                 int compression_level) :
-    input_files(FindInputFiles(input_dirs, file_name_pattern, exclude_list, exclude_dir_list)),
+    RootFilesMerger(output, FindInputFiles(input_dirs, file_name_pattern, exclude_list, exclude_dir_list),
+                    n_threads, compression, compression_level)
+{
+}
+
+RootFilesMerger::RootFilesMerger(const std::string& output, const std::vector<std::string>& _input_files,
+                unsigned n_threads, ROOT::ECompressionAlgorithm compression, int compression_level) :
+    input_files(_input_files),
     output_file(root_ext::CreateRootFile(output, compression, compression_level))
 {
     TreeDescriptor::NumberOfFiles() = input_files.size();
@@ -95,8 +117,9 @@ RootFilesMerger::RootFilesMerger(const std::string& output, const std::vector<st
 
 void RootFilesMerger::Process(bool process_histograms, bool process_trees)
 {
-    for(const auto& file_name : input_files) {
-        std::cout << "file: " << file_name << std::endl;
+    for(size_t n = 0; n < input_files.size(); ++n) {
+        const auto& file_name = input_files.at(n);
+        std::cout << "file [" << n + 1 << "/" << input_files.size() << "]: " << file_name << std::endl;
         auto file = root_ext::OpenRootFile(file_name);
         ProcessDirectory(file_name, "", file.get(), objects, process_histograms, process_trees);
         ProcessFile(file_name, file);
@@ -131,7 +154,10 @@ void RootFilesMerger::Process(bool process_histograms, bool process_trees)
             {
                 auto chain = tree.second->CreateChain(tree.first.full_name);
                 n_entries = chain->GetEntries();
+                MergeProgress progress(*chain);
+                chain->SetNotify(&progress);
                 chain->Merge(output_file.get(), 0, "C keep");
+                chain->SetNotify(nullptr);
             }
             std::unique_ptr<TTree> merged_tree(root_ext::ReadObject<TTree>(*output_file, tree.first.full_name));
             if(merged_tree->GetEntries() != n_entries)
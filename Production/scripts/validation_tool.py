@@ -6,23 +6,27 @@ from collections import OrderedDict
 import os
 import re
 
+import numpy as np
+
 import argparse
 parser = argparse.ArgumentParser('''
 The script runs a binned KS test between different chunks of the same RDataFrame. For simplicity, all chunks are compared to the first one.
 If a KS test is below the threshold, a warning message is printed on screen.
 NOTE: the binning of each variable must be hard coded in the script (using the BINS dictionary)
 NOTE: pvalue = 99 means that one of the two histograms is empty.
+With --lean, sparse bin counts are filled instead of the 3D histograms, the KS and chi2 tests are computed on NumPy arrays and only failing entries are drawn.
 ''')
 
 parser.add_argument('--input'         , required = True, type = str, help = 'input directory. Will loop inside all subdirectories')
 parser.add_argument('--regex'  , default  = '.*\.root$', type = str, help = 'regular expression to match to input files')
 parser.add_argument('--output'        , required = True, type = str, help = 'output directory name')
 parser.add_argument('--nsplit'        , default  = 100 , type = int, help = 'number of chunks per file')
-parser.add_argument('--pvthreshold'   , default  = .05 , type = str, help = 'threshold of KS test (above = ok)')
+parser.add_argument('--pvthreshold'   , default  = .05 , type = float, help = 'threshold of KS test (above = ok)')
 parser.add_argument('--n_threads'     , default  = 1   , type = int, help = 'enable ROOT implicit multithreading')
 parser.add_argument('--id_json'       , required = True, type = str, help = 'dataset id json file')
 parser.add_argument('--group_id_json' , required = True, type = str, help = 'dataset group id json file')
 parser.add_argument('--use_dataset_id', action = 'store_true', help = 'Add \'dataset_id\' column for comparison and binning')
+parser.add_argument('--lean'          , action = 'store_true', help = 'Sparse bin counts and vectorized tests, plots are saved only for failing entries')
 
 parser.add_argument('--visual', action = 'store_true', help = 'Won\'t run the script in batch mode')
 parser.add_argument('--legend', action = 'store_true', help = 'Draw a TLegent on canvases')
@@ -49,6 +53,50 @@ BINS = {
   'sampleType': (20, -1, 19),
 }
 
+INDEX_CODE = '''
+#include <unordered_map>
+namespace validation_tool {{
+  // position of each hash in the json file, unknown hashes are mapped to the number of known ones
+  static const std::unordered_map<ULong64_t, int> {name}_map = {{ {entries} }};
+  int {name}(ULong64_t hash) {{
+    const auto it = {name}_map.find(hash);
+    return it != {name}_map.end() ? it->second : static_cast<int>({name}_map.size());
+  }}
+}}'''
+
+LEAN_CODE = '''
+#include <unordered_map>
+#include <vector>
+namespace validation_tool {
+  // sparse counts per (binned variable bin, chunk, bin) key of each tested variable, one map per processing slot
+  static std::vector<std::vector<std::unordered_map<ULong64_t, ULong64_t>>> counters;
+  void InitCounters(size_t n_counters, unsigned n_slots) {
+    counters.assign(n_counters, std::vector<std::unordered_map<ULong64_t, ULong64_t>>(n_slots));
+  }
+  // 0-based bin of a fixed binning as in TAxis::FindFixBin, -1 for under/overflow
+  int Bin(double x, int n_bins, double low, double high) {
+    if(!(x >= low && x < high)) return -1;
+    return std::min(static_cast<int>(n_bins * (x - low) / (high - low)), n_bins - 1);
+  }
+  bool Fill(size_t counter, unsigned slot, ULong64_t chunk, int bin, int third_bin, ULong64_t n_chunks, ULong64_t n_bins) {
+    if(bin >= 0 && third_bin >= 0)
+      ++counters[counter][slot][(third_bin * n_chunks + chunk) * n_bins + bin];
+    return true;
+  }
+  // merges the slots of a counter into (key, count) pairs and releases it
+  void Collect(size_t counter, std::vector<ULong64_t>& keys, std::vector<ULong64_t>& counts) {
+    std::unordered_map<ULong64_t, ULong64_t> total;
+    for(const auto& slot : counters[counter])
+      for(const auto& key_count : slot)
+        total[key_count.first] += key_count.second;
+    counters[counter].clear();
+    for(const auto& key_count : total) {
+      keys.push_back(key_count.first);
+      counts.push_back(key_count.second);
+    }
+  }
+}'''
+
 class Lazy_container:
   def __init__(self, ptr, hst = None):
     self.ptr = ptr
@@ -62,7 +110,7 @@ class Entry:  ## 2D entry (chunk_id x variable)
     self.hst = histo
     self.tdir = tdir if not tdir is None else self.var
 
-  def run_KS_test(self, norm = True):    
+  def make_chunks(self, norm = True):
     self.chunks = [self.hst.ProjectionY('chunk_{}'.format(cc), cc+1, cc+1).Clone() for cc in range(N_SPLIT)]
 
     self.chunks[0].SetMarkerStyle(20)
@@ -76,6 +124,9 @@ class Entry:  ## 2D entry (chunk_id x variable)
     
     self.chunks[0].GetYaxis().SetRangeUser(0, 1.1*max(hh.GetMaximum() for hh in self.chunks))
 
+  def run_KS_test(self, norm = True):
+    self.make_chunks(norm)
+
     if not self.chunks[0].Integral():
       print ('[WARNING] control histogram is empty inside {}'.format(self.tdir))
     
@@ -106,116 +157,203 @@ class Entry:  ## 2D entry (chunk_id x variable)
 
     OUTPUT_ROOT.cd()
 
-    json_here = JSON_DICT
-    for here in self.tdir.split('/'):
-      if not here in json_here.keys():
-        json_here[here] = OrderedDict()
-      json_here = json_here[here]
-    json_here['pvalues'] = self.pvalues
+    json_entry(self.tdir)['pvalues'] = self.pvalues
+
+def json_entry(tdir):
+  json_here = JSON_DICT
+  for here in tdir.split('/'):
+    if not here in json_here.keys():
+      json_here[here] = OrderedDict()
+    json_here = json_here[here]
+  return json_here
 
 def to_2D(histo, vbin):
   histo.GetZaxis().SetRange(vbin, vbin)
   return histo.Project3D('yx').Clone()
 
+def from_numpy(counts, var, tdir):
+  ## chunk_id x variable histogram of an entry, used to draw the failing ones
+  histo = ROOT.TH2D(tdir.replace('/', '_'), '', N_SPLIT, 0, N_SPLIT, *BINS[var])
+  for (cc, vv), nn in np.ndenumerate(counts):
+    if nn:
+      histo.SetBinContent(cc+1, vv+1, nn)
+  histo.SetEntries(counts.sum())
+  return histo
+
+def kolmogorov_prob(z):
+  ## vectorized TMath::KolmogorovProb
+  z = np.asarray(z, dtype = np.float64)
+  c1 = -np.pi**2 / 8
+  zs = np.clip(z, 0.2, None)
+  with np.errstate(over = 'ignore', under = 'ignore'):
+    small = 1 - np.sqrt(2*np.pi) * (np.exp(c1/zs**2) + np.exp(9*c1/zs**2) + np.exp(25*c1/zs**2)) / zs
+    large = 2 * (np.exp(-2*z**2) - np.exp(-8*z**2) + np.exp(-18*z**2) - np.exp(-32*z**2))
+  return np.where(z < 0.2, 1., np.where(z < 0.755, small, np.where(z < 6.8116, large, 0.)))
+
+def compare_chunks(counts):
+  ## binned KS and chi2 tests of all chunks against the first one, counts: [..., chunk, bin]
+  from scipy.special import chdtrc
+  ref   = counts[..., :1, :]
+  n_ref = ref.sum(axis = -1)
+  n     = counts.sum(axis = -1)
+  total = counts + ref
+  empty = n * n_ref == 0
+  with np.errstate(divide = 'ignore', invalid = 'ignore'):
+    dist = np.abs(np.cumsum(counts, axis = -1) / n[..., None] - np.cumsum(ref, axis = -1) / n_ref[..., None]).max(axis = -1)
+    ks_pvalues = kolmogorov_prob(np.nan_to_num(dist * np.sqrt(n * n_ref / (n + n_ref))))
+    chi2 = np.where(total > 0, (n[..., None] * ref - n_ref[..., None] * counts)**2 / total, 0.).sum(axis = -1) / (n * n_ref)
+  ndf = (total > 0).sum(axis = -1) - 1
+  chi2_pvalues = np.where(ndf > 0, chdtrc(np.maximum(ndf, 1), np.nan_to_num(chi2)), 1.)
+  return np.where(empty, 99, ks_pvalues), np.where(empty, 99, chi2_pvalues)
+
+def book_lean_counters(dataframe, bookings):
+  ## bookings: (var, binned variable or None), each filled into its own sparse counter by a pass-through filter
+  ROOT.validation_tool.InitCounters(len(bookings), dataframe.GetNSlots())
+  for counter, (var, third) in enumerate(bookings):
+    main_bin  = 'validation_tool::Bin({}, {}, {}, {})'.format(var, *BINS[var])
+    third_bin = 'validation_tool::Bin({}, {}, {}, {})'.format(third, *BINS[third]) if not third is None else '0'
+    dataframe = dataframe.Filter('validation_tool::Fill({}, rdfslot_, chunk_id, {}, {}, {}, {})'.format(
+      counter, main_bin, third_bin, N_SPLIT, BINS[var][0]))
+  return dataframe.Count()
+
+def lean_entries(counter, var, third):
+  ## (var, tdir, counts[chunk, bin]) of the non-empty slices of a counter, expanded one slice at a time
+  keys, counts = ROOT.std.vector('ULong64_t')(), ROOT.std.vector('ULong64_t')()
+  ROOT.validation_tool.Collect(counter, keys, counts)
+  keys, counts = np.array(keys, dtype = np.int64), np.array(counts, dtype = np.float64)
+  n_bins = BINS[var][0]
+  bins, chunks, third_bins = keys % n_bins, keys // n_bins % N_SPLIT, keys // n_bins // N_SPLIT
+  for tb in (np.unique(third_bins) if not third is None else [0]):
+    selected = third_bins == tb
+    slice_counts = np.zeros((N_SPLIT, n_bins))
+    slice_counts[chunks[selected], bins[selected]] = counts[selected]
+    yield var, var if third is None else '/'.join([third, str(int(BINS[third][1]) + int(tb)), var]), slice_counts
+
+def run_lean_validation(entries):
+  ## entries: (var, tdir, counts[chunk, bin]), failing ones are drawn with the p-values computed here
+  for var, tdir, counts in entries:
+    pvalues, chi2_pvalues = compare_chunks(counts)
+    json_entry(tdir)['pvalues'] = pvalues.tolist()
+    json_entry(tdir)['chi2_pvalues'] = chi2_pvalues.tolist()
+    if not all(pvalues >= PVAL_THRESHOLD):
+      print ('[WARNING] KS test failed for step {}. p-values are:'.format(tdir))
+      print ('\t', pvalues.tolist())
+      entry = Entry(var = var, histo = from_numpy(counts, var, tdir), tdir = tdir)
+      entry.make_chunks()
+      entry.pvalues = pvalues.tolist()
+      entry.save_data()
+
 if __name__ == '__main__':
   print ('[INFO] reading files from', args.input)
   
   if args.n_threads > 1:
     ROOT.ROOT.EnableImplicitMT(args.n_threads)
 
-  input_files = ROOT.std.vector('std::string')()
   file_list = ['/'.join([root, ff]) for root, dirs, files in os.walk(args.input) for ff in files]
   file_list = sorted([ff for ff in file_list if not re.match(args.regex, ff) is None])
-  
-  for ff in file_list:
-    input_files.push_back(ff)
 
   model = lambda main, third = None: (main, '', N_SPLIT, 0, N_SPLIT)+BINS[main]+BINS[third] if not third is None else (main, '', N_SPLIT, 0, N_SPLIT)+BINS[main]
   
-  cpp_function = '''
-std::vector<ULong64_t> hash_list = {%s};
-int hash, line = 0;
-for(std::vector<ULong64_t>::iterator it = hash_list.begin(); it != hash_list.end(); it++, line++){
-if (*it == %s) return line;
-} return line;'''
-
-  id_json       = json.load(open(args.id_json, 'r'))
-  group_id_json = json.load(open(args.group_id_json, 'r'))
-  ids = id_json.values()
-  group_ids = group_id_json.values()
+  id_json       = json.load(open(args.id_json, 'r'), object_pairs_hook = OrderedDict)
+  group_id_json = json.load(open(args.group_id_json, 'r'), object_pairs_hook = OrderedDict)
+  ids = list(id_json.values())
+  group_ids = list(group_id_json.values())
+
+  ## hash -> position in the json file, compiled once and shared by all Defines and threads
+  ROOT.gInterpreter.Declare(INDEX_CODE.format(name = 'dataset_index', entries = ', '.join(
+    '{{{}ULL, {}}}'.format(int(hh), ii) for ii, hh in enumerate(ids))))
+  ROOT.gInterpreter.Declare(INDEX_CODE.format(name = 'dataset_group_index', entries = ', '.join(
+    '{{{}ULL, {}}}'.format(int(hh), ii) for ii, hh in enumerate(group_ids))))
+  if args.lean:
+    ROOT.gInterpreter.Declare(LEAN_CODE)
 
   BINS['uh_dataset_group_id'] = (len(group_ids), 0, len(group_ids))
   BINS['uh_dataset_id']       = (len(ids), 0, len(ids))
 
-  dataframe = ROOT.RDataFrame('taus', input_files)
-  tot_entries = dataframe.Count().GetValue()
+  ## the number of entries is taken from the file headers, so that the data is read only once
+  chain = ROOT.TChain('taus')
+  for ff in file_list:
+    chain.Add(ff)
+  tot_entries = chain.GetEntries()
+  dataframe = ROOT.RDataFrame(chain)
 
   dataframe = dataframe.Define('chunk_id', 'rdfentry_ * {} / {}'.format(N_SPLIT, tot_entries))
-  dataframe = dataframe.Define('uh_dataset_id'      , cpp_function % (','.join(ids), 'dataset_id'))
-  dataframe = dataframe.Define('uh_dataset_group_id', cpp_function % (','.join(group_ids), 'dataset_group_id'))
+  dataframe = dataframe.Define('uh_dataset_id'      , 'validation_tool::dataset_index(dataset_id)')
+  dataframe = dataframe.Define('uh_dataset_group_id', 'validation_tool::dataset_group_index(dataset_group_id)')
 
-  ## unbinned distributions
-  ptr_lgm = Lazy_container(dataframe.Histo2D(model('tauType'), 'chunk_id', 'tauType'))
-  ptr_st  = Lazy_container(dataframe.Histo2D(model('sampleType')      , 'chunk_id', 'sampleType'      ))
-  ptr_dgi = Lazy_container(dataframe.Histo2D(model('uh_dataset_group_id'), 'chunk_id', 'uh_dataset_group_id'))
-  ptr_di  = Lazy_container(dataframe.Histo2D(model('uh_dataset_id')      , 'chunk_id', 'uh_dataset_id'      ))
-
-  ## binned distributions
   BINNED_VARIABLES = ['tauType', 'sampleType', 'uh_dataset_group_id'] + ['uh_dataset_id']*args.use_dataset_id
-  ptrs_tau_pt = {
-    binned_variable: Lazy_container(dataframe.Histo3D(model('tau_pt', third = binned_variable), 'chunk_id', 'tau_pt', binned_variable))
-      for binned_variable in BINNED_VARIABLES
-  }
-  ptrs_tau_eta = {
-    binned_variable: Lazy_container(dataframe.Histo3D(model('tau_eta', third = binned_variable), 'chunk_id', 'tau_eta', binned_variable))
-      for binned_variable in BINNED_VARIABLES
-  }
-  ptrs_dataset_id = {
-    binned_variable: Lazy_container(dataframe.Histo3D(model('uh_dataset_id', third = binned_variable), 'chunk_id', 'uh_dataset_id', binned_variable))
-      for binned_variable in ['uh_dataset_group_id']
-  }
 
-  lazy_containers = [ptr_lgm, ptr_st, ptr_dgi] + [ptr_di]*args.use_dataset_id +\
-    [lc for lc in ptrs_tau_pt.values()]  +\
-    [lc for lc in ptrs_tau_eta.values()] +\
-    [lc for lc in ptrs_dataset_id.values()]*args.use_dataset_id
-
-  for lc in lazy_containers:
-    lc.load_histogram()
-  
-  ## run validation
-  entry_lgm = Entry(var = 'tauType', histo = ptr_lgm.hst)
-  entry_st  = Entry(var = 'sampleType'      , histo = ptr_st .hst)
-  entry_dgi = Entry(var = 'uh_dataset_group_id', histo = ptr_dgi.hst)
-  entry_di  = Entry(var = 'uh_dataset_id'      , histo = ptr_di .hst)
-
-  entries_tau_pt = [
-    Entry(var = 'tau_pt', histo = to_2D(ptrs_tau_pt[binned_variable].hst, jj+1), tdir = '/'.join([binned_variable, str(bb), 'tau_pt']))
-      for binned_variable in BINNED_VARIABLES
-      for jj, bb in enumerate(range(*BINS[binned_variable][1:]))
-  ] ; entries_tau_pt = [ee for ee in entries_tau_pt if ee.hst.GetEntries()]
-
-  entries_tau_eta = [
-    Entry(var = 'tau_eta', histo = to_2D(ptrs_tau_eta[binned_variable].hst, jj+1), tdir = '/'.join([binned_variable, str(bb), 'tau_eta']))
-      for binned_variable in BINNED_VARIABLES
-      for jj, bb in enumerate(range(*BINS[binned_variable][1:]))
-  ] ; entries_tau_eta = [ee for ee in entries_tau_eta if ee.hst.GetEntries()]
+  if args.lean:
+    ## sparse counts instead of dense histograms, filled in a single (multithreaded) event loop
+    bookings = [('tauType', None), ('sampleType', None), ('uh_dataset_group_id', None)] + [('uh_dataset_id', None)]*args.use_dataset_id +\
+      [('tau_pt' , binned_variable) for binned_variable in BINNED_VARIABLES] +\
+      [('tau_eta', binned_variable) for binned_variable in BINNED_VARIABLES] +\
+      [('uh_dataset_id', 'uh_dataset_group_id')]*args.use_dataset_id
+    book_lean_counters(dataframe, bookings).GetValue()
+    for counter, (var, third) in enumerate(bookings):
+      run_lean_validation(lean_entries(counter, var, third))
+  else:
+    ## unbinned distributions
+    ptr_lgm = Lazy_container(dataframe.Histo2D(model('tauType'), 'chunk_id', 'tauType'))
+    ptr_st  = Lazy_container(dataframe.Histo2D(model('sampleType')      , 'chunk_id', 'sampleType'      ))
+    ptr_dgi = Lazy_container(dataframe.Histo2D(model('uh_dataset_group_id'), 'chunk_id', 'uh_dataset_group_id'))
+    ptr_di  = Lazy_container(dataframe.Histo2D(model('uh_dataset_id')      , 'chunk_id', 'uh_dataset_id'      )) if args.use_dataset_id else None
+
+    ptrs_tau_pt = {
+      binned_variable: Lazy_container(dataframe.Histo3D(model('tau_pt', third = binned_variable), 'chunk_id', 'tau_pt', binned_variable))
+        for binned_variable in BINNED_VARIABLES
+    }
+    ptrs_tau_eta = {
+      binned_variable: Lazy_container(dataframe.Histo3D(model('tau_eta', third = binned_variable), 'chunk_id', 'tau_eta', binned_variable))
+        for binned_variable in BINNED_VARIABLES
+    }
+    ptrs_dataset_id = {
+      binned_variable: Lazy_container(dataframe.Histo3D(model('uh_dataset_id', third = binned_variable), 'chunk_id', 'uh_dataset_id', binned_variable))
+        for binned_variable in ['uh_dataset_group_id']*args.use_dataset_id
+    }
+
+    lazy_containers = [ptr_lgm, ptr_st, ptr_dgi] + [ptr_di]*args.use_dataset_id +\
+      [lc for lc in ptrs_tau_pt.values()]  +\
+      [lc for lc in ptrs_tau_eta.values()] +\
+      [lc for lc in ptrs_dataset_id.values()]
+
+    ## all histograms are booked above and filled in a single (multithreaded) event loop
+    for lc in lazy_containers:
+      lc.load_histogram()
+
+    ## run validation
+    entry_lgm = Entry(var = 'tauType', histo = ptr_lgm.hst)
+    entry_st  = Entry(var = 'sampleType'      , histo = ptr_st .hst)
+    entry_dgi = Entry(var = 'uh_dataset_group_id', histo = ptr_dgi.hst)
+    entry_di  = Entry(var = 'uh_dataset_id'      , histo = ptr_di .hst) if args.use_dataset_id else None
+
+    entries_tau_pt = [
+      Entry(var = 'tau_pt', histo = to_2D(ptrs_tau_pt[binned_variable].hst, jj+1), tdir = '/'.join([binned_variable, str(bb), 'tau_pt']))
+        for binned_variable in BINNED_VARIABLES
+        for jj, bb in enumerate(range(*BINS[binned_variable][1:]))
+    ] ; entries_tau_pt = [ee for ee in entries_tau_pt if ee.hst.GetEntries()]
+
+    entries_tau_eta = [
+      Entry(var = 'tau_eta', histo = to_2D(ptrs_tau_eta[binned_variable].hst, jj+1), tdir = '/'.join([binned_variable, str(bb), 'tau_eta']))
+        for binned_variable in BINNED_VARIABLES
+        for jj, bb in enumerate(range(*BINS[binned_variable][1:]))
+    ] ; entries_tau_eta = [ee for ee in entries_tau_eta if ee.hst.GetEntries()]
   
-  entries_dataset_id = [
-    Entry(var = 'uh_dataset_id', histo = to_2D(ptrs_dataset_id[binned_variable].hst, jj+1), tdir = '/'.join([binned_variable, str(bb), 'uh_dataset_id']))
-      for binned_variable in ['uh_dataset_group_id']
-      for jj, bb in enumerate(range(*BINS[binned_variable][1:]))
-      if args.use_dataset_id
-  ]; entries_dataset_id = [ee for ee in entries_dataset_id if ee.hst.GetEntries()]
-
-  entries = [entry_lgm, entry_st, entry_dgi] + [entry_di]*args.use_dataset_id +\
-    [ee for ee in entries_tau_pt]  +\
-    [ee for ee in entries_tau_eta] +\
-    [ee for ee in entries_dataset_id]
-
-  for ee in entries:
-    ee.run_KS_test()
-    ee.save_data()
+    entries_dataset_id = [
+      Entry(var = 'uh_dataset_id', histo = to_2D(ptrs_dataset_id[binned_variable].hst, jj+1), tdir = '/'.join([binned_variable, str(bb), 'uh_dataset_id']))
+        for binned_variable in ['uh_dataset_group_id']
+        for jj, bb in enumerate(range(*BINS[binned_variable][1:]))
+        if args.use_dataset_id
+    ]; entries_dataset_id = [ee for ee in entries_dataset_id if ee.hst.GetEntries()]
+
+    entries = [entry_lgm, entry_st, entry_dgi] + [entry_di]*args.use_dataset_id +\
+      [ee for ee in entries_tau_pt]  +\
+      [ee for ee in entries_tau_eta] +\
+      [ee for ee in entries_dataset_id]
+
+    for ee in entries:
+      ee.run_KS_test()
+      ee.save_data()
 
   OUTPUT_ROOT.Close()
   json.dump(JSON_DICT, OUTPUT_JSON, indent = 4)
@@ -4,6 +4,8 @@
 
 #include "TROOT.h"
 #include "TLorentzVector.h"
+#include "ROOT/TThreadExecutor.hxx"
+#include "ROOT/TSeq.hxx"
 
 template <typename T, typename Tuple>
 struct ElementIndex;
@@ -95,40 +97,21 @@ private:
 
 
 struct Data {
-    typedef std::unordered_map<CellObjectType, std::unordered_map<bool, std::vector<float>>> GridMap;
-
-    Data(size_t n_tau, size_t tau_fn, size_t n_inner_cells,
-         size_t n_outer_cells, size_t pfelectron_fn, size_t pfmuon_fn,
-         size_t pfchargedhad_fn, size_t pfneutralhad_fn, size_t pfgamma_fn,
-         size_t electron_fn, size_t muon_fn, size_t tau_labels) :
-         x_tau(n_tau * tau_fn, 0), weight(n_tau, 0), y_onehot(n_tau * tau_labels, 0)
+    Data(size_t n_tau, size_t tau_fn, size_t n_inner_cells, size_t n_outer_cells,
+         const std::vector<size_t>& grid_group_fn, size_t tau_labels) :
+         x_tau(n_tau * tau_fn, 0), x_grid(grid_group_fn.size()), weight(n_tau, 0), y_onehot(n_tau * tau_labels, 0)
          {
-          // pf electron
-           // x_grid[CellObjectType::PfCand_electron][0] = std::vector<float>(n_tau * n_outer_cells * n_outer_cells * pfelectron_fn,0);
-           x_grid[CellObjectType::PfCand_electron][0].resize(n_tau * n_outer_cells * n_outer_cells * pfelectron_fn,0);
-           x_grid[CellObjectType::PfCand_electron][1].resize(n_tau * n_inner_cells * n_inner_cells * pfelectron_fn,0);
-           // pf muons
-           x_grid[CellObjectType::PfCand_muon][0].resize(n_tau * n_outer_cells * n_outer_cells * pfmuon_fn,0);
-           x_grid[CellObjectType::PfCand_muon][1].resize(n_tau * n_inner_cells * n_inner_cells * pfmuon_fn,0);
-           // pf charged hadrons
-           x_grid[CellObjectType::PfCand_chHad][0].resize(n_tau * n_outer_cells * n_outer_cells * pfchargedhad_fn,0);
-           x_grid[CellObjectType::PfCand_chHad][1].resize(n_tau * n_inner_cells * n_inner_cells * pfchargedhad_fn,0);
-           // pf neutral hadrons
-           x_grid[CellObjectType::PfCand_nHad][0].resize(n_tau * n_outer_cells * n_outer_cells * pfneutralhad_fn,0);
-           x_grid[CellObjectType::PfCand_nHad][1].resize(n_tau * n_inner_cells * n_inner_cells * pfneutralhad_fn,0);
-           // pf gamma
-           x_grid[CellObjectType::PfCand_gamma][0].resize(n_tau * n_outer_cells * n_outer_cells * pfgamma_fn,0);
-           x_grid[CellObjectType::PfCand_gamma][1].resize(n_tau * n_inner_cells * n_inner_cells * pfgamma_fn,0);
-           // electrons
-           x_grid[CellObjectType::Electron][0].resize(n_tau * n_outer_cells * n_outer_cells * electron_fn,0);
-           x_grid[CellObjectType::Electron][1].resize(n_tau * n_inner_cells * n_inner_cells * electron_fn,0);
-           // muons
-           x_grid[CellObjectType::Muon][0].resize(n_tau * n_outer_cells * n_outer_cells * muon_fn,0);
-           x_grid[CellObjectType::Muon][1].resize(n_tau * n_inner_cells * n_inner_cells * muon_fn,0);
+           // one contiguous (tau, eta, phi, feature) buffer per input grid group,
+           // features of the cell object types of a group are stored next to each other
+           for(size_t group = 0; group < grid_group_fn.size(); ++group) {
+             x_grid[group].resize(2);
+             x_grid[group][0].resize(n_tau * n_outer_cells * n_outer_cells * grid_group_fn[group],0);
+             x_grid[group][1].resize(n_tau * n_inner_cells * n_inner_cells * grid_group_fn[group],0);
+           }
          }
 
     std::vector<float> x_tau;
-    GridMap x_grid; // [enum class CellObjectType][ 0 - outer, 1 - inner]
+    std::vector<std::vector<std::vector<float>>> x_grid; // [input grid group][ 0 - outer, 1 - inner]
     std::vector<float> weight;
     std::vector<float> y_onehot;
 };
@@ -150,7 +133,9 @@ public:
         hasData(false), fullData(false), hasFile(false)
     { 
       ROOT::EnableThreadSafety();
-      if(n_threads > 1) ROOT::EnableImplicitMT(n_threads);
+      // with n_threads > 1 the slots of a batch are filled in parallel,
+      // each thread reading the taus with its own TauTuple (see MoveNextParallel)
+      if(n_threads > 1) pool = std::make_unique<ROOT::TThreadExecutor>(n_threads);
 
       if (xaxis.size() != (yaxis_list.size() + 1)){
         throw std::invalid_argument("Y binning list does not match X binning length");
@@ -202,12 +187,33 @@ public:
 
     void ReadFile(std::string file_name, Long64_t start_file, Long64_t end_file) { // put end_file=-1 to read all events from file
         tauTuple.reset();
+        thread_tuples.clear();
+        thread_files.clear();
         if(file) file->Close();
         file = std::make_unique<TFile>(file_name.c_str());
-        tauTuple = std::make_unique<tau_tuple::TauTuple>(file.get(), true);
+        if(n_threads > 1) {
+          // only tauType is read to select the entries, the full tuples are opened per thread
+          tauTuple = std::make_unique<tau_tuple::TauTuple>(file.get(), true, std::set<std::string>{},
+                                                           std::set<std::string>{"tauType"});
+          for(size_t thread_id = 0; thread_id < n_threads; ++thread_id) {
+            thread_files.push_back(std::make_unique<TFile>(file_name.c_str()));
+            thread_tuples.push_back(std::make_unique<tau_tuple::TauTuple>(thread_files.back().get(), true));
+          }
+        }
+        else
+          tauTuple = std::make_unique<tau_tuple::TauTuple>(file.get(), true);
         current_entry = start_file;
         end_entry = tauTuple->GetEntries();
         if(end_file!=-1) end_entry = std::min(end_file, end_entry);
+        if(n_threads > 1) {
+          selected_entries.clear();
+          for(Long64_t entry = current_entry; entry < end_entry; ++entry) {
+            tauTuple->GetEntry(entry);
+            if(tau_types_names.find(tauTuple->data().tauType) != tau_types_names.end())
+              selected_entries.push_back(entry);
+          }
+          selected_index = 0;
+        }
         hasFile = true;
     } 
 
@@ -220,12 +226,11 @@ public:
 
         if(!hasData) {
           data = std::make_unique<Data>(n_tau, n_TauFlat, n_inner_cells, n_outer_cells,
-                                        n_PfCand_electron, n_PfCand_muon, n_PfCand_chHad, n_PfCand_nHad,
-                                        n_PfCand_gamma, n_Electron, n_Muon, tau_types_names.size()
-                                        );
+                                        n_input_grid_features, tau_types_names.size());
           tau_i = 0;
           hasData = true;
         }
+        if(n_threads > 1) return MoveNextParallel();
         while(tau_i < n_tau) {
           if(current_entry == end_entry) {
             hasFile = false;
@@ -233,22 +238,25 @@ public:
           }
           tauTuple->GetEntry(current_entry);
           const auto& tau = tauTuple->data();
+          ++current_entry;
           // skip event if it is not tau_e, tau_mu, tau_jet or tau_h
           if ( tau_types_names.find(tau.tauType) == tau_types_names.end() ) continue;
-          else {
-            data->y_onehot[ tau_i * tau_types_names.size() + tau.tauType ] = 1.0; // filling labels
-            data->weight.at(tau_i) = GetWeight(tau.tauType, tau.tau_pt, std::abs(tau.tau_eta)); // filling weights
-            FillTauBranches(tau, tau_i);
-            FillCellGrid(tau, tau_i, innerCellGridRef, true);
-            FillCellGrid(tau, tau_i, outerCellGridRef, false);
-            ++tau_i;
-          }
-          ++current_entry;
+          FillTau(tau, tau_i);
+          ++tau_i;
         }
         fullData = true;
         return true;
     }
 
+    // discards the partially filled batch, so that the next batch starts with the next file
+    void DropBatch() {
+      hasData = false;
+      fullData = false;
+    }
+
+    // entry of the current file from which the next batch is filled
+    Long64_t GetCurrentEntry() const { return current_entry; }
+
     Data LoadData() {
       if(!fullData)
         throw std::runtime_error("Data was not loaded with MoveNext()");
@@ -257,6 +265,18 @@ public:
       return (*data.get());
     }
 
+    // number of taus filled into the batch that is not complete yet
+    Long64_t GetBatchFill() const { return hasData && !fullData ? tau_i : 0; }
+
+    // incomplete last batch of the file (once MoveNext() returned false),
+    // only the first GetBatchFill() taus are filled, the rest is zero
+    Data LoadPartialData() {
+      if(fullData || !hasData || tau_i == 0)
+        throw std::runtime_error("No partial batch is available");
+      hasData = false;
+      return (*data.get());
+    }
+
 
     static void MaxDisbCheck(const std::unordered_map<int ,std::shared_ptr<TH2D>>& hists,
                              Double_t max_thr)
@@ -277,6 +297,43 @@ public:
 
       static constexpr float pi = boost::math::constants::pi<float>();
 
+      bool MoveNextParallel()
+      {
+        // the free slots of the batch are split into n_threads contiguous ranges of
+        // preselected entries, each range is filled by one thread with its own TauTuple
+        const size_t n_fill = std::min(static_cast<size_t>(n_tau - tau_i),
+                                       selected_entries.size() - selected_index);
+        auto fillRange = [&](size_t thread_id) {
+          const size_t begin = n_fill * thread_id / n_threads;
+          const size_t end = n_fill * (thread_id + 1) / n_threads;
+          auto& tuple = *thread_tuples.at(thread_id);
+          for(size_t n = begin; n < end; ++n) {
+            tuple.GetEntry(selected_entries.at(selected_index + n));
+            FillTau(tuple.data(), tau_i + n);
+          }
+        };
+        pool->Foreach(fillRange, ROOT::TSeqU(n_threads));
+
+        tau_i += n_fill;
+        selected_index += n_fill;
+        current_entry = selected_index < selected_entries.size() ? selected_entries.at(selected_index) : end_entry;
+        if(tau_i < n_tau) {
+          hasFile = false;
+          return false;
+        }
+        fullData = true;
+        return true;
+      }
+
+      void FillTau(const Tau& tau, Long64_t tau_i)
+      {
+        data->y_onehot[ tau_i * tau_types_names.size() + tau.tauType ] = 1.0; // filling labels
+        data->weight.at(tau_i) = GetWeight(tau.tauType, tau.tau_pt, std::abs(tau.tau_eta)); // filling weights
+        FillTauBranches(tau, tau_i);
+        FillCellGrid(tau, tau_i, innerCellGridRef, true);
+        FillCellGrid(tau, tau_i, outerCellGridRef, false);
+      }
+
       const double GetWeight(const int type_id, const double pt, const double eta) const
       {
         // if(eta <= eta_min || eta >= eta_max || pt<=pt_min || pt>=pt_max) return 0;
@@ -423,12 +480,15 @@ public:
       template<size_t... I>
       std::vector<size_t> CreateStartIndices(const CellGrid& cellGridRef, const CellIndex& cellIndex, size_t tau_i, std::index_sequence<I...> idx_seq)
       {
-         auto getStartIndex = [&](size_t n_total) {
+         auto getStartIndex = [&](size_t grid_group, size_t grid_offset) {
+              const size_t n_total = n_input_grid_features.at(grid_group);
               return tau_i * cellGridRef.GetnTotal() * n_total
-                     + cellGridRef.GetFlatIndex(cellIndex) * n_total;
+                     + cellGridRef.GetFlatIndex(cellIndex) * n_total
+                     + grid_offset;
               };
         std::vector<size_t> start(idx_seq.size());
-        ((start[I] = getStartIndex(FeaturesHelper<std::tuple_element_t<I, FeatureTuple>>::size)), ...);
+        ((start[I] = getStartIndex(FeaturesHelper<std::tuple_element_t<I, FeatureTuple>>::grid_group,
+                                   FeaturesHelper<std::tuple_element_t<I, FeatureTuple>>::grid_offset)), ...);
         return start;
       }
 
@@ -441,9 +501,9 @@ public:
 
         auto fillGrid = [&](auto _feature_idx, float value) {
           if(static_cast<int>(_feature_idx) < 0) return;
-          const CellObjectType obj_type = FeaturesHelper<decltype(_feature_idx)>::object_type;
+          const size_t grid_group = FeaturesHelper<decltype(_feature_idx)>::grid_group;
           const size_t start = start_indices.at(ElementIndex<decltype(_feature_idx), FeatureTuple>::value);
-          data->x_grid.at(obj_type).at(inner).at(start + static_cast<int>(_feature_idx))
+          data->x_grid.at(grid_group).at(inner).at(start + static_cast<int>(_feature_idx))
                   = Scale<typename  FeaturesHelper<decltype(_feature_idx)>::scaler_type>(static_cast<int> (_feature_idx), value, inner);
         };
 
@@ -879,4 +939,11 @@ private:
   std::unique_ptr<Data> data;
   std::unordered_map<int ,std::shared_ptr<TH2D>> hist_weights;
 
+  // multithreaded filling (n_threads > 1)
+  std::unique_ptr<ROOT::TThreadExecutor> pool;
+  std::vector<std::unique_ptr<TFile>> thread_files;
+  std::vector<std::unique_ptr<TauTuple>> thread_tuples;
+  std::vector<Long64_t> selected_entries; // entries of the current file with tauType in tau_types_names
+  size_t selected_index;
+
 };
@@ -1,6 +1,7 @@
 import os
 import gc
 import sys
+import argparse
 import glob
 import time
 import math
@@ -226,9 +227,10 @@ def close_file(f_name):
         obj.close()
 
 class TimeCheckpoint(Callback):
-    def __init__(self, time_interval, file_name_prefix):
+    def __init__(self, time_interval, file_name_prefix, data_loader = None):
         self.time_interval = time_interval
         self.file_name_prefix = file_name_prefix
+        self.data_loader = data_loader
         self.initial_time = time.time()
         self.last_check_time = self.initial_time
 
@@ -241,22 +243,26 @@ class TimeCheckpoint(Callback):
             read_hdf_lock.acquire()
             self.model.save('{}_historic_b{}_{:.1f}h.h5'.format(self.file_name_prefix, batch, abs_delta_t_h))
             read_hdf_lock.release()
+            if self.data_loader is not None:
+                # position after the batches used by the model so far, batches prefetched
+                # by tf.data are not counted, to be resumed with --resume-loader-state
+                self.data_loader.save_state('{}_historic_b{}_{:.1f}h_loader.json'.format(self.file_name_prefix, batch, abs_delta_t_h),
+                                            n_batches = batch + 1)
             self.last_check_time = current_time
 
     def on_epoch_end(self, epoch, logs=None):
         read_hdf_lock.acquire()
         self.model.save('{}_e{}.h5'.format(self.file_name_prefix, epoch))
         read_hdf_lock.release()
+        if self.data_loader is not None:
+            self.data_loader.save_state('{}_e{}_loader.json'.format(self.file_name_prefix, epoch))
         print("Epoch {} is ended.".format(epoch))
 
 
 def run_training(train_suffix, model_name, model, data_loader, is_profile):
 
-    gen_train = dataloader.get_generator(primary_set = True)
-    gen_val = dataloader.get_generator(primary_set = False)
-
-    # data_train = tf.data.Dataset.from_generator(gen_train, output_types = input_types, output_shapes = input_shape)
-    # data_val = tf.data.Dataset.from_generator(gen_val, output_types = input_types, output_shapes = input_shape)
+    data_train = dataloader.get_dataset(primary_set = True)
+    data_val = dataloader.get_dataset(primary_set = False)
 
     train_name = '%s_%s' % (model_name, train_suffix)
     log_name = "%s.log" % train_name
@@ -264,7 +270,7 @@ def run_training(train_suffix, model_name, model, data_loader, is_profile):
         close_file(log_name)
         os.remove(log_name)
     csv_log = CSVLogger(log_name, append=True)
-    time_checkpoint = TimeCheckpoint(12*60*60, train_name)
+    time_checkpoint = TimeCheckpoint(12*60*60, train_name, data_loader)
     callbacks = [time_checkpoint, csv_log]
 
     if is_profile:
@@ -272,7 +278,7 @@ def run_training(train_suffix, model_name, model, data_loader, is_profile):
         tboard_callback = tf.keras.callbacks.TensorBoard(log_dir = logs, profile_batch='10, 50')
         callbacks.append(tboard_callback)
 
-    fit_hist = model.fit(gen_train(), validation_data = gen_val(),
+    fit_hist = model.fit(data_train, validation_data = data_val,
                          epochs = data_loader.n_epochs, initial_epoch = data_loader.epoch,
                          callbacks = callbacks)
 
@@ -282,6 +288,14 @@ def run_training(train_suffix, model_name, model, data_loader, is_profile):
     return fit_hist
 
 
+parser = argparse.ArgumentParser(description='Train the DeepTau model.')
+parser.add_argument('--resume-loader-state', required=False, default=None, type=str,
+                    help="DataLoader state (*_loader.json) saved by TimeCheckpoint to resume the training from")
+parser.add_argument('--resume-model', required=False, default=None, type=str,
+                    help="model checkpoint to restore the weights from (default: the .h5 file saved"
+                         " together with the DataLoader state)")
+args = parser.parse_args()
+
 config   = os.path.abspath( "../../configs/training_v1.yaml")
 scaling  = os.path.abspath("../../configs/scaling_params_v1.json")
 dataloader = DataLoader.DataLoader(config, scaling)
@@ -298,5 +312,20 @@ model = create_model(netConf_full)
 compile_model(model, 1e-3)
 tf.keras.utils.plot_model(model, model_name + "_diagram.png", show_shapes=False)
 
+if args.resume_loader_state is not None:
+    # the DataLoader continues from the saved epoch and files before get_dataset is called,
+    # the optimizer state is not part of the checkpoint and starts anew
+    resume_model = args.resume_model
+    if resume_model is None:
+        if not args.resume_loader_state.endswith('_loader.json'):
+            raise RuntimeError("Model checkpoint for '{}' is unknown, please specify --resume-model"
+                               .format(args.resume_loader_state))
+        resume_model = args.resume_loader_state[:-len('_loader.json')] + '.h5'
+    dataloader.load_state(args.resume_loader_state)
+    read_hdf_lock.acquire()
+    model.load_weights(resume_model)
+    read_hdf_lock.release()
+    print("[INFO] training is resumed from epoch {} with the weights of {}".format(dataloader.epoch, resume_model))
+
 fit_hist = run_training('step{}'.format(1), model_name, model, dataloader, False)
 
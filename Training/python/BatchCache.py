@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+class ChunkWriter:
+    '''
+    Appends batches of one input file to a new cache chunk.
+    The chunk becomes visible to readers only once it is closed.
+    '''
+    def __init__(self, cache, file_name, start_entry):
+        self.cache = cache
+        self.file_name = file_name
+        self.start_entry = start_entry
+        self.name = cache.chunk_name(file_name, start_entry)
+        self.tmp_name = "{}.bin.{}.tmp".format(self.name, os.getpid())
+        self.file = open(self.tmp_name, "wb")
+        self.record = np.zeros(1, dtype=cache.record)
+        self.batch_end_entries = []
+
+    def add(self, batch, end_entry):
+        for name, x in zip(self.record.dtype.names, batch):
+            self.record[name][0] = x
+        self.record.tofile(self.file)
+        self.batch_end_entries.append(end_entry)
+
+    def close(self, complete):
+        '''
+        complete - the file was read to the end, otherwise the reading was
+        interrupted and the next chunk of the file starts at the last end entry.
+        '''
+        self.file.close()
+        if not complete and len(self.batch_end_entries) == 0:
+            os.remove(self.tmp_name)
+            return
+        meta = { "file": self.file_name,
+                 "start_entry": self.start_entry,
+                 "end_entry": self.batch_end_entries[-1] if len(self.batch_end_entries) else self.start_entry,
+                 "batch_end_entries": self.batch_end_entries,
+                 "complete": complete }
+        os.replace(self.tmp_name, self.name + ".bin")
+        with open(self.name + ".json.tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(self.name + ".json.tmp", self.name + ".json")
+        self.cache.evict()
+
+class BatchCache:
+    '''
+    On-disk cache of preprocessed (scaled and gridded) batches.
+    Batches made from one input file starting at a given entry are stored as a chunk:
+    a raw file with one record per batch, which is memory-mapped on read,
+    and a json file with the entry ranges. If the reading of a file was interrupted,
+    the rest of the file is cached as the chunk starting at the end entry of the previous one.
+    Chunks are grouped by the key of the DataLoader configuration and the total size
+    of the cache directory is limited to max_size GB by removing least recently used chunks.
+    '''
+    def __init__(self, cache_dir, key, shapes, dtype, max_size):
+        '''
+        shapes - shapes of the batch elements: flat tau features, grids, labels, weights.
+        Features are stored with the given dtype, labels and weights in float32.
+        '''
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.path = os.path.join(self.cache_dir, "{}_{}".format(key[:16], np.dtype(dtype).name))
+        self.max_size = int(max_size * 1024**3)
+        self.record = np.dtype([ ("x{}".format(n), dtype, tuple(shape)) for n, shape in enumerate(shapes[:-2]) ] +
+                               [ ("labels", np.float32, tuple(shapes[-2])),
+                                 ("weights", np.float32, tuple(shapes[-1])) ])
+        os.makedirs(self.path, exist_ok=True)
+
+    def chunk_name(self, file_name, start_entry):
+        _hash = hashlib.sha256("{}:{}".format(os.path.abspath(file_name), start_entry).encode())
+        return os.path.join(self.path, _hash.hexdigest()[:24])
+
+    def load(self, file_name, start_entry):
+        '''
+        Returns (meta, records) of the chunk or None if it is not cached.
+        records[name][n] are read-only views of the n-th batch.
+        '''
+        name = self.chunk_name(file_name, start_entry)
+        try:
+            with open(name + ".json") as file:
+                meta = json.load(file)
+            # modification time is used as the last access time for the eviction
+            os.utime(name + ".bin")
+            if len(meta["batch_end_entries"]) == 0:
+                return meta, np.zeros(0, dtype=self.record)
+            return meta, np.memmap(name + ".bin", dtype=self.record, mode="r")
+        except FileNotFoundError:
+            # not cached or evicted meanwhile
+            return None
+
+    def open_chunk(self, file_name, start_entry):
+        return ChunkWriter(self, file_name, start_entry)
+
+    def evict(self):
+        chunks = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file in files:
+                if not file.endswith(".bin"): continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                chunks.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum([ size for _, size, _ in chunks ])
+        for _, size, path in sorted(chunks):
+            if total_size <= self.max_size: break
+            # json is removed first, so that readers never see a chunk without data
+            for name in [ path[:-len(".bin")] + ".json", path ]:
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
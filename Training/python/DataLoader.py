@@ -1,102 +1,234 @@
+import collections
 import gc
+import hashlib
+import json
 import multiprocessing as mp
+import threading
+from multiprocessing import shared_memory
 from queue import Empty as EmptyException
-from queue import Full as FullException
 
 import numpy as np
 import ROOT as R
 import config_parse
-import tensorflow as tf
+from BatchCache import BatchCache
 import os
 import yaml
 import time
 
 class TerminateGenerator:
-    pass
-
-def LoaderThread(queue_out, queue_files,  batch_counter, n_batches, #terminate,
+    '''
+    Sent by a worker once it stops, together with its statistics:
+    number of sent batches and the time spent waiting for queue space.
+    '''
+    def __init__(self, n_batches = 0, wait_time = 0.):
+        self.n_batches = n_batches
+        self.wait_time = wait_time
+
+class SharedBatchBuffer:
+    '''
+    Ring of preallocated batch slots in shared memory.
+    Each batch element (flat tau features, grids, labels, weights)
+    gets one shared block of shape (n_slots, *shape): workers fill
+    a free slot in place and only the slot index travels through the queue,
+    so the consumer reads the batch as zero-copy NumPy views.
+    '''
+    def __init__(self, shapes, n_slots, dtype=np.float32):
+        self.shapes = [ tuple(shape) for shape in shapes ]
+        self.n_slots = n_slots
+        self.dtype = np.dtype(dtype)
+        self.memory = [ shared_memory.SharedMemory(create=True,
+                            size=n_slots * int(np.prod(shape)) * self.dtype.itemsize)
+                        for shape in self.shapes ]
+
+    def slot(self, slot_id):
+        return [ np.ndarray((self.n_slots,) + shape, dtype=self.dtype, buffer=mem.buf)[slot_id]
+                 for shape, mem in zip(self.shapes, self.memory) ]
+
+    def release(self):
+        for mem in self.memory:
+            mem.unlink()
+            try:
+                mem.close()
+            except BufferError:
+                # views handed to the consumer are still alive,
+                # the mapping is released once they are garbage collected
+                pass
+
+def MakeItem(X_all, Y, weights, return_truth, return_weights):
+    if return_truth and return_weights:
+        return (X_all, Y, weights)
+    elif return_truth:
+        return (X_all, Y)
+    elif return_weights:
+        return (X_all, weights)
+    return X_all
+
+def ReserveBatch(batch_counter, n_batches):
+    '''
+    Atomically reserves one batch of the n_batches budget (-1 - no limit),
+    returns False once the budget is spent.
+    '''
+    with batch_counter.get_lock():
+        if n_batches != -1 and batch_counter.value >= n_batches:
+            return False
+        batch_counter.value += 1
+        return True
+
+def ReleaseBatch(batch_counter):
+    with batch_counter.get_lock():
+        batch_counter.value -= 1
+
+def LoaderThread(queue_out, queue_files, batch_counter, n_batches, stop_event,
                  input_grids, batch_size, n_inner_cells, n_outer_cells, n_flat_features,
-                 n_grid_features, tau_types, return_truth, return_weights):
+                 n_grid_features, tau_types, return_truth, return_weights,
+                 shared_buffer = None, queue_free = None, batch_cache = None):
+
+    # features of a grid group are filled by the c++ loader into a single
+    # contiguous (tau, eta, phi, feature) buffer, see Data::x_grid
+    n_group_features = [ sum([ n_grid_features[fname] for fname in group ]) for group in input_grids ]
 
-    def getdata(_obj_f, _reshape, _dtype=np.float32):
-        x = np.copy(np.frombuffer(_obj_f.data(), dtype=_dtype, count=_obj_f.size()))
+    def getview(_obj_f, _reshape, _dtype=np.float32):
+        # zero-copy view of the c++ buffer, valid only while the batch is alive
+        x = np.frombuffer(_obj_f.data(), dtype=_dtype, count=_obj_f.size())
         return x if _reshape==-1 else x.reshape(_reshape)
-    
+
     def getgrid(_obj_grid, _inner):
         _n_cells = n_inner_cells if _inner else n_outer_cells
-        _X = []
-        for group in input_grids:
-            _X.append(tf.convert_to_tensor(
-                np.concatenate(
-                    [ getdata(_obj_grid[ getattr(R.CellObjectType,fname) ][_inner],
-                     (batch_size, _n_cells, _n_cells, n_grid_features[fname])) for fname in group ],
-                    axis=-1
-                    ),dtype=tf.float32)
-                )
-        return _X
+        return [ getview(_obj_grid[group_idx][_inner], (batch_size, _n_cells, _n_cells, n_group_features[group_idx]))
+                 for group_idx in range(len(input_grids)) ]
+
+    def getbatch(data):
+        # views of all batch elements: tau, inner grids, outer grids, labels, weights
+        return [ getview(data.x_tau, (batch_size, n_flat_features)) ] + \
+               getgrid(data.x_grid, 1) + getgrid(data.x_grid, 0) + \
+               [ getview(data.y_onehot, (batch_size, tau_types)), getview(data.weight, -1) ]
+
+    def send(batch, _filename, _end_entry):
+        # copies the batch into a queue item and sends it,
+        # returns False once the worker should stop
+        nonlocal _finished_files, _n_sent, _wait_time
+
+        # the budget is reserved only for a complete batch, so n_batches is never overshot
+        if not ReserveBatch(batch_counter, n_batches):
+            return False
+
+        if shared_buffer is None:
+            # Workers stay TensorFlow-free: batches are plain contiguous float32 arrays,
+            # conversion to tensors is done by the consumer (see DataLoader.get_dataset)
+            X_all = tuple([ np.array(x, dtype=np.float32) for x in batch[:-2] ])
+            Y = np.array(batch[-2], dtype=np.float32) if return_truth else None
+            weights = np.array(batch[-1], dtype=np.float32) if return_weights else None
+            item = MakeItem(X_all, Y, weights, return_truth, return_weights)
+        else:
+            # blocking: slots are given back by the consumer, also while it shuts down
+            _start = time.time()
+            item = queue_free.get()
+            _wait_time += time.time() - _start
+            # slot layout: tau, inner grids, outer grids, labels, weights
+            slot = shared_buffer.slot(item)
+            for x_slot, x in zip(slot, batch):
+                np.copyto(x_slot, x)
+            del slot
+
+        # progress: current file, its next entry to read and the files consumed up to this batch
+        progress = (_filename, _end_entry, _finished_files)
+
+        if stop_event.is_set():
+            # the batch is not sent, give back the reservation and the slot
+            ReleaseBatch(batch_counter)
+            if shared_buffer is not None:
+                queue_free.put(item)
+            return False
+
+        # blocking: on shutdown the consumer drains queue_out until all workers are terminated
+        _start = time.time()
+        queue_out.put((item, progress))
+        _wait_time += time.time() - _start
+        _n_sent += 1
+        _finished_files = []
+        return True
+
+    def replay(_filename, _entry):
+        # sends the cached batches of the file starting from _entry, returns
+        # the entry to continue reading the file from, -1 if the file is complete
+        # or None if the worker should stop
+        _chunk = batch_cache.load(_filename, _entry)
+        while _chunk is not None:
+            _meta, _records = _chunk
+            for _n, _end_entry in enumerate(_meta["batch_end_entries"]):
+                if not send([ _records[name][_n] for name in _records.dtype.names ], _filename, _end_entry):
+                    return None
+            if _meta["complete"]:
+                return -1
+            _entry = _meta["end_entry"]
+            _chunk = batch_cache.load(_filename, _entry)
+        return _entry
 
     _dl_worker = R.DataLoader()
     _req_file = True
+    _writer = None
+    # files read to the end since the last sent batch,
+    # they are reported as consumed together with the next batch
+    _finished_files = []
+    _n_sent, _wait_time = 0, 0.
 
-    while batch_counter.value < n_batches or n_batches == -1:
+    while not stop_event.is_set():
 
         if _req_file:
             try:
-                _filename = queue_files.get(False)
-                _dl_worker.ReadFile(R.std.string(_filename), 0, -1)
-                _req_file = False
-                continue
+                _filename, _entry = queue_files.get(False)
             except EmptyException:
                 break
+            if batch_cache is not None:
+                _entry = replay(_filename, _entry)
+                if _entry is None:
+                    break
+                if _entry == -1:
+                    _finished_files.append(_filename)
+                    continue
+                _writer = batch_cache.open_chunk(_filename, _entry)
+            _dl_worker.ReadFile(R.std.string(_filename), _entry, -1)
+            _req_file = False
+            continue
 
         if not _dl_worker.MoveNext():
+            _finished_files.append(_filename)
             _req_file = True
+            if _writer is not None:
+                # cached batches do not span files, the incomplete last batch of the file is dropped
+                _dl_worker.DropBatch()
+                _writer.close(complete = True)
+                _writer = None
             continue
-        
+
         data = _dl_worker.LoadData()
-        # Flat Tau features
-        X_all = [tf.convert_to_tensor(getdata(data.x_tau, (batch_size, n_flat_features)))]
-        # Inner grid
-        X_all += getgrid(data.x_grid, 1) # 500 11 11 176
-        # Outer grid
-        X_all += getgrid(data.x_grid, 0) # 500 21 21 176
+        _end_entry = int(_dl_worker.GetCurrentEntry())
+        batch = getbatch(data)
+        if _writer is not None:
+            _writer.add(batch, _end_entry)
+        if not send(batch, _filename, _end_entry):
+            break
 
-        # X_all = tuple(X_all)
+    if _writer is not None:
+        # the rest of the file is cached by the next reader as a chunk starting at the last end entry
+        _writer.close(complete = False)
 
-        if return_weights:
-            weights = getdata(data.weight, -1)
-        if return_truth:
-            Y = getdata(data.y_onehot, (batch_size, tau_types))
-
-        if return_truth and return_weights:
-            item = (X_all, Y, weights)
-        elif return_truth:
-            item = (X_all, Y)
-        elif return_weights:
-            item = (X_all, weights)
-        else:
-            item = X_all
-        
-        while batch_counter.value < n_batches or n_batches == -1:
-            try:
-                queue_out.put(item, timeout=0.1)
-                batch_counter.value+=1
-                break
-            except FullException:
-                continue
+    queue_out.put(TerminateGenerator(_n_sent, _wait_time))
 
-    queue_out.put(TerminateGenerator())
+class DataLoader:
 
-    ## For some reasons Thread can not exit
-    ## while elements are present in the queue
-    ## here LoadThread is put to sleep until
-    ## all other processes are finished
-    
-    ## Uncomment if needed: 
-    # while not terminate.value:
-    #     time.sleep(1)
+    # headers the compiled DataLoader depends on (relative to the TauMLTools parent directory)
+    _HEADERS = [ "TauMLTools/Training/interface/DataLoader_main.h",
+                 "TauMLTools/Training/interface/DataLoader_tools.h",
+                 "TauMLTools/Training/interface/histogram2d.h",
+                 "TauMLTools/Analysis/interface/TauTuple.h",
+                 "TauMLTools/Analysis/interface/TauIdResults.h",
+                 "TauMLTools/Core/interface/SmartTree.h" ]
 
-class DataLoader:
+    # headers provided implicitly by the interpreter, required by the generated code
+    _PRELUDE = [ "#include <algorithm>", "#include <map>", "#include <set>", "#include <string>",
+                 "#include <tuple>", "#include <unordered_map>", "#include <vector>",
+                 '#include "Rtypes.h"' ]
 
     @staticmethod
     def compile_classes(file_config, file_scaling):
@@ -113,16 +245,69 @@ class DataLoader:
         if not(os.path.isfile(_rootpath+"/"+_LOADPATH)):
             raise RuntimeError("c++ dataloader does not exist")
 
+        with open(file_config) as file:
+            cache_dir = yaml.safe_load(file)["SetupNN"].get("compile_cache_dir")
+
         # compilation should be done in corresponding order:
-        print("Compiling DataLoader headers.")
-        R.gInterpreter.Declare(config_parse.create_scaling_input(file_scaling,file_config, verbose=False))
-        R.gInterpreter.Declare(config_parse.create_settings(file_config, verbose=False))
-        R.gInterpreter.Declare('#include "{}"'.format(_LOADPATH))
+        _code = [ config_parse.create_scaling_input(file_scaling,file_config, verbose=False),
+                  config_parse.create_settings(file_config, verbose=False),
+                  '#include "{}"'.format(_LOADPATH) ]
+
+        _hash = DataLoader.code_hash(_code, _rootpath)
+        if cache_dir is None:
+            print("Compiling DataLoader headers.")
+            for _c in _code:
+                R.gInterpreter.Declare(_c)
+        else:
+            DataLoader.load_compiled(_code, _rootpath, cache_dir, _hash)
+        return _hash
+
+    @staticmethod
+    def code_hash(code, rootpath):
+        '''
+        sha256 of the generated code (i.e. of the training and scaling configs)
+        and of the c++ headers, identifies the batches the DataLoader produces.
+        '''
+        _hash = hashlib.sha256()
+        for _c in code:
+            _hash.update(_c.encode())
+        for _header in DataLoader._HEADERS:
+            with open(os.path.join(rootpath, _header), "rb") as file:
+                _hash.update(file.read())
+        return _hash.hexdigest()
+
+    @staticmethod
+    def load_compiled(code, rootpath, cache_dir, code_hash):
+        '''
+        Ahead-of-time compilation of the DataLoader with ACLiC.
+        The library is stored in cache_dir under code_hash,
+        so that it is compiled only once and afterwards
+        loaded directly by every job.
+        '''
+        import fcntl
+
+        os.makedirs(cache_dir, exist_ok=True)
+        _name = os.path.join(os.path.abspath(cache_dir), "DataLoader_{}".format(code_hash[:16]))
+        _source = _name + ".C"
+
+        R.gSystem.AddIncludePath("-I" + rootpath)
+        with open(_name + ".lock", "w") as lock:
+            # concurrent jobs wait here until the library is built by the first one
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(_source):
+                # ACLiC rebuilds the library if the source is newer, so the source is written only once
+                with open(_source + ".tmp", "w") as file:
+                    file.write("\n".join(DataLoader._PRELUDE + code) + "\n")
+                os.replace(_source + ".tmp", _source)
+            print("Loading compiled DataLoader from {}".format(cache_dir))
+            if not R.gSystem.CompileMacro(_source, "kO"):
+                raise RuntimeError("Compilation of the DataLoader in {} failed".format(_source))
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
 
     def __init__(self, file_config, file_scaling):
 
-        self.compile_classes(file_config, file_scaling)
+        self.code_hash = self.compile_classes(file_config, file_scaling)
 
         with open(file_config) as file:
             self.config = yaml.safe_load(file)
@@ -149,12 +334,25 @@ class DataLoader:
         self.n_epochs         = self.config["SetupNN"]["n_epochs"]
         self.epoch         = self.config["SetupNN"]["epoch"]
         self.input_grids        = self.config["SetupNN"]["input_grids"]
+        self.use_shared_memory  = self.config["SetupNN"]["use_shared_memory"]
         self.n_cells = { 'inner': self.n_inner_cells, 'outer': self.n_outer_cells }
+        self.n_group_features = [ sum([ self.n_grid_features[fname] for fname in group ])
+                                  for group in self.input_grids ]
+
+        self.batch_cache = None
+        if self.config["SetupNN"]["batch_cache_dir"] is not None:
+            self.batch_cache = BatchCache(self.config["SetupNN"]["batch_cache_dir"], self.code_hash,
+                                          self.get_batch_shapes(), self.config["SetupNN"]["batch_cache_dtype"],
+                                          self.config["SetupNN"]["batch_cache_size"])
+
+        self.seed             = self.config["SetupNN"]["seed"]
 
         data_files = []
         for root, dirs, files in os.walk(os.path.abspath(self.config["Setup"]["input_dir"])):
             for file in files:
                 data_files.append(os.path.join(root, file))
+        # os.walk order is not reproducible, the split and the shuffling rely on the sorted list
+        data_files.sort()
 
         self.train_files, self.val_files = \
              np.split(data_files, [int(len(data_files)*(1-self.validation_split))])
@@ -167,8 +365,101 @@ class DataLoader:
         print("Files for training:", len(self.train_files))
         print("Files for validation:", len(self.val_files))
 
-
-    def get_generator(self, primary_set = True, return_truth = True, return_weights = False):
+        # progress of the current training epoch (see state_dict)
+        self.state_lock = threading.Lock()
+        self.finished_files = set()
+        self.file_entries = {}
+        # epoch progress after each batch of the current training generator (see state_dict)
+        # (the history has to be longer than the number of batches prefetched ahead of the training)
+        self.batch_states = collections.OrderedDict()
+        self.state_history_size = 1000
+        # statistics of the last generator of each set (see print_metrics)
+        self.metrics = {}
+
+    def set_epoch(self, epoch):
+        '''
+        Sets the training epoch and resets the epoch progress.
+        '''
+        with self.state_lock:
+            self.epoch = epoch
+            self.finished_files = set()
+            self.file_entries = {}
+            self.batch_states.clear()
+
+    def state_dict(self, n_batches = None):
+        '''
+        Position of the DataLoader in the training data:
+        epoch, seed, files read to the end and the next entry
+        of the files that are read partially.
+        The current position includes the batches which are yielded by the generator,
+        but not yet used by the training (prefetched by tf.data and Keras). With n_batches,
+        the position after the first n_batches of the current training generator is returned
+        instead, so that no batches are skipped when the training is resumed from it.
+        '''
+        with self.state_lock:
+            epoch, finished_files, file_entries = self.epoch, self.finished_files, self.file_entries
+            if n_batches is not None:
+                if n_batches in self.batch_states:
+                    epoch, finished_files, file_entries = self.batch_states[n_batches]
+                else:
+                    print("[WARNING] DataLoader state after batch {} is not available,"
+                          " the current state is used instead".format(n_batches))
+            return { "seed": self.seed,
+                     "epoch": epoch,
+                     "finished_files": sorted(finished_files),
+                     "file_entries": dict(file_entries) }
+
+    def load_state_dict(self, state):
+        '''
+        Restores the position saved with state_dict, the next training
+        generator continues the epoch from there.
+        '''
+        if state["seed"] != self.seed:
+            raise RuntimeError("DataLoader state was saved with seed {}, but seed {} is configured"
+                               .format(state["seed"], self.seed))
+        with self.state_lock:
+            self.epoch = state["epoch"]
+            self.finished_files = set(state["finished_files"])
+            self.file_entries = dict(state["file_entries"])
+            self.batch_states.clear()
+
+    def save_state(self, file_name, n_batches = None):
+        with open(file_name + ".tmp", "w") as file:
+            json.dump(self.state_dict(n_batches), file, indent=4)
+        os.replace(file_name + ".tmp", file_name)
+
+    def load_state(self, file_name):
+        with open(file_name) as file:
+            self.load_state_dict(json.load(file))
+
+    def get_epoch_files(self):
+        '''
+        Training files of the current epoch as (file, first entry) pairs,
+        shuffled with a permutation defined by (seed, epoch).
+        Files consumed according to the epoch progress are skipped
+        and partially read files start from their next entry.
+        '''
+        _files = np.random.default_rng([self.seed, self.epoch]).permutation(self.train_files)
+        with self.state_lock:
+            return [ (str(f), self.file_entries.get(str(f), 0)) for f in _files
+                     if str(f) not in self.finished_files ]
+
+    def update_state(self, file_name, entry, finished_files, n_batches):
+        with self.state_lock:
+            for f in finished_files:
+                self.finished_files.add(f)
+                self.file_entries.pop(f, None)
+            self.file_entries[file_name] = entry
+            self.batch_states[n_batches] = (self.epoch, frozenset(self.finished_files), dict(self.file_entries))
+            while len(self.batch_states) > self.state_history_size:
+                self.batch_states.popitem(last = False)
+
+
+    def get_generator(self, primary_set = True, return_truth = True, return_weights = False, copy_batches = False):
+        '''
+        With shared memory, batches are yielded as views of a ring slot, which is reused once the next
+        batch is requested. Consumers which keep batches longer (e.g. tf.data prefetching) need copy_batches.
+        '''
 
         _files = self.train_files if primary_set else self.val_files
         n_batches = self.n_batches if primary_set else self.n_batches_val
@@ -178,49 +469,158 @@ class DataLoader:
 
             finish_counter = 0
             batch_counter = mp.Value('i', 0)
-            # terminate_workers = mp.Value('b', False)
-            
+            stop_event = mp.Event()
+            metrics = { "n_batches": 0, "time": 0., "consumer_wait": 0., "producer_wait": 0. }
+            self.metrics["train" if primary_set else "val"] = metrics
+            if primary_set:
+                with self.state_lock:
+                    self.batch_states.clear()
+
             queue_files = mp.Queue()
-            [ queue_files.put(file) for file in _files ]
+            _epoch_files = self.get_epoch_files() if primary_set else [ (str(f), 0) for f in _files ]
+            [ queue_files.put(file) for file in _epoch_files ]
             queue_out = mp.Queue(self.max_queue_size)
 
+            shared_buffer, queue_free = None, None
+            if self.use_shared_memory:
+                # one slot per queued batch, per worker being filled and for the batch held by the consumer
+                n_slots = self.max_queue_size + self.n_load_workers + 1
+                shared_buffer = SharedBatchBuffer(self.get_batch_shapes(), n_slots)
+                queue_free = mp.Queue()
+                [ queue_free.put(slot_id) for slot_id in range(n_slots) ]
+                n_groups = len(self.input_grids)
+
             processes = []
             for i in range(self.n_load_workers):
                 processes.append(
                 mp.Process(target = LoaderThread, 
-                        args = (queue_out, queue_files, batch_counter, n_batches, #terminate_workers,
+                        args = (queue_out, queue_files, batch_counter, n_batches, stop_event,
                                 self.input_grids, self.batch_size, self.n_inner_cells,
                                 self.n_outer_cells, self.n_flat_features, self.n_grid_features,
-                                self.tau_types, return_truth, return_weights)))
+                                self.tau_types, return_truth, return_weights,
+                                shared_buffer, queue_free, self.batch_cache)))
                 processes[-1].deamon = True
                 processes[-1].start()
 
-            while finish_counter < self.n_load_workers:
-                item = queue_out.get()
-                if isinstance(item, TerminateGenerator):
-                    finish_counter+=1
-                else:
-                    yield item
+            def get_item():
+                # blocking get, which fails if workers are gone without being terminated
+                while True:
+                    try:
+                        return queue_out.get(timeout=1)
+                    except EmptyException:
+                        if not any(pr.is_alive() for pr in processes):
+                            raise RuntimeError("DataLoader workers stopped unexpectedly")
 
-            ## queue_out should be empty
-            ## before joining the processes
-            ## uncomment if needed:
-            # while not queue_out.empty():
-            #     _ = queue_out.get()
-            
-            ## This line send signal to all workers indicating
-            ## that all the processes were finished
-            ## and extra elements were removed (optional)
-            # terminate_workers.value = True
-
-            for i, pr in enumerate(processes):
-                pr.join()
+            _start_time = time.time()
+            try:
+                while finish_counter < self.n_load_workers:
+                    _start = time.time()
+                    item = get_item()
+                    if isinstance(item, TerminateGenerator):
+                        finish_counter+=1
+                        metrics["producer_wait"] += item.wait_time
+                        continue
+                    metrics["consumer_wait"] += time.time() - _start
+                    metrics["n_batches"] += 1
+                    item, progress = item
+                    if primary_set:
+                        self.update_state(*progress, metrics["n_batches"])
+                    if shared_buffer is None:
+                        yield item
+                    elif copy_batches:
+                        # the slot is released before the batch is handed over
+                        slot = [ np.array(x, copy=True) for x in shared_buffer.slot(item) ]
+                        queue_free.put(item)
+                        yield MakeItem(tuple(slot[:1+2*n_groups]), slot[-2], slot[-1], return_truth, return_weights)
+                    else:
+                        # the views stay valid until the next batch is requested
+                        slot = shared_buffer.slot(item)
+                        yield MakeItem(tuple(slot[:1+2*n_groups]), slot[-2], slot[-1], return_truth, return_weights)
+                        del slot
+                        queue_free.put(item)
+
+                if primary_set:
+                    # the epoch is complete, the next generator reads the next permutation
+                    self.set_epoch(self.epoch + 1)
+            finally:
+                # stop the workers (also when the generator is closed early) and drain
+                # queue_out, so that workers blocked on put or on a free slot can finish
+                stop_event.set()
+                while finish_counter < self.n_load_workers:
+                    try:
+                        item = queue_out.get(timeout=1)
+                    except EmptyException:
+                        if not any(pr.is_alive() for pr in processes): break
+                        continue
+                    if isinstance(item, TerminateGenerator):
+                        finish_counter+=1
+                        metrics["producer_wait"] += item.wait_time
+                    elif shared_buffer is not None:
+                        queue_free.put(item[0])
+                for pr in processes:
+                    pr.join()
+                metrics["time"] = time.time() - _start_time
+                self.print_metrics(primary_set)
+                if shared_buffer is not None:
+                    shared_buffer.release()
             gc.collect()
 
         return _generator
 
 
+    def print_metrics(self, primary_set = True):
+        '''
+        Summary of the waiting times of the last generator. Workers waiting long for queue
+        space indicate that max_queue_size or n_load_workers can be reduced, while
+        a long consumer waiting time indicates that the training is limited by the loader.
+        '''
+        name = "train" if primary_set else "val"
+        m = self.metrics[name]
+        print("[INFO] DataLoader ({}): {} batches in {:.1f} s, consumer waited {:.1f} s for data"
+              ", workers waited {:.1f} s for queue space ({:.1f} s per worker)"
+              .format(name, m["n_batches"], m["time"], m["consumer_wait"],
+                      m["producer_wait"], m["producer_wait"] / self.n_load_workers))
+
+    def get_dataset(self, primary_set = True, return_truth = True, return_weights = False):
+        '''
+        Wraps get_generator into tf.data.Dataset. Batches are produced as NumPy arrays
+        by the workers and converted to tensors only here, on the consumer side.
+        Shared memory batches are copied, since tf.data can wrap the NumPy buffers
+        without a copy and keeps prefetched elements while the slots are reused.
+        '''
+        import tensorflow as tf
+
+        _, input_shape, input_types = self.get_config()
+        x_shape, y_shape = input_shape
+        x_types, y_types = input_types
+        output_shapes, output_types = [x_shape], [x_types]
+        if return_truth:
+            output_shapes.append(y_shape)
+            output_types.append(y_types)
+        if return_weights:
+            output_shapes.append((None,))
+            output_types.append(tf.float32)
+        if len(output_shapes) == 1:
+            output_shapes, output_types = x_shape, x_types
+        else:
+            output_shapes, output_types = tuple(output_shapes), tuple(output_types)
+
+        generator = self.get_generator(primary_set, return_truth, return_weights, copy_batches = True)
+        return tf.data.Dataset.from_generator(generator, output_types = output_types,
+                                              output_shapes = output_shapes)
+
+    def get_batch_shapes(self):
+        '''
+        Shapes of all batch elements in the order:
+        flat tau features, inner grids, outer grids, labels, weights.
+        '''
+        return [ (self.batch_size, self.n_flat_features) ] + \
+               [ (self.batch_size, self.n_inner_cells, self.n_inner_cells, n) for n in self.n_group_features ] + \
+               [ (self.batch_size, self.n_outer_cells, self.n_outer_cells, n) for n in self.n_group_features ] + \
+               [ (self.batch_size, self.tau_types), (self.batch_size,) ]
+
     def get_config(self):
+        import tensorflow as tf
 
         def get_branches(config, group):
             return list(
@@ -42,6 +42,7 @@ n_grid_features = {
 }
 
 input_grids =[ [ "PfCand_electron", "PfCand_gamma", "Electron" ], [ "PfCand_muon", "Muon" ], [ "PfCand_chHad", "PfCand_nHad" ] ]
+n_group_features = list(R.Setup.n_input_grid_features)
 
 input_files = []
 for root, dirs, files in os.walk(os.path.abspath(R.Setup.input_dir)):
@@ -63,16 +64,12 @@ def getdata(_obj_f, _reshape, _dtype=np.float32):
     return x if _reshape==-1 else x.reshape(_reshape)
 
 def getgrid(_obj_grid, _inner):
+    # each input grid group is filled as one contiguous (tau, eta, phi, feature) buffer
     _n_cells = n_inner_cells if _inner else n_outer_cells
     _X = []
-    for group in input_grids:
-        _X.append(
-            np.concatenate(
-                [ getdata(_obj_grid[ getattr(R.CellObjectType,fname) ][_inner],
-                    (n_tau, _n_cells, _n_cells, n_grid_features[fname])) for fname in group ],
-                axis=-1
-                )
-            )
+    for group_idx in range(len(n_group_features)):
+        _X.append(getdata(_obj_grid[group_idx][_inner],
+                  (n_tau, _n_cells, _n_cells, n_group_features[group_idx])))
     return _X
 
 c = 0
@@ -12,6 +12,62 @@ try:
 except:
     from tqdm import tqdm
 
+class WeightStore:
+    """Column-per-file store of per-tau weights.
+
+    Each column is kept in <path>/<column>.npy, which is memory-mapped on open: range reads touch only the
+    requested rows, columns can be updated in place and processes opening the same store share its pages.
+    mode='c' (default) keeps updates private to the process, mode='r+' writes them back to the files.
+    """
+    def __init__(self, columns=None):
+        self.columns = columns if columns is not None else {}
+
+    @staticmethod
+    def IsStore(path):
+        return os.path.isdir(path)
+
+    @staticmethod
+    def FromDataFrame(df):
+        return WeightStore({ column: np.ascontiguousarray(df[column].values) for column in df.columns })
+
+    @staticmethod
+    def Open(path, mode='c'):
+        columns = {}
+        for file_name in sorted(os.listdir(path)):
+            if file_name.endswith('.npy'):
+                columns[file_name[:-len('.npy')]] = np.load(os.path.join(path, file_name), mmap_mode=mode)
+        return WeightStore(columns)
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if len(self.columns) else 0
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __setitem__(self, column, values):
+        if column in self.columns and self.columns[column].shape == np.shape(values):
+            self.columns[column][:] = values
+        else:
+            self.columns[column] = np.array(values)
+
+    def GetColumns(self, columns, start, stop):
+        return np.stack([ self.columns[column][start:stop] for column in columns ], axis=1)
+
+    def ToDataFrame(self):
+        return pandas.DataFrame({ column: np.asarray(values) for column, values in self.columns.items() })
+
+    def Save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for column, values in self.columns.items():
+            file_name = os.path.join(path, column + '.npy')
+            tmp_file_name = os.path.join(path, column + '.tmp.npy')
+            np.save(tmp_file_name, values)
+            os.replace(tmp_file_name, file_name)
+
 class WeightManager:
     @staticmethod
     def CreateBins():
@@ -47,29 +103,41 @@ class WeightManager:
 
         return weight_df
 
-    def __init__(self, weight_file_name, calc_weights=False, full_file_name = None, Y = None, first_block = True):
+    def __init__(self, weight_file_name, calc_weights=False, full_file_name = None, Y = None, first_block = True,
+                 store_mode = 'c'):
+        '''
+        weight_file_name - directory of the columnar weight store (see WeightStore),
+                           or a .h5/.hdf5 file in the legacy pandas HDF5 format.
+        store_mode - memory-mapping mode of the store: 'c' updates the weights only in memory, 'r+' also in the files.
+        '''
         self.pt_bins, self.eta_bins, self.pteta_bins = WeightManager.CreateBins()
         if calc_weights:
             if (full_file_name is None) or (Y is None):
                 raise RuntimeError("Missing information which is needed to calculate the weights.")
-            self.weight_df = WeightManager.CreateWeightDataFrame(full_file_name, Y, self.pt_bins, self.eta_bins)
+            self.weights = WeightStore.FromDataFrame(
+                WeightManager.CreateWeightDataFrame(full_file_name, Y, self.pt_bins, self.eta_bins))
             self.SaveWeights(weight_file_name)
+        elif WeightStore.IsStore(weight_file_name):
+            self.weights = WeightStore.Open(weight_file_name, mode=store_mode)
         else:
-            self.weight_df = pandas.read_hdf(weight_file_name, 'weights')
+            self.weights = WeightStore.FromDataFrame(pandas.read_hdf(weight_file_name, 'weights'))
 
         if first_block:
             for cl in ['e', 'mu', 'jet']:
-                self.weight_df["tau_vs_" + cl] = pandas.Series(np.zeros(self.weight_df.shape[0]),
-                                                               index=self.weight_df.index)
-                self.weight_df["weight_" + cl] = pandas.Series(np.copy(self.weight_df.weight.values),
-                                                               index=self.weight_df.index)
+                self.weights["tau_vs_" + cl] = np.zeros(len(self.weights))
+                self.weights["weight_" + cl] = np.copy(self.weights["weight"])
 
-        self.sum_tau_weights = self.weight_df[self.weight_df.gen_tau == 1].weight.sum()
+        self.sum_tau_weights = self.weights["weight"][self.weights["gen_tau"] == 1].sum()
 
         gc.collect()
 
+    @property
+    def weight_df(self):
+        # copy of the weights as a DataFrame, for the inspection only: updates should go through self.weights
+        return self.weights.ToDataFrame()
+
     def GetWeights(self, start, stop):
-        return self.weight_df[["weight_e", "weight_mu", "weight_jet"]].values[start:stop, :]
+        return self.weights.GetColumns(["weight_e", "weight_mu", "weight_jet"], start, stop)
 
     def SetHistFileName(self, hist_file_name, overwrite=True):
         self.hist_file_name = hist_file_name
@@ -77,7 +145,10 @@ class WeightManager:
             os.remove(hist_file_name)
 
     def SaveWeights(self, weight_file_name):
-        self.weight_df.to_hdf(weight_file_name, 'weights', mode='w', format='fixed', complevel=1)
+        if weight_file_name.endswith('.h5') or weight_file_name.endswith('.hdf5'):
+            self.weights.ToDataFrame().to_hdf(weight_file_name, 'weights', mode='w', format='fixed', complevel=1)
+        else:
+            self.weights.Save(weight_file_name)
 
     def UpdateWeights(self, model, epoch, X, test_start, n_test, sf_inputs, class_target_eff, batch_size=100000):
         pred = model.predict([X[test_start:test_start+n_test], self.GetWeights(test_start, test_start+n_test),
@@ -85,94 +156,73 @@ class WeightManager:
                              batch_size = batch_size, verbose=0)
         print("\tpredictions has been calculated.")
 
-        n_bins = self.pteta_bins.shape[0]
-        n_updates = n_bins * len(class_target_eff)
-        df_update = pandas.DataFrame(data ={
-            'epoch': np.ones(n_updates, dtype=int) * epoch,
-            'cl_idx': np.ones(n_updates, dtype=int) * (-1),
-            'target_eff': np.zeros(n_updates),
-            'threashold': np.zeros(n_updates),
-            'pt_bin_id': np.zeros(n_updates, dtype=int),
-            'eta_bin_id': np.zeros(n_updates, dtype=int),
-            'pt_min': np.zeros(n_updates),
-            'pt_max': np.zeros(n_updates),
-            'eta_min': np.zeros(n_updates),
-            'eta_max': np.zeros(n_updates),
-            'is_updated': np.ones(n_updates, dtype=int),
-            'sf': np.ones(n_updates),
-            'eff': np.zeros(n_updates),
-            'eff_err': np.zeros(n_updates),
-            'n_taus': np.zeros(n_updates, dtype=int),
-            'n_passed': np.ones(n_updates),
-        })
-
-        upd_idx = 0
-
-        test_sel = (self.weight_df.index >= test_start) & (self.weight_df.index < test_start + n_test)
-        tau_sel = test_sel & (self.weight_df.gen_tau == 1)
-
         thr = np.zeros(3)
         all_target_eff = np.zeros(3)
 
+        test_slice = slice(test_start, test_start + n_test)
+        is_test_tau = self.weights["gen_tau"][test_slice] == 1
+
         for cl, target_eff in class_target_eff:
-            br_loc = self.weight_df.columns.get_loc('tau_vs_'+cl)
             cl_idx = match_suffixes.index(cl)
             tau_vs_cl = TauLosses.tau_vs_other(pred[:, tau], pred[:, cl_idx])
-            self.weight_df.iloc[test_start:test_start+n_test, br_loc] = tau_vs_cl
-            df_tau = self.weight_df[tau_sel]
+            self.weights["tau_vs_" + cl][test_slice] = tau_vs_cl
             cl_idx = min(cl_idx, 2)
-            thr[cl_idx] = np.percentile(df_tau["tau_vs_" + cl], (1 - target_eff) * 100)
-            #thr[cl_idx] = quantile_ex(df_tau["tau_vs_" + cl].values, 1 - target_eff, df_tau.weight.values)
+            test_tau_vs_cl = self.weights["tau_vs_" + cl][test_slice][is_test_tau]
+            thr[cl_idx] = np.percentile(test_tau_vs_cl, (1 - target_eff) * 100)
+            #thr[cl_idx] = quantile_ex(test_tau_vs_cl, 1 - target_eff, self.weights["weight"][test_slice][is_test_tau])
             all_target_eff[cl_idx] = target_eff
 
         sf_results = sf_calc.CalculateScaleFactors(self.pt_bins, self.eta_bins,
-                self.weight_df.tau_vs_e.values, self.weight_df.tau_vs_mu.values, self.weight_df.tau_vs_jet.values,
-                self.weight_df.gen_tau.values, self.weight_df.weight.values, thr, all_target_eff, test_start,
-                n_test, self.weight_df.pt_bin_ids.values, self.weight_df.eta_bin_ids.values)
+                self.weights["tau_vs_e"], self.weights["tau_vs_mu"], self.weights["tau_vs_jet"],
+                self.weights["gen_tau"], self.weights["weight"], thr, all_target_eff, test_start,
+                n_test, self.weights["pt_bin_ids"], self.weights["eta_bin_ids"])
         weights_changed = np.count_nonzero(sf_results[:, :, :, 0]) > 0
 
         if weights_changed:
-            new_weights = sf_calc.ApplyScaleFactors(self.weight_df.pt_bin_ids.values,
-                    self.weight_df.eta_bin_ids.values, sf_results, self.weight_df.gen_tau.values,
-                    self.GetWeights(0, self.weight_df.shape[0]), self.weight_df.weight.values,
+            new_weights = sf_calc.ApplyScaleFactors(self.weights["pt_bin_ids"],
+                    self.weights["eta_bin_ids"], sf_results, self.weights["gen_tau"],
+                    self.GetWeights(0, len(self.weights)), self.weights["weight"],
                     self.sum_tau_weights, 10)
             for cl, target_eff in class_target_eff:
                 cl_idx = min(match_suffixes.index(cl), 2)
                 if np.count_nonzero(sf_results[cl_idx, :, :, 0]) > 0:
-                    w_br_loc = self.weight_df.columns.get_loc('weight_' + cl)
-                    self.weight_df.iloc[:, w_br_loc] = new_weights[:, cl_idx]
+                    self.weights["weight_" + cl] = new_weights[:, cl_idx]
+
+        # one row per (class, pt bin, eta bin), filled from sf_results in one go
+        n_pt_bins, n_eta_bins = len(self.pt_bins) - 1, len(self.eta_bins) - 1
+        cl_ids = np.array([ min(match_suffixes.index(cl), 2) for cl, _ in class_target_eff ], dtype=int)
+        target_effs = np.array([ target_eff for _, target_eff in class_target_eff ])
+        cl_pos, pt_bin_ids, eta_bin_ids = [ idx.ravel() for idx in np.meshgrid(np.arange(len(cl_ids)), np.arange(n_pt_bins),
+                                                                                np.arange(n_eta_bins), indexing='ij') ]
+        cl_idx = cl_ids[cl_pos]
+        bin_results = sf_results[cl_idx, pt_bin_ids, eta_bin_ids]
+        df_update = pandas.DataFrame(data ={
+            'epoch': np.full(len(cl_idx), epoch, dtype=int),
+            'cl_idx': cl_idx,
+            'target_eff': target_effs[cl_pos],
+            'threashold': thr[cl_idx],
+            'pt_bin_id': pt_bin_ids,
+            'eta_bin_id': eta_bin_ids,
+            'pt_min': self.pt_bins[pt_bin_ids].astype(float),
+            'pt_max': self.pt_bins[pt_bin_ids + 1].astype(float),
+            'eta_min': self.eta_bins[eta_bin_ids].astype(float),
+            'eta_max': self.eta_bins[eta_bin_ids + 1].astype(float),
+            'is_updated': bin_results[:, 0].astype(int),
+            'sf': bin_results[:, 1],
+            'eff': bin_results[:, 2],
+            'eff_err': bin_results[:, 3],
+            'n_taus': bin_results[:, 4].astype(int),
+            'n_passed': bin_results[:, 7].astype(float),
+        })
 
-        for cl, target_eff in class_target_eff:
-            cl_idx = min(match_suffixes.index(cl), 2)
-            for pt_bin_id in range(len(self.pt_bins) - 1):
-                for eta_bin_id in range(len(self.eta_bins) - 1):
-                    df_update.loc[upd_idx, 'cl_idx'] = cl_idx
-                    df_update.loc[upd_idx, 'target_eff'] = target_eff
-                    df_update.loc[upd_idx, 'threashold'] = thr[cl_idx]
-                    df_update.loc[upd_idx, 'pt_bin_id'] = pt_bin_id
-                    df_update.loc[upd_idx, 'eta_bin_id'] = eta_bin_id
-                    df_update.loc[upd_idx, 'pt_min'] = self.pt_bins[pt_bin_id]
-                    df_update.loc[upd_idx, 'pt_max'] = self.pt_bins[pt_bin_id+1]
-                    df_update.loc[upd_idx, 'eta_min'] = self.eta_bins[eta_bin_id]
-                    df_update.loc[upd_idx, 'eta_max'] = self.eta_bins[eta_bin_id+1]
-
-                    df_update.loc[upd_idx, 'is_updated'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 0]
-                    df_update.loc[upd_idx, 'sf'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 1]
-                    df_update.loc[upd_idx, 'n_taus'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 4]
-                    df_update.loc[upd_idx, 'n_passed'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 7]
-                    df_update.loc[upd_idx, 'eff'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 2]
-                    df_update.loc[upd_idx, 'eff_err'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 3]
-
-                    upd_idx += 1
-
-
-            cl_update = df_update[df_update.cl_idx == cl_idx]
-            cl_updated = cl_update[cl_update.is_updated > 0]
-            if cl_updated.shape[0] > 0:
-                average_sf = np.average(cl_updated.sf, weights=cl_updated.n_taus)
+        for cl, _ in class_target_eff:
+            cl_updated = (cl_idx == min(match_suffixes.index(cl), 2)) & (bin_results[:, 0] > 0)
+            n_changed = np.count_nonzero(cl_updated)
+            if n_changed > 0:
+                average_sf = np.average(bin_results[cl_updated, 1], weights=bin_results[cl_updated, 4])
             else:
                 average_sf = 0
-            print('tau_vs_{}: bins changed = {}, average sf = {}'.format(cl, cl_updated.shape[0], average_sf))
+            print('tau_vs_{}: bins changed = {}, average sf = {}'.format(cl, n_changed, average_sf))
         if self.hist_file_name is not None:
             df_update.to_hdf(self.hist_file_name, "weight_updates", append=True, complevel=1, complib='zlib')
         gc.collect()
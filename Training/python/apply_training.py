@@ -4,35 +4,96 @@ import argparse
 parser = argparse.ArgumentParser(description='Apply training and store results.')
 parser.add_argument('--input', required=True, type=str, help="Input directory")
 parser.add_argument('--filelist', required=False, type=str, default=None, help="Txt file with input tuple list")
-parser.add_argument('--output', required=True, type=str, help="Output file")
-parser.add_argument('--model', required=True, type=str, help="Model file")
+parser.add_argument('--output', required=True, type=str, help="Output directory")
+parser.add_argument('--model', required=True, type=str, help="Model file (.pb graph) or SavedModel directory")
+parser.add_argument('--training-cfg', required=True, type=str, help="Training config used to build the inputs")
+parser.add_argument('--scaling-cfg', required=True, type=str, help="Feature scaling config used to build the inputs")
 parser.add_argument('--tree', required=False, type=str, default="taus", help="Tree name")
-parser.add_argument('--chunk-size', required=False, type=int, default=1000, help="Chunk size")
-parser.add_argument('--batch-size', required=False, type=int, default=250, help="Batch size")
-parser.add_argument('--max-queue-size', required=False, type=int, default=8, help="Maximal queue size")
+parser.add_argument('--batch-size', required=False, type=int, default=1000,
+                    help="Number of taus per inference batch")
+parser.add_argument('--n-workers', required=False, type=int, default=4,
+                    help="Number of loader processes, each reading its own input files")
+parser.add_argument('--max-queue-memory', required=False, type=float, default=2048,
+                    help="Maximal memory (in MB) of the inference batches waiting in the queue")
 parser.add_argument('--max-n-files', required=False, type=int, default=None, help="Maximum number of files to process")
-parser.add_argument('--max-n-entries-per-file', required=False, type=int, default=None,
-                    help="Maximum number of entries per file")
+parser.add_argument('--manifest', required=False, type=str, default=None,
+                    help="Json file with the processed files, which are skipped (default: OUTPUT/manifest.json)")
 args = parser.parse_args()
 
 import os
-import gc
-import pandas
-import tensorflow as tf
+import json
+import multiprocessing as mp
+from queue import Empty as EmptyException
 import numpy as np
+import pandas
+import ROOT as R
+import yaml
 from tqdm import tqdm
 
-from common import *
-from DataLoader import DataLoader, read_hdf_lock
+from DataLoader import DataLoader
+from config_parse import get_input_shapes
+
+class FileDone:
+    '''
+    Sent by a loader once a file is read to the end,
+    together with the number of entries in the file.
+    '''
+    def __init__(self, file_name, n_entries):
+        self.file_name = file_name
+        self.n_entries = n_entries
+
+class LoaderDone:
+    pass
+
+def LoaderThread(queue_out, queue_files, input_shapes, n_tau, batch_size):
+    '''
+    Reads complete input files one by one and sends inference batches of up to batch_size taus
+    as (file, inputs) items. Loader batches of a file are merged into large batches,
+    so that the model is called only a few times per file.
+    '''
+    def getbatch(data, n_filled):
+        # copies of the filled part of the c++ buffers: tau, inner grids, outer grids
+        buffers = [ data.x_tau ] + [ grid[1] for grid in data.x_grid ] + [ grid[0] for grid in data.x_grid ]
+        return [ np.array(np.frombuffer(buf.data(), dtype=np.float32, count=buf.size())
+                          .reshape((n_tau,) + shape)[:n_filled])
+                 for buf, shape in zip(buffers, input_shapes) ]
+
+    def send(batches):
+        queue_out.put((file_name, [ np.concatenate(x) for x in zip(*batches) ]))
+
+    dl_worker = R.DataLoader()
+    while True:
+        try:
+            file_name = queue_files.get(False)
+        except EmptyException:
+            break
+        dl_worker.ReadFile(R.std.string(file_name), 0, -1)
+        batches, n_taus = [], 0
+        while dl_worker.MoveNext():
+            batches.append(getbatch(dl_worker.LoadData(), n_tau))
+            n_taus += n_tau
+            if n_taus >= batch_size:
+                send(batches)
+                batches, n_taus = [], 0
+        n_filled = int(dl_worker.GetBatchFill())
+        if n_filled > 0:
+            batches.append(getbatch(dl_worker.LoadPartialData(), n_filled))
+        if len(batches):
+            send(batches)
+        queue_out.put(FileDone(file_name, int(dl_worker.GetCurrentEntry())))
+    queue_out.put(LoaderDone())
 
 class Predictor:
-    def __init__(self, graph, net_config):
+    # input names of the full network, see DataLoader.get_config
+    cell_locations = [ 'inner', 'outer' ]
+    comp_names = [ 'egamma', 'muon', 'hadrons' ]
+
+    def __init__(self, graph):
         gr_name_prefix = "deepTau/input_"
         self.x_graphs = []
-        if len(net_config.tau_branches):
-            self.x_graphs.append(graph.get_tensor_by_name(gr_name_prefix + "tau:0"))
-        for loc in net_config.cell_locations:
-            for comp_name in net_config.comp_names:
+        self.x_graphs.append(graph.get_tensor_by_name(gr_name_prefix + "tau:0"))
+        for loc in Predictor.cell_locations:
+            for comp_name in Predictor.comp_names:
                 gr_name = '{}{}_{}:0'.format(gr_name_prefix, loc, comp_name)
                 self.x_graphs.append(graph.get_tensor_by_name(gr_name))
         self.y_graph = graph.get_tensor_by_name("deepTau/main_output/Softmax:0")
@@ -44,64 +105,150 @@ class Predictor:
         feed_dict = {}
         for n in range(len(self.x_graphs)):
             feed_dict[self.x_graphs[n]] = X[n]
-        pred = session.run(self.y_graph, feed_dict=feed_dict)
+        return Predictor.Check(session.run(self.y_graph, feed_dict=feed_dict))
+
+    @staticmethod
+    def Check(pred):
         if np.any(np.isnan(pred)):
             raise RuntimeError("NaN in predictions. Total count = {} out of {}".format(
                                np.count_nonzero(np.isnan(pred)), pred.shape))
         if np.any(pred < 0) or np.any(pred > 1):
             raise RuntimeError("Predictions outside [0, 1] range.")
-        return pandas.DataFrame(data = {
-            'deepId_e': pred[:, e], 'deepId_mu': pred[:, mu], 'deepId_tau': pred[:, tau],
-            'deepId_jet': pred[:, jet]
-        })
+        return pred
+
+class SavedModelPredictor:
+    def __init__(self, model):
+        self.model = model
+
+    def Predict(self, session, X):
+        return Predictor.Check(self.model(X, training=False).numpy())
+
+def LoadManifest(file_name, model):
+    if not os.path.isfile(file_name):
+        return { "model": model, "files": {} }
+    with open(file_name) as f:
+        manifest = json.load(f)
+    if manifest["model"] != model:
+        raise RuntimeError('"{}" was produced with model "{}". Use another output directory or manifest.'
+                           .format(file_name, manifest["model"]))
+    return manifest
+
+def SaveManifest(manifest, file_name):
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(file_name + ".tmp", file_name)
+
+def SavePredictions(pred, pred_output, tree):
+    # single bulk write into a temporary file, the output appears only once it is complete
+    df = pandas.DataFrame(data = {
+        'deepId_e': pred[:, e], 'deepId_mu': pred[:, mu], 'deepId_tau': pred[:, tau],
+        'deepId_jet': pred[:, jet]
+    })
+    tmp_output = pred_output + '.tmp'
+    df.to_hdf(tmp_output, key=tree, mode='w', format='fixed', complevel=1, complib='zlib')
+    os.replace(tmp_output, pred_output)
 
 if args.filelist is None:
     if os.path.isdir(args.input):
-        file_list = [ f for f in os.listdir(args.input) if f.endswith('.root') or f.endswith('.h5') ]
+        file_list = [ f for f in sorted(os.listdir(args.input)) if f.endswith('.root') ]
         prefix = args.input + '/'
     else:
         file_list = [ args.input ]
         prefix = ''
 else:
     with open(args.filelist, 'r') as f_list:
-        file_list = [ f.strip() for f in f_list if len(f) != 0 ]
+        file_list = [ f.strip() for f in f_list if len(f.strip()) != 0 ]
+    prefix = ''
 
 if len(file_list) == 0:
     raise RuntimeError("Empty input list")
-#if args.max_n_files is not None and args.max_n_files > 0:
-#    file_list = file_list[0:args.max_n_files]
+if args.max_n_files is not None and args.max_n_files > 0:
+    file_list = file_list[0:args.max_n_files]
 
+os.makedirs(args.output, exist_ok=True)
+model_path = os.path.abspath(args.model)
+manifest_name = args.manifest if args.manifest is not None else os.path.join(args.output, 'manifest.json')
+manifest = LoadManifest(manifest_name, model_path)
 
-graph = load_graph(args.model)
-sess = tf.Session(graph=graph)
-net_conf = netConf_full
-predictor = Predictor(graph, net_conf)
-
-file_index = 0
+pred_outputs = {}
 for file_name in file_list:
-    if args.max_n_files is not None and file_index >= args.max_n_files: break
-    full_name = prefix + file_name
-
-    pred_output = args.output + '/' + os.path.splitext(file_name)[0] + '_pred.h5'
-    if os.path.isfile(pred_output):
+    pred_output = os.path.join(args.output, os.path.splitext(os.path.basename(file_name))[0] + '_pred.h5')
+    if prefix + file_name in manifest["files"] and os.path.isfile(pred_output):
         print('"{}" already present in the output directory.'.format(pred_output))
         continue
-        #os.remove(pred_output)
-    print("Processing '{}' -> '{}'".format(file_name, os.path.basename(pred_output)))
-
-    loader = DataLoader(full_name, net_conf, args.batch_size, args.chunk_size,
-                        max_data_size = args.max_n_entries_per_file, max_queue_size = args.max_queue_size,
-                        n_passes = 1, return_grid = True)
-
-    with tqdm(total=loader.data_size, unit='taus') as pbar:
-        for inputs in loader.generator(return_truth = False, return_weights = False):
-            df = predictor.Predict(sess, inputs)
-            read_hdf_lock.acquire()
-            df.to_hdf(pred_output, args.tree, append=True, complevel=1, complib='zlib')
-            read_hdf_lock.release()
-            pbar.update(df.shape[0])
-            del df
-            gc.collect()
-    file_index += 1
+    pred_outputs[prefix + file_name] = pred_output
+
+if len(pred_outputs) == 0:
+    print("All files processed.")
+    raise SystemExit(0)
+
+# loaders are started before TensorFlow is initialised, they only need the compiled c++ DataLoader
+DataLoader.compile_classes(args.training_cfg, args.scaling_cfg)
+with open(args.training_cfg) as f:
+    config = yaml.safe_load(f)
+input_shapes = get_input_shapes(config)
+
+queue_files = mp.Queue()
+[ queue_files.put(file_name) for file_name in pred_outputs ]
+# the queue is bounded by the memory of the inference batches
+batch_memory = args.batch_size * sum([ np.prod(shape) for shape in input_shapes ]) * np.dtype(np.float32).itemsize / 2 ** 20
+max_queue_size = max(1, int(args.max_queue_memory // batch_memory))
+print("[INFO] inference batch of {} taus takes {:.0f} MB, up to {} batches are queued.".format(
+      args.batch_size, batch_memory, max_queue_size))
+queue_out = mp.Queue(max_queue_size)
+n_workers = min(args.n_workers, len(pred_outputs))
+processes = []
+for i in range(n_workers):
+    processes.append(mp.Process(target = LoaderThread,
+                                args = (queue_out, queue_files, input_shapes, config["Setup"]["n_tau"],
+                                        args.batch_size)))
+    processes[-1].daemon = True
+    processes[-1].start()
+
+import tensorflow as tf
+from common import e, mu, tau, jet, load_graph
+
+if os.path.isdir(args.model):
+    sess = None
+    predictor = SavedModelPredictor(tf.keras.models.load_model(args.model, compile=False))
+else:
+    graph = load_graph(args.model)
+    sess = tf.Session(graph=graph)
+    predictor = Predictor(graph)
+
+# predictions are collected in memory per file and written once the file is read to the end
+predictions = { file_name: [] for file_name in pred_outputs }
+failed_files = []
+finish_counter = 0
+with tqdm(total=len(pred_outputs), unit='files') as pbar:
+    while finish_counter < n_workers:
+        try:
+            item = queue_out.get(timeout=1)
+        except EmptyException:
+            if not any(pr.is_alive() for pr in processes):
+                raise RuntimeError("Loader processes stopped unexpectedly")
+            continue
+        if isinstance(item, LoaderDone):
+            finish_counter += 1
+        elif isinstance(item, FileDone):
+            pred = np.concatenate(predictions.pop(item.file_name) or [ np.zeros((0, 4), dtype=np.float32) ])
+            # predictions are matched to the tuple entries by position, so a file with skipped taus can't be used
+            if pred.shape[0] == item.n_entries:
+                SavePredictions(pred, pred_outputs[item.file_name], args.tree)
+                manifest["files"][item.file_name] = { "output": pred_outputs[item.file_name], "n_taus": pred.shape[0] }
+                SaveManifest(manifest, manifest_name)
+            else:
+                failed_files.append(item.file_name)
+            pbar.update(1)
+        else:
+            file_name, X = item
+            predictions[file_name].append(predictor.Predict(sess, X))
+
+for pr in processes:
+    pr.join()
 
+if len(failed_files):
+    raise RuntimeError("The number of predictions differs from the number of entries for {} files, which are not"
+                       " stored: {}. Taus of tau types which are not in the training config are skipped by the"
+                       " DataLoader.".format(len(failed_files), ', '.join(failed_files)))
 print("All files processed.")
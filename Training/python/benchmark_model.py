@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import argparse
+parser = argparse.ArgumentParser(description='Measure the inference latency and throughput of frozen graphs.')
+parser.add_argument('--model', required=True, type=str, nargs='+', help="Protocol Buffers file(s) to benchmark")
+parser.add_argument('--training-cfg', required=True, type=str, help="Training config, which defines the input shapes")
+parser.add_argument('--output', required=False, type=str, default=None, help="Output json file")
+parser.add_argument('--output-node', required=False, type=str, default="deepTau/main_output/Softmax:0",
+                    help="Name of the output tensor")
+parser.add_argument('--batch-sizes', required=False, type=int, nargs='+', default=[1, 10, 100, 1000],
+                    help="Number of taus per inference call")
+parser.add_argument('--intra-threads', required=False, type=int, nargs='+', default=[1, 2, 4],
+                    help="Values of intra_op_parallelism_threads to scan")
+parser.add_argument('--inter-threads', required=False, type=int, nargs='+', default=[1, 2],
+                    help="Values of inter_op_parallelism_threads to scan")
+parser.add_argument('--n-warmup', required=False, type=int, default=5, help="Number of calls before the measurement")
+parser.add_argument('--n-iter', required=False, type=int, default=50, help="Number of measured calls")
+parser.add_argument('--seed', required=False, type=int, default=12345, help="Seed of the synthetic inputs")
+args = parser.parse_args()
+
+import json
+import time
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from common import load_graph
+from config_parse import get_input_shapes
+
+# input names of the full network in the order of get_input_shapes
+input_names = [ "deepTau/input_tau:0" ] + [ "deepTau/input_{}_{}:0".format(loc, comp_name)
+                                            for loc in [ 'inner', 'outer' ]
+                                            for comp_name in [ 'egamma', 'muon', 'hadrons' ] ]
+
+def get_inputs(graph, input_shapes):
+    '''
+    Input placeholders of the graph found by name,
+    checked against the shapes from the training config.
+    '''
+    if len(input_names) != len(input_shapes):
+        raise RuntimeError("{} inputs are expected from the training config, while the network has {}."
+                           .format(len(input_shapes), len(input_names)))
+    placeholders = [ graph.get_tensor_by_name(name) for name in input_names ]
+    for x, shape in zip(placeholders, input_shapes):
+        if not x.shape.is_compatible_with((None,) + shape):
+            raise RuntimeError("Input {} has shape {}, while {} is expected from the training config."
+                               .format(x.name, x.shape, (None,) + shape))
+    return placeholders
+
+def get_latencies(session, x_graphs, y_graph, X, n_warmup, n_iter):
+    feed_dict = { x: x_value for x, x_value in zip(x_graphs, X) }
+    for _ in range(n_warmup):
+        session.run(y_graph, feed_dict=feed_dict)
+    latencies = np.empty(n_iter)
+    for n in range(n_iter):
+        start = time.perf_counter()
+        session.run(y_graph, feed_dict=feed_dict)
+        latencies[n] = time.perf_counter() - start
+    return latencies
+
+# input shapes are taken from the config only, the input files are not needed
+with open(args.training_cfg) as f:
+    input_shapes = get_input_shapes(yaml.safe_load(f))
+rng = np.random.default_rng(args.seed)
+# the same synthetic inputs are used for all graphs and thread settings
+inputs = { batch_size: [ rng.standard_normal((batch_size,) + shape).astype(np.float32)
+                         for shape in input_shapes ]
+           for batch_size in args.batch_sizes }
+
+results = { "settings": { "n_warmup": args.n_warmup, "n_iter": args.n_iter,
+                          "input_shapes": [ list(shape) for shape in input_shapes ] },
+            "models": {} }
+for model in args.model:
+    graph = load_graph(model)
+    x_graphs = get_inputs(graph, input_shapes)
+    y_graph = graph.get_tensor_by_name(args.output_node)
+    model_results = []
+    for intra_threads in args.intra_threads:
+        for inter_threads in args.inter_threads:
+            config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads,
+                                    inter_op_parallelism_threads=inter_threads,
+                                    device_count = {'CPU' : 1, 'GPU' : 0})
+            with tf.Session(graph=graph, config=config) as sess:
+                for batch_size in args.batch_sizes:
+                    latencies = get_latencies(sess, x_graphs, y_graph, inputs[batch_size],
+                                              args.n_warmup, args.n_iter)
+                    model_results.append({
+                        "batch_size": batch_size,
+                        "intra_op_threads": intra_threads,
+                        "inter_op_threads": inter_threads,
+                        "latency_p50_ms": float(np.percentile(latencies, 50) * 1e3),
+                        "latency_p99_ms": float(np.percentile(latencies, 99) * 1e3),
+                        "taus_per_s": float(batch_size * len(latencies) / np.sum(latencies)),
+                    })
+                    print("[INFO] {}: batch size {}, threads {}/{}: p50 {:.2f} ms, p99 {:.2f} ms, {:.0f} taus/s"
+                          .format(model, batch_size, intra_threads, inter_threads,
+                                  model_results[-1]["latency_p50_ms"], model_results[-1]["latency_p99_ms"],
+                                  model_results[-1]["taus_per_s"]))
+    results["models"][model] = model_results
+
+if args.output is None:
+    print(json.dumps(results, indent=4))
+else:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
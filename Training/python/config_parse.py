@@ -14,7 +14,9 @@ def create_settings(input_file: str, verbose=False) -> str:
           PfCand_electron,
           PfCand_muon,
           ...};
-    4.  FeaturesHelper explicit templated structures:
+    4.  FeaturesHelper explicit templated structures
+        (including the position of the cell type inside
+        the input grid groups defined in SetupNN.input_grids):
         e.g:
         template<typename T> struct FeaturesHelper;
         template<> struct FeaturesHelper<PfCand_electron_Features> {...
@@ -27,6 +29,9 @@ def create_settings(input_file: str, verbose=False) -> str:
     '''
     import yaml
 
+    def n_features(content: dict, key_name: str) -> int:
+        return len(content["Features_all"][key_name]) - len(content["Features_disable"][key_name])
+
     def create_namestruc(content: dict) -> str:
         types_map = {
                 int   : "size_t",
@@ -70,6 +75,13 @@ def create_settings(input_file: str, verbose=False) -> str:
             number = len(content["Features_all"][features]) -  len(content["Features_disable"][features])
             string += "const inline size_t n_" + str(features) + " = " + str(number) + ";\n"
 
+        # number of features in each input grid group (SetupNN.input_grids),
+        # every group is stored by the DataLoader as one contiguous (tau, eta, phi, feature) buffer
+        string += "const inline std::vector<size_t> n_input_grid_features = {" + \
+                  ",".join([str(sum([n_features(content, celltype) for celltype in group]))
+                            for group in content["SetupNN"]["input_grids"]]) + \
+                  "};\n"
+
 
         string += "const inline std::vector<std::string> CellObjectTypes {\"" + \
                   "\",\"".join(content["CellObjectType"]) + \
@@ -102,12 +114,26 @@ def create_settings(input_file: str, verbose=False) -> str:
         string += ",\n".join(content["CellObjectType"])
         string += "};\n\n"
 
+        # position of each cell object type inside the input grid groups: (group index, feature offset)
+        grid_position = {}
+        for group_idx, group in enumerate(content["SetupNN"]["input_grids"]):
+            offset = 0
+            for celltype in group:
+                if celltype in grid_position:
+                    raise Exception("Cell object type {0} is listed more than once in \"input_grids\" section of config file".format(celltype))
+                grid_position[celltype] = (group_idx, offset)
+                offset += n_features(content, celltype)
+
         string +="template<typename T> struct FeaturesHelper;\n"
         for celltype in content["CellObjectType"]:
-            number = len(content["Features_all"][celltype]) - len(content["Features_disable"][celltype])
+            if celltype not in grid_position:
+                raise Exception("Cell object type {0} is not listed in \"input_grids\" section of config file".format(celltype))
+            number = n_features(content, celltype)
             string += "template<> struct FeaturesHelper<{0}_Features> ".format(celltype) + "{\n"
             string += "static constexpr CellObjectType object_type = CellObjectType::{0};\n".format(celltype)
             string += "static constexpr size_t size = {0};\n".format(number)
+            string += "static constexpr size_t grid_group = {0};\n".format(grid_position[celltype][0])
+            string += "static constexpr size_t grid_offset = {0};\n".format(grid_position[celltype][1])
             string += "using scaler_type = Scaling::{0};\n".format(celltype) + "};\n\n"
 
         string += "using FeatureTuple = std::tuple<" \
@@ -195,3 +221,18 @@ def create_scaling_input(input_scaling_file: str, input_cfg_file: str, verbose=F
     if verbose:
         print(settings)
     return settings
+
+def get_input_shapes(config: dict) -> list:
+    '''
+    Per tau shapes of the model inputs derived from the parsed
+    training config in the order of DataLoader.get_config:
+    flat tau features, inner grids, outer grids
+    (one grid per group in SetupNN.input_grids).
+    '''
+    def n_features(group):
+        return len(config["Features_all"][group]) - len(config["Features_disable"][group])
+    n_group_features = [ sum([ n_features(fname) for fname in group ]) for group in config["SetupNN"]["input_grids"] ]
+    n_inner_cells, n_outer_cells = config["Setup"]["n_inner_cells"], config["Setup"]["n_outer_cells"]
+    return [ (n_features("TauFlat"),) ] + \
+           [ (n_inner_cells, n_inner_cells, n) for n in n_group_features ] + \
+           [ (n_outer_cells, n_outer_cells, n) for n in n_group_features ]
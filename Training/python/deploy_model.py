@@ -1,20 +1,117 @@
 import os
 import argparse
 
+# graph optimizations that can be selected with --transforms
+transform_sets = {
+    'fold_constants': [ "fold_constants(ignore_errors=true)" ],
+    'fold_batch_norms': [ "fold_batch_norms" ],
+    'quantize_weights': [ "quantize_weights" ],
+    'float16': [], # applied after TransformGraph, see convert_weights_to_float16
+    'prune_inputs': [], # inputs that do not contribute to the outputs are removed, see prune_inputs
+}
+
 parser = argparse.ArgumentParser(description='Deploy keras model.')
 parser.add_argument('--input', required=True, type=str, help="Input Keras model")
 parser.add_argument('--output', required=False, type=str, default=None, help="Output Protocol Buffers file")
 parser.add_argument('--check-nans', action='store_true')
+parser.add_argument('--transforms', required=False, type=str, nargs='*', default=['fold_constants', 'fold_batch_norms'],
+                    choices=list(transform_sets.keys()), help="Graph optimizations to apply")
+parser.add_argument('--tolerance', required=False, type=float, default=1e-3,
+                    help="Maximal absolute difference between the predictions of the optimized and the float graph")
+parser.add_argument('--training-cfg', required=False, type=str, default=None,
+                    help="Training config: predictions are compared on the validation sample (random inputs otherwise)")
+parser.add_argument('--scaling-cfg', required=False, type=str, default=None,
+                    help="Feature scaling config, required together with --training-cfg")
+parser.add_argument('--n-check-batches', required=False, type=int, default=10,
+                    help="Number of batches used to compare the predictions")
 args = parser.parse_args()
+if (args.training_cfg is None) != (args.scaling_cfg is None):
+    parser.error("--training-cfg and --scaling-cfg should be given together")
 
-import tensorflow as tf
 import numpy as np
+
+def load_check_batches():
+    '''
+    Batches of the validation sample. They are loaded before TensorFlow is initialised,
+    since the DataLoader workers are forked processes.
+    '''
+    from DataLoader import DataLoader
+    loader = DataLoader(args.training_cfg, args.scaling_cfg)
+    generator = loader.get_generator(primary_set = False, return_truth = False)()
+    batches = []
+    for X in generator:
+        batches.append([ np.array(x) for x in X ])
+        if len(batches) >= args.n_check_batches:
+            generator.close()
+            break
+    return batches
+
+check_batches = load_check_batches() if args.training_cfg is not None else None
+
+import tensorflow as tf
+from tensorflow.python.framework import tensor_util
 from tensorflow.python.framework.graph_io import write_graph
-from tensorflow.python.framework.graph_util import convert_variables_to_constants
+from tensorflow.python.framework.graph_util import convert_variables_to_constants, extract_sub_graph
 from tensorflow.tools.graph_transforms import TransformGraph
 from keras import backend as K
 from common import LoadModel
 
+def prune_inputs(graph_def, input_nodes, output_nodes):
+    sub_graph = extract_sub_graph(graph_def, output_nodes)
+    used_nodes = set(node.name for node in sub_graph.node)
+    unused_inputs = [ name for name in input_nodes if name not in used_nodes ]
+    if len(unused_inputs):
+        print("Unused inputs removed:", unused_inputs)
+    return [ name for name in input_nodes if name in used_nodes ]
+
+def convert_weights_to_float16(graph_def):
+    '''
+    Stores float32 constants (except scalars) as float16, each followed by a cast back to float32.
+    '''
+    float16, float32 = tf.float16.as_datatype_enum, tf.float32.as_datatype_enum
+    output_graph = tf.GraphDef()
+    output_graph.versions.CopyFrom(graph_def.versions)
+    output_graph.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op == 'Const' and node.attr['dtype'].type == float32:
+            value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+            if value.size > 1:
+                const_node = output_graph.node.add()
+                const_node.op = 'Const'
+                const_node.name = node.name + '_float16'
+                const_node.device = node.device
+                const_node.attr['dtype'].type = float16
+                const_node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value.astype(np.float16)))
+                cast_node = output_graph.node.add()
+                cast_node.op = 'Cast'
+                cast_node.name = node.name
+                cast_node.device = node.device
+                cast_node.input.append(const_node.name)
+                cast_node.attr['SrcT'].type = float16
+                cast_node.attr['DstT'].type = float32
+                continue
+        output_graph.node.add().CopyFrom(node)
+    return output_graph
+
+def get_check_inputs(model, input_nodes):
+    '''
+    Batches of the validation sample, or random inputs with the shapes of the model inputs.
+    '''
+    if check_batches is not None:
+        return check_batches
+    print("Predictions are compared on random inputs, use --training-cfg for the validation sample.")
+    rng = np.random.default_rng(12345)
+    return [ [ rng.standard_normal((100,) + tuple(x.shape[1:])).astype(np.float32) for x in model.inputs ]
+             for _ in range(args.n_check_batches) ]
+
+def predict(graph_def, input_nodes, output_nodes, batches):
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name="")
+    x_graphs = [ graph.get_tensor_by_name(name + ':0') for name in input_nodes ]
+    y_graphs = [ graph.get_tensor_by_name(name + ':0') for name in output_nodes ]
+    with tf.Session(graph=graph) as sess:
+        return [ sess.run(y_graphs, feed_dict=dict(zip(x_graphs, X))) for X in batches ]
+
 config = tf.ConfigProto(intra_op_parallelism_threads=2,
                         inter_op_parallelism_threads=2,
                         allow_soft_placement=True,
@@ -28,18 +125,14 @@ model = LoadModel(args.input, False)
 print("Model loaded")
 def node_names(nodes):
     return [ node.name.split(':')[0] for node in nodes ]
-#print(model.inputs[0].name)
-#print(model.outputs[0].name)
-#raise RuntimeError("stop")
 
-input_nodes = node_names(model.inputs)
+# input and output nodes are taken from the Keras model
+all_input_nodes = node_names(model.inputs)
+input_nodes = all_input_nodes
 output_nodes = node_names(model.outputs)
 
 print("Inputs:", input_nodes)
 print("Outputs:", output_nodes)
-#input_nodes = ["main_input"]#  [model.inputs[0].name]
-#output_nodes = ["main_output/Softmax"]#["output_node"]
-#node_wrapper = tf.identity(model.outputs[0], name=output_nodes[0])
 
 with K.get_session() as sess:
 
@@ -50,17 +143,32 @@ with K.get_session() as sess:
                 if np.any(np.isnan(w)):
                     raise RuntimeError('Some weights in layer "{}/{}" are NaN.'.format(layer.name, weight.name))
 
-    #final_graph = sess.graph.as_graph_def()
     const_graph = convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_nodes)
-    #final_graph = const_graph
+    if 'prune_inputs' in args.transforms:
+        input_nodes = prune_inputs(const_graph, input_nodes, output_nodes)
     transforms = [
         "strip_unused_nodes",
         "remove_nodes(op=Identity, op=CheckNumerics)",
-        "fold_constants(ignore_errors=true)",
-        "fold_batch_norms",
-        #"quantize_weights"
     ]
+    for name in args.transforms:
+        transforms += transform_sets[name]
+    print("Transforms:", transforms)
     final_graph = TransformGraph(const_graph, input_nodes, output_nodes, transforms)
+    if 'float16' in args.transforms:
+        final_graph = convert_weights_to_float16(final_graph)
+
+# the optimized graph is written only if its predictions agree with the float graph
+check_batches = get_check_inputs(model, all_input_nodes)
+ref_pred = predict(const_graph, all_input_nodes, output_nodes, check_batches)
+used_inputs = [ all_input_nodes.index(name) for name in input_nodes ]
+final_pred = predict(final_graph, input_nodes, output_nodes,
+                     [ [ X[n] for n in used_inputs ] for X in check_batches ])
+max_diff = max([ np.max(np.abs(y_final - y_ref)) for pred_final, pred_ref in zip(final_pred, ref_pred)
+                 for y_final, y_ref in zip(pred_final, pred_ref) ])
+print("Maximal difference of the predictions: {:.3g} (tolerance {:.3g})".format(max_diff, args.tolerance))
+if not max_diff <= args.tolerance:
+    raise RuntimeError("Predictions of the optimized graph differ from the float graph by {:.3g}, which is more"
+                       " than the tolerance {:.3g}.".format(max_diff, args.tolerance))
 
 if args.output is None:
     input_base = os.path.basename(args.input)
@@ -69,3 +177,4 @@ if args.output is None:
 else:
     out_dir, out_file = os.path.split(args.output)
 write_graph(final_graph, out_dir, out_file, as_text=False)
+print("Graph size: {:.1f} kB -> {:.1f} kB".format(const_graph.ByteSize() / 1024., final_graph.ByteSize() / 1024.))
@@ -5,14 +5,12 @@ import math
 import copy
 from sklearn import metrics
 from scipy import interpolate
+from scipy import stats
 from _ctypes import PyObj_FromPtr
 import json
 import re
 import sys
 
-if sys.version_info.major > 2:
-    from statsmodels.stats.proportion import proportion_confint
-
 class DiscriminatorWP:
     VVVLoose = 0
     VVLoose = 1
@@ -91,6 +89,12 @@ class RocCurve:
                 ax_ratio.plot(x, y, color=self.color, linewidth=1, linestyle=linestyle)
         return entry
 
+    def SetRatio(self, ref_roc = None):
+        if ref_roc is not None:
+            self.ratio = create_roc_ratio(self.pr[1], self.pr[0], ref_roc.pr[1], ref_roc.pr[0])
+        elif self.pr[1].shape[0] > 0:
+            self.ratio = np.array([ [1, 1], [ self.pr[1][0], self.pr[1][-1] ] ])
+
     def Prune(self, tpr_decimals=3):
         pruned = copy.deepcopy(self)
         rounded_tpr = np.round(self.pr[1, :], decimals=tpr_decimals)
@@ -148,6 +152,63 @@ class PlotSetup:
 
             ax_ratio.grid(True, which='both')
 
+def get_bin_ids(values, bins):
+    """Index of the (bins[i], bins[i+1]) open interval containing each value, -1 if there is none."""
+    bins = np.asarray(bins)
+    bin_ids = np.searchsorted(bins, values, side='left') - 1
+    in_range = (bin_ids >= 0) & (bin_ids < len(bins) - 1)
+    on_edge = values == bins[np.clip(bin_ids + 1, 0, len(bins) - 1)]
+    return np.where(in_range & ~on_edge, bin_ids, -1)
+
+def _trapz(y, x):
+    return np.trapezoid(y, x) if hasattr(np, 'trapezoid') else np.trapz(y, x)
+
+def roc_curves(scores, labels, weights, bin_ids, n_bins):
+    """
+    Weighted ROC curves of the scores in each bin, with one sort for all the bins.
+    Returns a list with (fpr, tpr, thresholds, auc) per bin, None for empty bins.
+    Points and thresholds are the same as from sklearn.metrics.roc_curve (with drop_intermediate=True).
+    """
+    sel = bin_ids >= 0
+    scores, labels, weights, bin_ids = scores[sel], labels[sel], weights[sel], bin_ids[sel]
+    order = np.lexsort((-scores, bin_ids))
+    scores, bin_ids = scores[order], bin_ids[order]
+    is_pos = labels[order] == 1
+    weights = weights[order]
+    tp_cum = np.cumsum(np.where(is_pos, weights, 0.))
+    fp_cum = np.cumsum(np.where(is_pos, 0., weights))
+    bounds = np.searchsorted(bin_ids, np.arange(n_bins + 1))
+    curves = []
+    for bin_id in range(n_bins):
+        begin, end = bounds[bin_id], bounds[bin_id + 1]
+        if begin == end:
+            curves.append(None)
+            continue
+        # last entry of each group of equal scores
+        threshold_idx = begin + np.append(np.flatnonzero(np.diff(scores[begin:end])), end - begin - 1)
+        tps = tp_cum[threshold_idx] - (tp_cum[begin - 1] if begin > 0 else 0.)
+        fps = fp_cum[threshold_idx] - (fp_cum[begin - 1] if begin > 0 else 0.)
+        thresholds = scores[threshold_idx]
+        if len(fps) > 2:
+            optimal_idx = np.flatnonzero(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])
+            tps, fps, thresholds = tps[optimal_idx], fps[optimal_idx], thresholds[optimal_idx]
+        tps, fps = np.r_[0, tps], np.r_[0, fps]
+        thresholds = np.r_[thresholds[0] + 1, thresholds]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fpr, tpr = fps / fps[-1], tps / tps[-1]
+        curves.append((fpr, tpr, thresholds, _trapz(tpr, fpr)))
+    return curves
+
+def clopper_pearson(n_passed, n_total, alpha=1-0.68):
+    """Vectorized Clopper-Pearson interval, same as statsmodels proportion_confint(method='beta')."""
+    n_passed, n_total = np.asarray(n_passed, dtype=float), np.asarray(n_total, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ci_low = stats.beta.ppf(alpha / 2, n_passed, n_total - n_passed + 1)
+        ci_upp = stats.beta.isf(alpha / 2, n_passed + 1, n_total - n_passed)
+    ci_low = np.where(n_passed > 0, ci_low, 0.)
+    ci_upp = np.where(n_passed < n_total, ci_upp, 1.)
+    return ci_low, ci_upp
+
 def find_threshold(pr, thresholds, target_pr):
     min_delta_index = 0
     min_delta = abs(pr[0] - target_pr)
@@ -175,53 +236,73 @@ class Discriminator:
         if not draw_wp and self.raw:
             self.working_points = []
 
-    def CountPassed(self, df, wp):
+    def Passed(self, df, wp):
         if self.from_tuple:
             flag = 1 << wp
-            passed = (np.bitwise_and(df[self.wp_column], flag) != 0).astype(int)
-            return np.sum(passed * df.weight.values)
+            return np.bitwise_and(df[self.wp_column].values, flag) != 0
         if self.working_points_thrs is None:
             raise RuntimeError('Working points are not specified for discriminator "{}"'.format(self.name))
         wp_thr = self.working_points_thrs[DiscriminatorWP.GetName(wp)]
-        return np.sum(df[df[self.column] > wp_thr].weight.values)
+        return df[self.column].values > wp_thr
 
-    def CreateRocCurve(self, df, ref_roc = None):
+    def CountPassed(self, df, wp):
+        return np.sum(df.weight.values[self.Passed(df, wp)])
+
+    def CreateRocCurves(self, df, bin_ids, n_bins):
+        '''
+        ROC curves and working point curves for each of n_bins bins, where bin_ids is the bin index of each df row
+        (-1 to skip the row). Scores are sorted once and working point efficiencies are computed for all the bins together.
+        Returns lists of (roc, wp_roc) per bin, roc is None for empty bins. Ratios are not set.
+        '''
         n_wp = len(self.working_points)
-        wp_roc = None
+        gen_tau = df['gen_tau'].values
+        weights = df.weight.values
+        rocs, wp_rocs = [ None ] * n_bins, [ None ] * n_bins
         if self.raw:
-            fpr, tpr, thresholds = metrics.roc_curve(df['gen_tau'].values, df[self.column].values,
-                                                     sample_weight=df.weight.values)
-            roc = RocCurve(len(fpr), self.color, False, dashed=self.dashed)
-            roc.pr[0, :] = fpr
-            roc.pr[1, :] = tpr
-            roc.thresholds = thresholds
-            roc.auc_score = metrics.roc_auc_score(df['gen_tau'].values, df[self.column].values,
-                                                  sample_weight=df.weight.values)
+            for bin_id, curve in enumerate(roc_curves(df[self.column].values, gen_tau, weights, bin_ids, n_bins)):
+                if curve is None: continue
+                fpr, tpr, thresholds, auc_score = curve
+                roc = RocCurve(len(fpr), self.color, False, dashed=self.dashed)
+                roc.pr[0, :] = fpr
+                roc.pr[1, :] = tpr
+                roc.thresholds = thresholds
+                roc.auc_score = auc_score
+                rocs[bin_id] = roc
         if n_wp > 0:
-            wp_roc = RocCurve(n_wp, self.color, not self.raw, self.raw)
-            for n in range(n_wp):
-                for kind in [0, 1]:
-                    df_x = df[df['gen_tau'] == kind]
-                    n_passed = self.CountPassed(df_x, self.working_points[n])
-                    n_total = np.sum(df_x.weight.values)
-                    eff = float(n_passed) / n_total
-                    wp_roc.pr[kind, n_wp - n - 1] = eff
-                    if not self.raw:
-                        if sys.version_info.major > 2:
-                            ci_low, ci_upp = proportion_confint(n_passed, n_total, alpha=1-0.68, method='beta')
-                        else:
-                            err = math.sqrt(eff * (1 - eff) / n_total)
-                            ci_low, ci_upp = eff - err, eff + err
-                        wp_roc.pr_err[kind, 1, n_wp - n - 1] = ci_upp - eff
-                        wp_roc.pr_err[kind, 0, n_wp - n - 1] = eff - ci_low
+            # weighted counts per [kind, bin]: kind = gen_tau
+            sel = bin_ids >= 0
+            kind_bin_ids = (gen_tau[sel] == 1) * n_bins + bin_ids[sel]
+            n_total = np.bincount(kind_bin_ids, weights=weights[sel], minlength=2*n_bins).reshape(2, n_bins)
+            n_passed = np.stack([ np.bincount(kind_bin_ids, weights=weights[sel] * self.Passed(df, wp)[sel],
+                                              minlength=2*n_bins).reshape(2, n_bins)
+                                  for wp in reversed(self.working_points) ], axis=-1)
+            n_total = n_total[:, :, np.newaxis]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                eff = n_passed / n_total
+            if not self.raw:
+                if sys.version_info.major > 2:
+                    ci_low, ci_upp = clopper_pearson(n_passed, n_total)
+                else:
+                    err = np.sqrt(eff * (1 - eff) / n_total)
+                    ci_low, ci_upp = eff - err, eff + err
+            bin_counts = np.bincount(bin_ids[sel], minlength=n_bins)
+            for bin_id in range(n_bins):
+                if bin_counts[bin_id] == 0: continue
+                wp_roc = RocCurve(n_wp, self.color, not self.raw, self.raw)
+                wp_roc.pr[:, :] = eff[:, bin_id, :]
+                if not self.raw:
+                    wp_roc.pr_err[:, 1, :] = ci_upp[:, bin_id, :] - eff[:, bin_id, :]
+                    wp_roc.pr_err[:, 0, :] = eff[:, bin_id, :] - ci_low[:, bin_id, :]
+                wp_rocs[bin_id] = wp_roc
         if not self.raw:
-            roc = wp_roc
-            wp_roc = None
-        if ref_roc is not None:
-            roc.ratio = create_roc_ratio(roc.pr[1], roc.pr[0], ref_roc.pr[1], ref_roc.pr[0])
-        elif roc.pr[1].shape[0] > 0:
-            roc.ratio = np.array([ [1, 1], [ roc.pr[1][0], roc.pr[1][-1] ] ])
+            rocs = wp_rocs
+            wp_rocs = [ None ] * n_bins
+        return rocs, wp_rocs
 
+    def CreateRocCurve(self, df, ref_roc = None):
+        rocs, wp_rocs = self.CreateRocCurves(df, np.zeros(df.shape[0], dtype=int), 1)
+        roc, wp_roc = rocs[0], wp_rocs[0]
+        roc.SetRatio(ref_roc)
         return roc, wp_roc
 
 def ReadBrancesToDataFrame(file_name, tree_name, branches):
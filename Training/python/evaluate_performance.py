@@ -2,8 +2,10 @@
 
 import argparse
 parser = argparse.ArgumentParser(description='Apply training and store results.')
-parser.add_argument('--input-taus', required=True, type=str, help="Input file with taus")
-parser.add_argument('--input-other', required=False, default=None, type=str, help="Input file with non-taus")
+parser.add_argument('--input-taus', required=True, type=str,
+                    help="Input file with taus, or a directory or glob pattern with several files")
+parser.add_argument('--input-other', required=False, default=None, type=str,
+                    help="Input file with non-taus, or a directory or glob pattern with several files")
 parser.add_argument('--other-type', required=True, type=str, help="Type of non-tau objects")
 parser.add_argument('--deep-results', required=True, type=str, help="Directory with deepId results")
 parser.add_argument('--setup', required=True, type=str, help="Path to the file with the plot setup definition")
@@ -23,6 +25,7 @@ parser.add_argument('--store-json', action="store_true", help="Store ROC curves
 parser.add_argument('--inequality-in-title', action="store_true",
                     help="Use inequality in the title to define pt range, instead of an interval")
 parser.add_argument('--public-plots', action="store_true", help="Apply public plot styles")
+parser.add_argument('--n-workers', required=False, default=1, type=int, help="Number of processes to load input files")
 
 args = parser.parse_args()
 
@@ -32,6 +35,8 @@ import math
 import pandas
 import numpy as np
 import json
+import glob
+import multiprocessing as mp
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -81,6 +86,31 @@ def CreateDF(file_name, tau_types, setup_provider):
         df = df[sel]
     return df
 
+def ExpandInput(input_path):
+    if os.path.isdir(input_path):
+        return sorted(glob.glob(os.path.join(input_path, '*.root')) + glob.glob(os.path.join(input_path, '*.h5')))
+    if not glob.has_magic(input_path):
+        return [ input_path ]
+    file_names = sorted(glob.glob(input_path))
+    if len(file_names) == 0:
+        raise RuntimeError('No input files found for "{}".'.format(input_path))
+    return file_names
+
+def LoadFile(file_name, tau_types):
+    # only the columns needed to compute the ROC curves are kept, pt is replaced by the pt bin index
+    df = CreateDF(file_name, tau_types, setup_provider)
+    if hasattr(setup_provider, 'ApplySelection'):
+        df = setup_provider.ApplySelection(df, args.input_other)
+    compact_df = pandas.DataFrame({
+        'pt_bin_id': eval_tools.get_bin_ids(df.tau_pt.values, pt_bins).astype(np.int16),
+        'gen_tau': df.gen_tau.values.astype(np.int8),
+        'weight': df.weight.values,
+    })
+    for column in disc_columns:
+        if column in df.columns:
+            compact_df[column] = df[column].values
+    return compact_df
+
 if sys.version_info.major > 2:
     import importlib.util
     spec = importlib.util.spec_from_file_location('setup_provider', args.setup)
@@ -116,25 +146,40 @@ for disc in discriminators:
         if disc.wp_column != disc.column:
             all_branches.append(disc.wp_column)
 
-if args.input_other is None:
-    df_all = CreateDF(args.input_taus, ['tau', args.other_type], setup_provider)
-else:
-    df_taus = CreateDF(args.input_taus, ['tau'], setup_provider)
-    df_other = CreateDF(args.input_other, [args.other_type], setup_provider)
-    df_all = df_taus.append(df_other)
-if hasattr(setup_provider, 'ApplySelection'):
-    df_all = setup_provider.ApplySelection(df_all, args.input_other)
+disc_columns = []
+for disc in discriminators:
+    for column in [ disc.column, disc.wp_column ]:
+        if column not in disc_columns:
+            disc_columns.append(column)
 
 pt_bins = setup_provider.GetPtBins()
 
+if args.input_other is None:
+    load_tasks = [ (file_name, ['tau', args.other_type]) for file_name in ExpandInput(args.input_taus) ]
+else:
+    load_tasks = [ (file_name, ['tau']) for file_name in ExpandInput(args.input_taus) ] \
+               + [ (file_name, [args.other_type]) for file_name in ExpandInput(args.input_other) ]
+if args.n_workers > 1 and len(load_tasks) > 1:
+    with mp.Pool(min(args.n_workers, len(load_tasks))) as pool:
+        df_files = pool.starmap(LoadFile, load_tasks)
+else:
+    df_files = [ LoadFile(*task) for task in load_tasks ]
+df_all = pandas.concat(df_files, ignore_index=True)
+del df_files
+
 plot_setup = setup_provider.GetPlotSetup(args.other_type)
 
 roc_json = []
 
+# ROC curves of all pt bins are computed at once for each discriminator
+n_pt_bins = len(pt_bins) - 1
+pt_bin_ids = df_all.pt_bin_id.values.astype(int)
+pt_bin_counts = np.bincount(pt_bin_ids[pt_bin_ids >= 0], minlength=n_pt_bins)
+binned_rocs = [ disc.CreateRocCurves(df_all, pt_bin_ids, n_pt_bins) for disc in discriminators ]
+
 with PdfPages(args.output) as pdf:
-    for pt_index in range(len(pt_bins) - 1):
-        df_tx = df_all[(df_all.tau_pt > pt_bins[pt_index]) & (df_all.tau_pt < pt_bins[pt_index + 1])]
-        if df_tx.shape[0] == 0:
+    for pt_index in range(n_pt_bins):
+        if pt_bin_counts[pt_index] == 0:
             print("Warning: pt bin ({}, {}) is empty.".format(pt_bins[pt_index], pt_bins[pt_index + 1]))
             continue
         n_discr = len(discriminators)
@@ -163,7 +208,8 @@ with PdfPages(args.output) as pdf:
 
         for n in reversed(range(n_discr)):
             ref_roc = rocs[-1]
-            rocs[n], wp_rocs[n] = discriminators[n].CreateRocCurve(df_tx, ref_roc)
+            rocs[n], wp_rocs[n] = binned_rocs[n][0][pt_index], binned_rocs[n][1][pt_index]
+            rocs[n].SetRatio(ref_roc)
             if rocs[n].auc_score is not None:
                 #target_prs = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 0.995 ]
                 #thrs = [ find_threshold(rocs[n].pr[1, :], rocs[n].thresholds, pr) for pr in target_prs ]
@@ -2,24 +2,290 @@ import uproot
 import awkward as ak
 import numpy as np
 
+import os
 import time
 import gc
+import hashlib
 import argparse
 import yaml
 import json
 import collections
+import multiprocessing as mp
+from functools import partial
 from glob import glob
 from tqdm import tqdm
 from collections import defaultdict
 
-from scaling_utils import Phi_mpi_pi, dR, dR_signal_cone, compute_mean, compute_std, mask_inf, fill_aggregators, get_quantiles
+from scaling_utils import Phi_mpi_pi, dR, dR_signal_cone, mask_inf, fill_aggregators, get_quantiles
+from scaling_utils import get_cone_masks, merge_aliases, update_scaling_params
+from scaling_utils import QuantileSketch, init_quantile_sketches, sketch_quantiles
 from scaling_utils import nested_dict, init_dictionaries, dump_to_json
 
+def process_file(file_name, scaling_dict, var_types):
+    """
+    Map step of the scaling parameters computation: accumulate for a single input file moments (count, mean, m2) of the features
+    together with the file's quantiles. The output doesn't depend on other files, so files can be processed in any order and in parallel.
+
+    Arguments:
+        - file_name: string, path to the input ROOT file
+        - scaling_dict: dict, content of the yaml configuration file
+        - var_types: list of variable types from field 'Features_all' to be processed
+
+    Returns:
+        dict with the following fields:
+            - skipped: bool, whether the file couldn't be read and was skipped
+            - moments: dict, [count, mean, m2] per variable type/variable name/cone type ('global' for inclusive computation)
+            - quantiles: dict, quantile numbers per variable type/variable name/cone type as returned by `get_quantiles()` function
+            - sketches: dict, quantile sketches (see `QuantileSketch.to_dict()`) per variable type/variable name/cone type, to be merged into the dataset-wide ones
+            - inf_fractions: dict, fraction of inf values per variable name
+    """
+    setup_dict = scaling_dict['Scaling_setup']
+    features_dict = scaling_dict['Features_all']
+    tree_name = setup_dict['tree_name']
+    cone_definition_dict = setup_dict['cone_definition']
+    cone_selection_dict = setup_dict['cone_selection']
+    dR_tau_outer_cone = cone_definition_dict['outer']['dR']
+    tau_pt_name, tau_eta_name, tau_phi_name = cone_selection_dict['TauFlat']['var_names']['pt'], cone_selection_dict['TauFlat']['var_names']['eta'], cone_selection_dict['TauFlat']['var_names']['phi']
+    inner_cone_min_pt = cone_definition_dict['inner']['min_pt']
+    inner_cone_min_radius = cone_definition_dict['inner']['min_radius']
+    inner_cone_opening_coef = cone_definition_dict['inner']['opening_coef']
+    #
+    # moments of a single file: file_i = 0 in the arrays of length 1
+    file_i, file_name_id = 0, 0
+    moments, _, quantile_params = init_dictionaries(features_dict, cone_selection_dict, 1)
+    quantile_sketches = init_quantile_sketches(quantile_params)
+    inf_counter = defaultdict(list) # counter of features with inf values and their fraction
+    skipped = False
+
+    with uproot.open(file_name, array_cache='5 GB') as f:
+        if len(f.keys()) == 0: # some input ROOT files can be corrupted and uproot can't recover for it. These files are skipped in computations
+            print(f'[WARNING] couldn\'t find any object in {file_name}: skipping the file')
+            skipped = True
+        else:
+            tree = f[tree_name]
+            # NB: selection cut is not applied on tau branches
+            tau_pt_array, tau_eta_array, tau_phi_array = tree.arrays([tau_pt_name, tau_eta_name, tau_phi_name], cut=None, aliases=None, how=tuple)
+            dR_tau_signal_cone = dR_signal_cone(tau_pt_array, inner_cone_min_pt, inner_cone_min_radius, inner_cone_opening_coef)
+            # loop over variable type
+            for var_type in var_types:
+                # collect variables of the given type for which the input arrays are needed
+                read_vars = {}
+                for var_dict in features_dict[var_type]:
+                    (var, (selection_cut, aliases, scaling_type, *lim_params)), = var_dict.items()
+                    if scaling_type == 'linear':
+                        # dict with scaling params already fully filled after init_dictionaries() call, here compute only variable's quantiles
+                        if len(lim_params) == 2 and lim_params[0] <= lim_params[1]:
+                            cone_types = [None]
+                        elif len(lim_params) == 1 and type(lim_params[0]) == dict:
+                            cone_types = cone_selection_dict[var_type]['cone_types']
+                            for cone_type in cone_types:
+                                assert cone_type in lim_params[0].keys() # constrain only to those cone_types in cfg
+                        else:
+                            raise ValueError(f'Unrecognised lim_params for {var} in quantile computation')
+                    elif scaling_type == 'normal':
+                        cone_types = cone_selection_dict[var_type]['cone_types']
+                    else:
+                        continue
+                    read_vars[var] = (selection_cut, aliases, scaling_type, cone_types)
+                if len(read_vars) == 0: continue
+                # all variables of the given type, their selection cuts (as boolean expressions) and constituents' eta/phi are read in one call
+                constituent_eta_name, constituent_phi_name = cone_selection_dict[var_type]['var_names']['eta'], cone_selection_dict[var_type]['var_names']['phi']
+                selection_cuts = [selection_cut for selection_cut, *_ in read_vars.values() if selection_cut is not None]
+                expressions = list(dict.fromkeys(list(read_vars.keys()) + selection_cuts + [constituent_eta_name, constituent_phi_name]))
+                var_type_arrays = tree.arrays(expressions, cut=None, aliases=merge_aliases([aliases for _, aliases, *_ in read_vars.values()]), how=dict)
+                cone_masks = {} # per selection cut, shared by all variables with the same cut
+                # loop over variables of the given type
+                for var, (selection_cut, _, scaling_type, cone_types) in read_vars.items():
+                    var_array = var_type_arrays[var]
+                    if selection_cut is not None:
+                        # NB: selection cut is applied, broadcasting with tau array (w/o cut) should correctly handle the difference
+                        var_array = var_array[var_type_arrays[selection_cut]]
+                    var_array = mask_inf(var_array, var, inf_counter)
+                    if cone_types != [None] and selection_cut not in cone_masks:
+                        constituent_eta_array, constituent_phi_array = var_type_arrays[constituent_eta_name], var_type_arrays[constituent_phi_name]
+                        if selection_cut is not None:
+                            constituent_eta_array = constituent_eta_array[var_type_arrays[selection_cut]]
+                            constituent_phi_array = constituent_phi_array[var_type_arrays[selection_cut]]
+                        cone_masks[selection_cut] = get_cone_masks(tau_eta_array, tau_phi_array, constituent_eta_array, constituent_phi_array,
+                                                                   dR_tau_signal_cone, dR_tau_outer_cone, cone_selection_dict[var_type]['cone_types'])
+                    # loop over cone types specified for a given var_type in the cfg file
+                    for cone_type in cone_types:
+                        cone_mask = None if cone_type is None else cone_masks[selection_cut][cone_type]
+                        if scaling_type == 'linear':
+                            cone_name = 'global' if cone_type is None else cone_type
+                            quantile_params[var_type][var][cone_name][file_name_id] = \
+                                get_quantiles(var_array if cone_mask is None else var_array[cone_mask], quantile_sketches[var_type][var][cone_name])
+                        else:
+                            fill_aggregators(var_array, var, var_type, file_i, file_name_id, cone_type, cone_mask,
+                                             moments, fill_scaling_params=False, quantile_params=quantile_params, quantile_sketches=quantile_sketches)
+                    del(var_array)
+                del(var_type_arrays, cone_masks)
+            del(tau_pt_array, tau_eta_array, tau_phi_array, dR_tau_signal_cone)
+    gc.collect()
+
+    file_moments, quantiles, sketches = nested_dict(), nested_dict(), nested_dict()
+    for (var_type, var, cone_type), var_moments in moments.file_moments(file_i).items():
+        file_moments[var_type][var][cone_type] = list(var_moments)
+    for var_type in quantile_params.keys():
+        for var in quantile_params[var_type].keys():
+            for cone_type, cone_quantiles in quantile_params[var_type][var].items():
+                if file_name_id in cone_quantiles:
+                    quantiles[var_type][var][cone_type] = cone_quantiles[file_name_id]
+                    sketches[var_type][var][cone_type] = quantile_sketches[var_type][var][cone_type].to_dict()
+    return {'skipped': skipped, 'moments': file_moments, 'quantiles': quantiles, 'sketches': sketches,
+            'inf_fractions': {var: [float(frac) for frac in fracs] for var, fracs in inf_counter.items()}}
+
+def reduce_file(result, file_i, file_name_id, moments, quantile_params, quantile_sketches, inf_counter):
+    """
+    Reduce step of the scaling parameters computation: store per file moments and quantiles of `result` (as returned by `process_file()`)
+    for file `file_i` in `moments` (which also merges them into the total ones) and under `file_name_id` key in `quantile_params`.
+    Quantile sketches of the file are merged into the dataset-wide ones in `quantile_sketches`.
+
+    Returns:
+        bool, whether the file was skipped
+    """
+    for var_type, var_moments in result['moments'].items():
+        for var, cone_moments in var_moments.items():
+            for cone_type, file_moments in cone_moments.items():
+                moments.set_file(file_i, (var_type, var, cone_type), file_moments)
+    for var_type, var_quantiles in result['quantiles'].items():
+        for var, cone_quantiles in var_quantiles.items():
+            for cone_type, quantiles in cone_quantiles.items():
+                quantile_params[var_type][var][cone_type][file_name_id] = quantiles
+    for var_type, var_sketches in result['sketches'].items():
+        for var, cone_sketches in var_sketches.items():
+            for cone_type, sketch in cone_sketches.items():
+                quantile_sketches[var_type][var][cone_type].merge(QuantileSketch.from_dict(sketch))
+    for var, fracs in result['inf_fractions'].items():
+        inf_counter[var] += fracs
+    return result['skipped']
+
+def map_files(file_names, scaling_dict, var_types, n_workers):
+    """
+    Run `process_file()` over `file_names` with `n_workers` processes. Yields the results in the order of `file_names`.
+    """
+    map_file = partial(process_file, scaling_dict=scaling_dict, var_types=var_types)
+    if n_workers > 1 and len(file_names) > 1:
+        with mp.Pool(min(n_workers, len(file_names))) as pool:
+            # imap keeps the order of the files, so the reduction (and the log snapshots) doesn't depend on the number of workers
+            yield from pool.imap(map_file, file_names)
+            pool.close()
+            pool.join()
+    else:
+        yield from map(map_file, file_names)
+
+def get_config_hash(scaling_dict, var_types):
+    """
+    Hash of the part of the configuration which affects the per file results of `process_file()`: per file results stored in the state file are reused only if it is unchanged.
+    """
+    setup_dict = scaling_dict['Scaling_setup']
+    config = {'features': {var_type: scaling_dict['Features_all'][var_type] for var_type in var_types},
+              'tree_name': setup_dict['tree_name'], 'cone_definition': setup_dict['cone_definition'], 'cone_selection': setup_dict['cone_selection']}
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_file_key(file_name):
+    """
+    [size, modification time] identifying the version of a local input file, None if the file can't be accessed locally (e.g. remote file).
+    """
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def get_sketch_file(state_file):
+    return f'{state_file}.sketches.npz'
+
+def load_state(state_file, config_hash):
+    """
+    Load per file results stored in `state_file` (and the centroids of their quantile sketches in the npz file next to it) by the previous run.
+    Results are discarded if they were produced with another configuration.
+    """
+    state = {'config_hash': config_hash, 'files': {}}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            stored_state = json.load(f)
+        sketch_file = get_sketch_file(state_file)
+        if stored_state['config_hash'] != config_hash:
+            print(f'[WARNING] configuration has changed since {state_file} was written: all the files will be processed')
+        elif not os.path.exists(sketch_file):
+            print(f'[WARNING] {sketch_file} is missing: all the files will be processed')
+        else:
+            with np.load(sketch_file) as centroids:
+                means, weights = centroids['means'], centroids['weights']
+            if len(means) != stored_state['n_centroids']:
+                print(f'[WARNING] {sketch_file} doesn\'t match {state_file}: all the files will be processed')
+            else:
+                for file_state in stored_state['files'].values():
+                    for var_sketches in file_state['result']['sketches'].values():
+                        for cone_sketches in var_sketches.values():
+                            for sketch in cone_sketches.values():
+                                begin = sketch.pop('offset')
+                                end = begin + sketch.pop('size')
+                                sketch['means'], sketch['weights'] = means[begin:end], weights[begin:end]
+                state = stored_state
+    return state
+
+def save_state(state_file, state):
+    """
+    Store per file results into `state_file`. Centroids of the quantile sketches are concatenated into two arrays of the npz file next to it,
+    the json file keeps per file moments, quantiles and the position of each sketch in these arrays, so that it stays small.
+    """
+    json_state = {'config_hash': state['config_hash'], 'files': {}}
+    means, weights, n_centroids = [], [], 0
+    for file_name, file_state in state['files'].items():
+        result = dict(file_state['result'])
+        sketches = nested_dict()
+        for var_type, var_sketches in result['sketches'].items():
+            for var, cone_sketches in var_sketches.items():
+                for cone_type, sketch in cone_sketches.items():
+                    means.append(np.asarray(sketch['means'], dtype='float64'))
+                    weights.append(np.asarray(sketch['weights'], dtype='float64'))
+                    sketches[var_type][var][cone_type] = {'compression': sketch['compression'], 'min': sketch['min'], 'max': sketch['max'],
+                                                          'offset': n_centroids, 'size': len(means[-1])}
+                    n_centroids += len(means[-1])
+        result['sketches'] = sketches
+        json_state['files'][file_name] = {'key': file_state['key'], 'result': result}
+    json_state['n_centroids'] = n_centroids
+    sketch_file = get_sketch_file(state_file)
+    with open(f'{sketch_file}.tmp', 'wb') as fout:
+        np.savez(fout, means=np.concatenate(means) if len(means) else np.zeros(0),
+                 weights=np.concatenate(weights) if len(weights) else np.zeros(0))
+    os.replace(f'{sketch_file}.tmp', sketch_file)
+    with open(f'{state_file}.tmp', 'w') as fout:
+        json.dump(json_state, fout)
+    os.replace(f'{state_file}.tmp', state_file)
+
+def incremental_results(file_names, state, scaling_dict, var_types, n_workers):
+    """
+    Iterate over per file results in the order of `file_names`, taking them from `state` for unchanged files and running `process_file()` only for new or changed ones.
+    `state` is updated with the new results.
+    """
+    file_keys = {file_name: get_file_key(os.path.abspath(file_name)) for file_name in file_names}
+    stored = state['files']
+    to_process = [file_name for file_name in file_names
+                  if file_keys[file_name] is None or stored.get(os.path.abspath(file_name), {}).get('key') != file_keys[file_name]]
+    print(f'[INFO] {len(file_names) - len(to_process)} files are unchanged since the previous run, {len(to_process)} files will be processed')
+    new_results = map_files(to_process, scaling_dict, var_types, n_workers)
+    to_process = set(to_process)
+    for file_name in file_names:
+        if file_name in to_process:
+            result = next(new_results)
+            stored[os.path.abspath(file_name)] = {'key': file_keys[file_name], 'result': result}
+            yield result
+        else:
+            yield stored[os.path.abspath(file_name)]['result']
+
 if __name__ == '__main__':
     # parse command line parameters
     parser = argparse.ArgumentParser()
     parser.add_argument("--cfg", type=str, help="Path to yaml configuration file")
     parser.add_argument('--var_types', nargs='+', help="Variable types from field 'Features_all' of the cfg file for which to derive scaling parameters. Defaults to -1 for running on all those specified in the cfg", default=-1)
+    parser.add_argument('--n-workers', type=int, default=1, help="Number of processes to run over input files in parallel")
+    parser.add_argument('--file-range', type=int, nargs=2, default=None, help="Overrides `file_range` of the cfg file")
+    parser.add_argument('--partial-output', type=str, default=None, help="Instead of scaling parameters, write per file moments and quantiles into this json file (to be merged with --reduce)")
+    parser.add_argument('--reduce', type=str, nargs='+', default=None, help="Json files produced with --partial-output to be merged into scaling parameters, input files are not read")
+    parser.add_argument('--state-file', type=str, default=None, help="Json file storing per file results between runs: only new or changed input files (by size and modification time) are processed")
     args = parser.parse_args()
     with open(args.cfg) as f:
         scaling_dict = yaml.load(f, Loader=yaml.FullLoader)
@@ -28,114 +294,76 @@ if __name__ == '__main__':
     setup_dict = scaling_dict['Scaling_setup']
     features_dict = scaling_dict['Features_all']
     #
-    assert type(args.var_types) == list
-    if args.var_types[0] == "-1" and len(args.var_types) == 1:
-        var_types = features_dict.keys()
+    if args.var_types == -1 or (args.var_types[0] == "-1" and len(args.var_types) == 1):
+        var_types = list(features_dict.keys())
     else:
         var_types = args.var_types
     file_path = setup_dict['file_path']
     output_json_folder = setup_dict['output_json_folder']
-    file_range = setup_dict['file_range']
-    tree_name = setup_dict['tree_name']
+    file_range = setup_dict['file_range'] if args.file_range is None else args.file_range
     log_step = setup_dict['log_step']
     version = setup_dict['version']
     scaling_params_json_prefix = f'{output_json_folder}/scaling_params_v{version}'
     quantile_params_json_prefix = f'{output_json_folder}/quantile_params_v{version}'
     #
-    selection_dict = setup_dict['selection']
-    cone_definition_dict = setup_dict['cone_definition']
     cone_selection_dict = setup_dict['cone_selection']
     #
     assert log_step > 0 and type(log_step) == int
-    if file_range==-1:
+    if args.reduce is not None:
+        partial_outputs = {}
+        for partial_name in args.reduce:
+            with open(partial_name) as f:
+                partial_outputs.update(json.load(f))
+        file_names = sorted(partial_outputs.keys())
+    elif file_range==-1:
         file_names = sorted(glob(file_path))
-        n_files = len(file_names)
     elif type(file_range)==list and len(file_range)==2 and file_range[0]<=file_range[1]:
         file_names = sorted(glob(file_path))[file_range[0]:file_range[1]]
-        n_files = file_range[1]-file_range[0]
     else:
         raise ValueError('Specified file_range is not valid: should be either -1 (run on all files in file_path) or range [a, b] with a<=b')
+    n_files = len(file_names)
     file_names_id = [fname.split('_')[-1].split('.root')[0] for fname in file_names] # id as taken from the name: used as file identifier (key field) in the output json files with quantiles
     #
-    dR_tau_outer_cone = cone_definition_dict['outer']['dR']
-    tau_pt_name, tau_eta_name, tau_phi_name = cone_selection_dict['TauFlat']['var_names']['pt'], cone_selection_dict['TauFlat']['var_names']['eta'], cone_selection_dict['TauFlat']['var_names']['phi']
-    inner_cone_min_pt = cone_definition_dict['inner']['min_pt']
-    inner_cone_min_radius = cone_definition_dict['inner']['min_radius']
-    inner_cone_opening_coef = cone_definition_dict['inner']['opening_coef']
-    #
+    # map step: per file moments are either read from partial outputs or computed (in parallel if requested)
+    if args.reduce is not None:
+        print(f'\n[INFO] will merge partial outputs of {n_files} input files from {len(args.reduce)} json files')
+        results = (partial_outputs[file_name] for file_name in file_names)
+    else:
+        print(f'\n[INFO] will process {n_files} input files from {file_path} with {args.n_workers} worker(s)')
+        if args.state_file is not None:
+            state = load_state(args.state_file, get_config_hash(scaling_dict, var_types))
+            results = incremental_results(file_names, state, scaling_dict, var_types, args.n_workers)
+        else:
+            results = map_files(file_names, scaling_dict, var_types, args.n_workers)
+
+    if args.partial_output is not None:
+        print(f'[INFO] will dump per file moments and quantiles into {args.partial_output}')
+        partial_outputs = {file_name: result for file_name, result in zip(file_names, tqdm(results, total=n_files))}
+        with open(args.partial_output, 'w') as fout:
+            # sketches of the results taken from the state file hold numpy arrays
+            json.dump(partial_outputs, fout, default=lambda array: array.tolist())
+        if args.state_file is not None:
+            save_state(args.state_file, state)
+        print('\nDone!')
+        exit(0)
+
     # initialise dictionaries to be filled
-    sums, sums2, counts, scaling_params, quantile_params = init_dictionaries(features_dict, cone_selection_dict, n_files)
+    moments, scaling_params, quantile_params = init_dictionaries(features_dict, cone_selection_dict, n_files)
+    quantile_sketches = init_quantile_sketches(quantile_params)
     #
-    print(f'\n[INFO] will process {n_files} input files from {file_path}')
     print(f'[INFO] will dump scaling parameters to {scaling_params_json_prefix}_*.json after every {log_step} files')
-    print(f'[INFO] will dump quantile parameters for every file into {quantile_params_json_prefix}.json')
-    print('[INFO] starting to accumulate sums & counts:\n')
+    print(f'[INFO] will dump quantile parameters for every file and for all the files (under "all" key) into {quantile_params_json_prefix}.json')
+    print('[INFO] starting to accumulate moments:\n')
     #
     skip_counter = 0 # counter of files which were skipped during processing
     inf_counter = defaultdict(list) # counter of features with inf values and their fraction
-    processed_last_file = time.time()
-
-    # loop over input files
-    for file_i, (file_name_id, file_name) in enumerate(zip(tqdm(file_names_id), file_names)): # file_i used internally to count number of processed files
-        log_scaling_params = not (file_i%log_step) or (file_i == n_files-1)
-        with uproot.open(file_name, array_cache='5 GB') as f:
-            if len(f.keys()) == 0: # some input ROOT files can be corrupted and uproot can't recover for it. These files are skipped in computations
-                print(f'[WARNING] couldn\'t find any object in {file_name}: skipping the file')
-                skip_counter += 1
-            else:
-                tree = f[tree_name]
-                # NB: selection cut is not applied on tau branches
-                tau_pt_array, tau_eta_array, tau_phi_array = tree.arrays([tau_pt_name, tau_eta_name, tau_phi_name], cut=None, aliases=None, how=tuple)
-                # loop over variable type
-                for var_type in var_types:
-                    # loop over variables of the given type
-                    for var_dict in features_dict[var_type]:
-                        begin_var = time.time()
-                        (var, (selection_cut, aliases, scaling_type, *lim_params)), = var_dict.items()
-                        if scaling_type == 'linear':
-                            # dict with scaling params already fully filled after init_dictionaries() call, here compute only variable's quantiles
-                            if len(lim_params) == 2 and lim_params[0] <= lim_params[1]:
-                                var_array = tree.arrays(var, cut=selection_cut, aliases=aliases)[var]
-                                var_array = mask_inf(var_array, var, inf_counter)
-                                quantile_params[var_type][var]['global'][file_name_id] = get_quantiles(var_array)
-                                del(var_array)
-                            elif len(lim_params) == 1 and type(lim_params[0]) == dict:
-                                constituent_eta_name, constituent_phi_name = cone_selection_dict[var_type]['var_names']['eta'], cone_selection_dict[var_type]['var_names']['phi']
-                                var_array, constituent_eta_array, constituent_phi_array = tree.arrays([var, constituent_eta_name, constituent_phi_name], cut=selection_cut, aliases=aliases, how=tuple)
-                                var_array = mask_inf(var_array, var, inf_counter)
-                                dR_tau_signal_cone = dR_signal_cone(tau_pt_array, inner_cone_min_pt, inner_cone_min_radius, inner_cone_opening_coef)
-                                for cone_type in cone_selection_dict[var_type]['cone_types']:
-                                    assert cone_type in lim_params[0].keys() # constrain only to those cone_types in cfg
-                                    constituent_dR = dR(tau_eta_array - constituent_eta_array, tau_phi_array - constituent_phi_array)
-                                    if cone_type == 'inner':
-                                        cone_mask = constituent_dR <= dR_tau_signal_cone
-                                    elif cone_type == 'outer':
-                                        cone_mask = (constituent_dR > dR_tau_signal_cone) & (constituent_dR < dR_tau_outer_cone)
-                                    else:
-                                        raise ValueError(f'For {var} cone_type should be either inner or outer, got {cone_type}.')
-                                    quantile_params[var_type][var][cone_type][file_name_id] = get_quantiles(var_array[cone_mask])
-                                del(constituent_eta_array, constituent_phi_array, var_array)
-                            else:
-                                raise ValueError(f'Unrecognised lim_params for {var} in quantile computation')
-                        elif scaling_type == 'normal':
-                            constituent_eta_name, constituent_phi_name = cone_selection_dict[var_type]['var_names']['eta'], cone_selection_dict[var_type]['var_names']['phi']
-                            # NB: selection cut is applied, broadcasting with tau array (w/o cut) should correctly handle the difference
-                            var_array, constituent_eta_array, constituent_phi_array = tree.arrays([var, constituent_eta_name, constituent_phi_name], cut=selection_cut, aliases=aliases, how=tuple)
-                            var_array = mask_inf(var_array, var, inf_counter)
-                            dR_tau_signal_cone = dR_signal_cone(tau_pt_array, inner_cone_min_pt, inner_cone_min_radius, inner_cone_opening_coef)
-                            # loop over cone types specified for a given var_type in the cfg file
-                            for cone_type in cone_selection_dict[var_type]['cone_types']:
-                                fill_aggregators(var_array, tau_eta_array, tau_phi_array, constituent_eta_array, constituent_phi_array,
-                                                 var, var_type, file_i, file_name_id, cone_type, dR_tau_signal_cone, dR_tau_outer_cone,
-                                                 sums, sums2, counts, fill_scaling_params=log_scaling_params, scaling_params=scaling_params, quantile_params=quantile_params
-                                                 )
-                            del(constituent_eta_array, constituent_phi_array, var_array)
-                        end_var = time.time()
-                        # print(f'---> processed {var} in {end_var - begin_var:.2f} s\n')
-                del(tau_pt_array, tau_eta_array, tau_phi_array)
-        gc.collect()
+
+    # reduce step: loop over per file results in the order of input files
+    for file_i, (file_name_id, result) in enumerate(zip(file_names_id, tqdm(results, total=n_files))): # file_i used internally to count number of processed files
+        skip_counter += reduce_file(result, file_i, file_name_id, moments, quantile_params, quantile_sketches, inf_counter)
         # snapshot scaling params into json if log_step is reached
-        if log_scaling_params:
+        if not (file_i%log_step) or (file_i == n_files-1):
+            update_scaling_params(moments, scaling_params)
             if file_i == n_files-1:
                 scaling_params_json_name = scaling_params_json_prefix
             else:
@@ -144,10 +372,16 @@ if __name__ == '__main__':
                 else:
                     scaling_params_json_name = f'{scaling_params_json_prefix}_log_{(file_i+1)//log_step}'
             dump_to_json({scaling_params_json_name: scaling_params})
-        processed_current_file = time.time()
-        # print(f'---> processed {file_name} in {processed_current_file - processed_last_file:.2f} s')
-        processed_last_file = processed_current_file
+    # dataset-wide quantiles from the merged sketches of all the files
+    for var_type in quantile_sketches.keys():
+        for var in quantile_sketches[var_type].keys():
+            for cone_type, sketch in quantile_sketches[var_type][var].items():
+                if sketch.count > 0:
+                    quantile_params[var_type][var][cone_type]['all'] = sketch_quantiles(sketch)
     dump_to_json({f'{quantile_params_json_prefix}': quantile_params})
+    if args.state_file is not None and args.reduce is None:
+        save_state(args.state_file, state)
+        print(f'[INFO] per file results are stored in {args.state_file} for the next run')
     print()
     if skip_counter > 0:
         print(f'[WARNING] during the processing {skip_counter} files with no objects were skipped\n')
@@ -69,7 +69,7 @@ def plot_ranges(file_id, var_name, cone_type, mean, median, min_value, max_value
 @click.option("--train-cfg", type=str, default='../configs/training_v1.yaml', help="Path to yaml configuration file used for training", show_default=True)
 @click.option("--scaling-file", type=str, default='../configs/scaling_params_v1.json', help="Path to json file with scaling parameters", show_default=True)
 @click.option("--quantile-file", type=str, default='../configs/quantile_params_v1_fid_0.json', help="Path to json file with quantile parameters", show_default=True)
-@click.option("--file-id", type=int, default=0, help="File ID to be picked from quantile parameters file", show_default=True)
+@click.option("--file-id", type=str, default="0", help="File ID to be picked from quantile parameters file (\"all\" for quantiles over all the files)", show_default=True)
 @click.option("--output-folder", type=str, default='quantile_plots', help="Folder to store range plots", show_default=True)
 @click.option('--only-suspicious', type=bool, default=True, show_default=True )
 def main(
@@ -52,6 +52,61 @@ def dR_signal_cone(pt_tau, min_pt, min_radius, opening_coef):
     """
     return np.maximum(opening_coef/np.maximum(pt_tau, min_pt), min_radius)
 
+def get_cone_masks(tau_eta_array, tau_phi_array, constituent_eta_array, constituent_phi_array,
+                   dR_tau_signal_cone, dR_tau_outer_cone, cone_types):
+    """
+    Derive `constituent_dR` of the constituents with respect to the tau direction of flight once and define masks of the cones as:
+        - inner: `constituent_dR` <= `dR_tau_signal_cone`
+        - outer: `constituent_dR` > `dR_tau_signal_cone` and `constituent_dR` < `dR_tau_outer_cone`
+    The masks are meant to be reused by all the features sharing the same constituents (i.e. the same selection cut).
+
+    Arguments:
+        - tau_eta_array: awkward array, eta values of taus
+        - tau_phi_array: awkward array, phi values of taus
+        - constituent_eta_array: awkward array, eta values of tau constituents
+        - constituent_phi_array: awkward array, phi values of tau constituents
+        - dR_tau_signal_cone: awkward array, per tau dR values defining the signal cone
+        - dR_tau_outer_cone: float, dR value defining the tau outer cone
+        - cone_types: list of cone types, each should be either inner, outer or None (inclusive, no mask)
+
+    Returns:
+        dict, mapping of cone type to the mask of constituents entering the cone (None for inclusive cone type)
+    """
+    cone_masks = {}
+    constituent_dR = None
+    for cone_type in cone_types:
+        if cone_type is None:
+            cone_masks[cone_type] = None
+            continue
+        if constituent_dR is None:
+            constituent_dR = dR(tau_eta_array - constituent_eta_array, tau_phi_array - constituent_phi_array)
+        if cone_type == 'inner':
+            cone_masks[cone_type] = constituent_dR <= dR_tau_signal_cone
+        elif cone_type == 'outer':
+            cone_masks[cone_type] = (constituent_dR > dR_tau_signal_cone) & (constituent_dR < dR_tau_outer_cone)
+        else:
+            raise ValueError(f'cone_type should be either inner, outer or None, got {cone_type}.')
+    return cone_masks
+
+def merge_aliases(aliases_list):
+    """
+    Merge aliases of several features into one dictionary to be passed to a single `tree.arrays()` call.
+
+    Arguments:
+        - aliases_list: list of dicts (or None), aliases of the features
+
+    Returns:
+        dict with all the aliases (None if there are no aliases)
+    """
+    merged_aliases = {}
+    for aliases in aliases_list:
+        if aliases is None: continue
+        for alias, expression in aliases.items():
+            if alias in merged_aliases and merged_aliases[alias] != expression:
+                raise ValueError(f'Alias {alias} is defined with different expressions: {merged_aliases[alias]} and {expression}')
+            merged_aliases[alias] = expression
+    return merged_aliases if merged_aliases else None
+
 def nested_dict():
     """
     Construct a recursively instantiated dictionary for convenient arbitrary initialisation.
@@ -72,8 +127,8 @@ def init_dictionaries(features_dict, cone_selection_dict, n_files):
         - linear: initialise only scaling params with an option of inclusive or separate (inner vs outer cone) initialisation
             NB: this assumes the clamping range downstream to be [-1, 1]
             -> mean=(lim_params[0]+lim_params[1])/2., std=(lim_params[1]-lim_params[0])/2., lim_min=-1., lim_max=1.
-        - normal: initialise sums, sums2, counts, scaling params with an option of inclusive or separate (inner vs outer cone) initialisation
-            -> sums, sums2 and counts are initialised with 0
+        - normal: initialise moments, scaling params with an option of inclusive or separate (inner vs outer cone) initialisation
+            -> moments (count, mean, m2) are initialised with 0
             -> if lim_params specified:
                     mean=None, std=None, lim_min=lim_params[0], lim_max=lim_params[1]
                else:
@@ -87,13 +142,11 @@ def init_dictionaries(features_dict, cone_selection_dict, n_files):
         - n_files: int, number of input files to be used for mean/std computation
 
     Returns:
-        - sums: dict, container for accumulating sums of features' values
-        - sums2: dict, container for accumulating squared sums of features' values
-        - counts: dict, container for accumulating counts of features' values
+        - moments: MomentAccumulator, container for accumulating per file and total moments of features' values
         - scaling_params: dict, container for storing features' scaling parameters (mean, std, lim_min, lim_max)
         - quantile_params: dict, container for storing features' quantile parameters (see `get_quantiles()` function for their description)
     """
-    sums, sums2, counts, scaling_params, quantile_params = nested_dict(), nested_dict(), nested_dict(), nested_dict(), nested_dict()
+    moment_keys, scaling_params, quantile_params = [], nested_dict(), nested_dict()
     for var_type in features_dict.keys():
         for var_dict in features_dict[var_type]:
             assert len(var_dict) == 1
@@ -138,9 +191,7 @@ def init_dictionaries(features_dict, cone_selection_dict, n_files):
                         else:
                             raise ValueError(f'In variable {var}: too many lim_params specified, expect either None, or 1 (dictionary with min/max values for various cone types), or 2 (min/max values)')
                         quantile_params[var_type][var][cone_type] = {}
-                        sums[var_type][var][cone_type] = np.zeros(n_files, dtype='float64')
-                        sums2[var_type][var][cone_type] = np.zeros(n_files, dtype='float64')
-                        counts[var_type][var][cone_type] = np.zeros(n_files, dtype='int64')
+                        moment_keys.append((var_type, var, cone_type))
                     else:
                         if len(lim_params) == 2:
                             assert lim_params[0] <= lim_params[1]
@@ -150,21 +201,66 @@ def init_dictionaries(features_dict, cone_selection_dict, n_files):
                         else:
                             raise ValueError(f'In variable {var}: too many lim_params specified, expect either None, or 2 (min/max values)')
                         quantile_params[var_type][var]['global'] = {}
-                        sums[var_type][var] = np.zeros(n_files, dtype='float64')
-                        sums2[var_type][var] = np.zeros(n_files, dtype='float64')
-                        counts[var_type][var] = np.zeros(n_files, dtype='int64')
+                        moment_keys.append((var_type, var, 'global'))
             else:
                 raise ValueError(f"In variable {var}: scaling_type should be one of [no_scaling, categorical, linear, normal]")
-    return sums, sums2, counts, scaling_params, quantile_params
+    return MomentAccumulator(moment_keys, n_files), scaling_params, quantile_params
+
+moment_dtype = np.dtype([('count', 'int64'), ('mean', 'float64'), ('m2', 'float64')])
+
+def get_moments(var_array):
+    """
+    Compute moments of a given feature's values: count, mean and sum of squared deviations from the mean (m2).
+    The latter is computed around the mean (i.e. in two passes), so that it doesn't suffer from cancellation for features with large mean.
+
+    Arguments:
+        - var_array: awkward array, values of a given feature
+
+    Returns:
+        np.array of `moment_dtype` with a single element
+    """
+    moments = np.zeros(1, dtype=moment_dtype)
+    count = ak.count(var_array)
+    if count > 0:
+        mean = ak.sum(var_array) / count
+        moments['count'], moments['mean'], moments['m2'] = count, mean, ak.sum((var_array - mean)**2)
+    return moments
+
+def merge_moments(moments_1, moments_2):
+    """
+    Merge element-wise two arrays of moments of `moment_dtype` into the moments of the union of the corresponding values (Chan et al. parallel algorithm).
+    The merge is exact (up to floating point precision) and doesn't depend on the order of merging.
 
-def compute_mean(sums, counts, aggregate=True, *file_range):
+    Returns:
+        np.array of `moment_dtype` with merged moments
+    """
+    merged = np.zeros(np.broadcast(moments_1, moments_2).shape, dtype=moment_dtype)
+    merged['count'] = moments_1['count'] + moments_2['count']
+    count = np.maximum(merged['count'], 1) # to avoid 0/0 for empty moments, which stay all 0
+    delta = moments_2['mean'] - moments_1['mean']
+    merged['mean'] = moments_1['mean'] + delta * moments_2['count'] / count
+    merged['m2'] = moments_1['m2'] + moments_2['m2'] + delta**2 * moments_1['count'] * moments_2['count'] / count
+    return merged
+
+def reduce_moments(moments):
+    """
+    Merge an array of moments of `moment_dtype` into a single moments element, using pairwise merging.
     """
-    Assuming input arrays correspond to per file sums and counts for a given feature's values, derive means either on the file-by-file basis, or via aggregating & averaging values over all/specified range of input files.
+    moments = np.atleast_1d(moments)
+    if len(moments) == 0:
+        return np.zeros(1, dtype=moment_dtype)[0]
+    while len(moments) > 1:
+        merged = merge_moments(moments[:len(moments)//2*2:2], moments[1:len(moments)//2*2:2])
+        moments = np.concatenate([merged, moments[len(moments)//2*2:]])
+    return moments[0]
+
+def compute_mean(moments, aggregate=True, *file_range):
+    """
+    Assuming input array corresponds to per file moments for a given feature's values, derive means either on the file-by-file basis, or via merging the moments over all/specified range of input files.
 
     Arguments:
-        - sums: np.array, summed values for a given feature per processed files
-        - counts: np.array, counts of a given feature per processed files
-        - aggregate (optional, default=True): bool, whether to aggregate sums and counts for the mean computation. If no `file_range` specified, do that for all the input array, otherwise over a specified range in `file_range`.
+        - moments: np.array of `moment_dtype`, moments of a given feature per processed files
+        - aggregate (optional, default=True): bool, whether to merge moments for the mean computation. If no `file_range` specified, do that for all the input array, otherwise over a specified range in `file_range`.
         - file_range (optional): if passed, assume to be a list with the range of file ids to run aggregation and mean computation on.
 
     Returns:
@@ -173,21 +269,18 @@ def compute_mean(sums, counts, aggregate=True, *file_range):
     if aggregate:
         if file_range:
             assert len(file_range) == 2 and file_range[0] <= file_range[1]
-            return sums[file_range[0]:file_range[1]].sum()/counts[file_range[0]:file_range[1]].sum()
-        else:
-            return sums.sum()/counts.sum()
+            moments = moments[file_range[0]:file_range[1]]
+        return reduce_moments(moments)['mean']
     else:
-        return sums/counts
+        return moments['mean']
 
-def compute_std(sums, sums2, counts, aggregate=True, *file_range):
+def compute_std(moments, aggregate=True, *file_range):
     """
-    Assuming input arrays correspond to per file (squared) sums and counts for a given feature's values, derive standard deviation either on the file-by-file basis, or via aggregating & averaging values over all/specified range of input files.
+    Assuming input array corresponds to per file moments for a given feature's values, derive standard deviation either on the file-by-file basis, or via merging the moments over all/specified range of input files.
 
     Arguments:
-        - sums: np.array, summed values for a given feature per processed files
-        - sums2: np.array, squared summed values for a given feature per processed files
-        - counts: np.array, counts of a given feature per processed files
-        - aggregate (optional, default=True): bool, whether to aggregate sums, sums2 and counts for the std computation. If no `file_range` specified, do that for all the input array, otherwise over a specified range in `file_range`.
+        - moments: np.array of `moment_dtype`, moments of a given feature per processed files
+        - aggregate (optional, default=True): bool, whether to merge moments for the std computation. If no `file_range` specified, do that for all the input array, otherwise over a specified range in `file_range`.
         - file_range (optional): if passed, assume to be a list with the range of file ids to run aggregation and std computation on.
 
     Returns:
@@ -196,33 +289,221 @@ def compute_std(sums, sums2, counts, aggregate=True, *file_range):
     if aggregate:
         if file_range:
             assert len(file_range) == 2 and file_range[0] <= file_range[1]
-            average2 = sums2[file_range[0]:file_range[1]].sum()/counts[file_range[0]:file_range[1]].sum()
-            average = sums[file_range[0]:file_range[1]].sum()/counts[file_range[0]:file_range[1]].sum()
-            return np.sqrt(average2 - average**2)
+            moments = moments[file_range[0]:file_range[1]]
+        moments = reduce_moments(moments)
+    return np.sqrt(moments['m2'] / moments['count'])
+
+class MomentAccumulator:
+    """
+    Container of per file and total moments (see `moment_dtype`) of the features, stored in structured numpy arrays.
+    Features are identified by the key (var_type, var, cone_type), with cone_type='global' for the inclusive computation.
+    The total moments are updated together with the per file ones, so that the snapshot of scaling parameters doesn't require to aggregate over the files.
+
+    Arguments:
+        - keys: list of (var_type, var, cone_type) tuples of the features to accumulate
+        - n_files: int, number of input files
+    """
+    def __init__(self, keys, n_files):
+        self.keys = list(keys)
+        self.index = {key: key_i for key_i, key in enumerate(self.keys)}
+        self.per_file = np.zeros((n_files, len(self.keys)), dtype=moment_dtype)
+        self.total = np.zeros(len(self.keys), dtype=moment_dtype)
+
+    def fill(self, file_i, key, var_array):
+        """
+        Add the values of `var_array` to the moments of the feature `key` for file `file_i`.
+        """
+        key_i = self.index[key]
+        moments = get_moments(var_array)[0]
+        self.per_file[file_i, key_i] = merge_moments(self.per_file[file_i, key_i], moments)
+        self.total[key_i] = merge_moments(self.total[key_i], moments)
+
+    def set_file(self, file_i, key, moments):
+        """
+        Set (count, mean, m2) `moments` of the feature `key` for file `file_i`, e.g. as computed in a separate process.
+        """
+        key_i = self.index[key]
+        previous = self.per_file[file_i, key_i]
+        self.per_file[file_i, key_i] = tuple(moments)
+        if previous['count'] > 0:
+            # recompute from the files instead of subtracting the previous moments
+            self.total[key_i] = reduce_moments(self.per_file[:, key_i])
         else:
-            return np.sqrt(sums2.sum()/counts.sum() - (sums.sum()/counts.sum())**2)
-    else:
-        return np.sqrt(sums2/counts - (sums/counts)**2)
+            self.total[key_i] = merge_moments(self.total[key_i], self.per_file[file_i, key_i])
 
-def get_quantiles(var_array):
+    def file_moments(self, file_i):
+        """
+        Returns dict {key: (count, mean, m2)} of file `file_i`.
+        """
+        return {key: (int(m['count']), float(m['mean']), float(m['m2'])) for key, m in zip(self.keys, self.per_file[file_i])}
+
+    def count(self, key):
+        return self.total[self.index[key]]['count']
+
+    def mean(self, key):
+        return self.total[self.index[key]]['mean']
+
+    def std(self, key):
+        moments = self.total[self.index[key]]
+        return np.sqrt(moments['m2'] / moments['count'])
+
+class QuantileSketch:
+    """
+    Mergeable streaming sketch of a feature's distribution (t-digest with a logistic scale function), used to estimate its quantiles with bounded memory.
+    The distribution is summarised with centroids (mean, weight), which are kept small in the tails and large in the bulk, so that the tail quantiles are estimated precisely.
+    Sketches of different files can be merged into the one of the whole dataset without accessing the values again.
+
+    Arguments:
+        - compression: int, controls the number of centroids (about compression/10*ln(2N) for N values, i.e. about 2*compression for 10^9 values) and hence the precision of the quantile estimation
+    """
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.zeros(0, dtype='float64')
+        self.weights = np.zeros(0, dtype='float64')
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def _compress(self, means, weights):
+        # assumes means to be sorted: group neighbouring centroids within the same unit interval of the scale k = compression/20*logit(q)
+        if len(means) == 0: return
+        cum_weights = np.cumsum(weights)
+        q = (cum_weights - weights/2.) / cum_weights[-1]
+        k = np.floor(self.compression / 20. * np.log(q / (1. - q)))
+        starts = np.flatnonzero(np.diff(k, prepend=k[0]-1))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means*weights, starts) / self.weights
+
+    def update(self, values):
+        """
+        Add the values of a numpy array to the sketch, this requires a single sort of the array. Masked values (e.g. infs masked by `mask_inf()`) are skipped.
+        """
+        values = np.sort(np.ma.compressed(values).astype('float64'))
+        if len(values) == 0: return
+        self.min = min(self.min, values[0])
+        self.max = max(self.max, values[-1])
+        if len(self.means) > 0:
+            self.merge(QuantileSketch.from_sorted(values, self.compression))
+        else:
+            self._compress(values, np.ones_like(values))
+
+    def merge(self, other):
+        """
+        Merge `other` sketch into this one.
+        """
+        if other.count == 0: return
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        means = np.concatenate([self.means, other.means])
+        weights = np.concatenate([self.weights, other.weights])
+        order = np.argsort(means, kind='stable')
+        self._compress(means[order], weights[order])
+
+    def quantile(self, q):
+        """
+        Estimate quantile(s) `q` by interpolating between the centroids, with min/max values as the end points.
+        """
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan)
+        positions = np.cumsum(self.weights) - self.weights/2.
+        positions = np.concatenate([[0.], positions, [self.count]])
+        means = np.concatenate([[self.min], self.means, [self.max]])
+        return np.interp(np.asarray(q)*self.count, positions, means)
+
+    @classmethod
+    def from_sorted(cls, values, compression=100):
+        sketch = cls(compression)
+        if len(values) > 0:
+            sketch.min, sketch.max = values[0], values[-1]
+            sketch._compress(values, np.ones_like(values))
+        return sketch
+
+    def to_dict(self):
+        return {'compression': self.compression, 'min': float(self.min), 'max': float(self.max),
+                'means': self.means.tolist(), 'weights': self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        sketch = cls(sketch_dict['compression'])
+        sketch.min, sketch.max = sketch_dict['min'], sketch_dict['max']
+        sketch.means = np.array(sketch_dict['means'], dtype='float64')
+        sketch.weights = np.array(sketch_dict['weights'], dtype='float64')
+        return sketch
+
+def init_quantile_sketches(quantile_params):
+    """
+    Initialise empty quantile sketches for all the variable types/variable names/cone types of `quantile_params` (as returned by `init_dictionaries()` function).
+
+    Returns:
+        dict, container for storing features' quantile sketches
+    """
+    quantile_sketches = nested_dict()
+    for var_type in quantile_params.keys():
+        for var in quantile_params[var_type].keys():
+            for cone_type in quantile_params[var_type][var].keys():
+                quantile_sketches[var_type][var][cone_type] = QuantileSketch()
+    return quantile_sketches
+
+sigmas = [1, 2, 3, 5] # sigma intervals (under assumption of normality) reported in the quantile dictionaries
+sigma_levels = norm.cdf([sign*sigma for sigma in sigmas for sign in [-1, 1]])
+
+def sketch_quantiles(sketch):
+    """
+    Derive from a quantile sketch characteristics of the distribution in the format of `get_quantiles()` function.
+
+    Arguments:
+        - sketch: QuantileSketch, sketch of a given feature's distribution
+
+    Returns:
+        dict with corresponding quantiles (empty if no values were added to the sketch)
+    """
+    if sketch.count == 0:
+        return {}
+    quantile_dict = {}
+    sigma_quantiles = sketch.quantile(sigma_levels)
+    quantile_dict['median'] = float(sketch.quantile(0.5))
+    quantile_dict['min'] = float(sketch.min)
+    quantile_dict['max'] = float(sketch.max)
+    for sigma_i, sigma in enumerate(sigmas):
+        quantile_dict[f'{sigma}sigma'] = {'left': float(sigma_quantiles[2*sigma_i]), 'right': float(sigma_quantiles[2*sigma_i+1])}
+    return quantile_dict
+
+def sorted_quantile(values, q):
+    """
+    Exact quantile(s) `q` of the sorted numpy array `values`, with the linear interpolation of `np.quantile()`.
     """
-    Compute for a given feature array `var_array` characteristics of its distribution: median, min/max, 1/2/3/5 sigma (under assumption of normality) intervals
+    positions = np.asarray(q) * (len(values) - 1)
+    lower = np.floor(positions).astype('int64')
+    upper = np.minimum(lower + 1, len(values) - 1)
+    return values[lower] + (positions - lower) * (values[upper] - values[lower])
+
+def get_quantiles(var_array, sketch=None):
+    """
+    Compute for a given feature array `var_array` characteristics of its distribution: median, min/max, 1/2/3/5 sigma (under assumption of normality) intervals.
+    The quantiles are exact and are read from the array sorted once. Masked values (e.g. infs masked by `mask_inf()`) are skipped.
 
     Arguments:
         - var_array: awkward array with values for a given feature for which quantiles need to be computed.
+        - sketch (optional, default=None): QuantileSketch, if passed, the sorted values are also merged into it (e.g. to accumulate the sketch of the whole dataset)
 
     Returns:
-        dict with corresponding quantiles
+        dict with corresponding quantiles (empty if there are no values)
     """
+    var_array = np.sort(np.ma.compressed(ak.to_numpy(ak.flatten(var_array, axis=-1))).astype('float64'))
+    if len(var_array) == 0:
+        return {}
+    if sketch is not None:
+        sketch.merge(QuantileSketch.from_sorted(var_array, sketch.compression))
     quantile_dict = {}
-    var_array = ak.to_numpy(ak.flatten(var_array, axis=-1))
-    quantile_dict['median'] = np.median(var_array).astype(float)
-    quantile_dict['min'] = np.min(var_array).astype(float)
-    quantile_dict['max'] = np.max(var_array).astype(float)
-    quantile_dict['1sigma'] = {side: float(np.quantile(var_array, norm.cdf(sigma_side), interpolation='linear')) for side, sigma_side in zip(['left', 'right'], [-1, 1])}
-    quantile_dict['2sigma'] = {side: float(np.quantile(var_array, norm.cdf(sigma_side), interpolation='linear')) for side, sigma_side in zip(['left', 'right'], [-2, 2])}
-    quantile_dict['3sigma'] = {side: float(np.quantile(var_array, norm.cdf(sigma_side), interpolation='linear')) for side, sigma_side in zip(['left', 'right'], [-3, 3])}
-    quantile_dict['5sigma'] = {side: float(np.quantile(var_array, norm.cdf(sigma_side), interpolation='linear')) for side, sigma_side in zip(['left', 'right'], [-5, 5])}
+    sigma_quantiles = sorted_quantile(var_array, sigma_levels)
+    quantile_dict['median'] = float(sorted_quantile(var_array, 0.5))
+    quantile_dict['min'] = float(var_array[0])
+    quantile_dict['max'] = float(var_array[-1])
+    for sigma_i, sigma in enumerate(sigmas):
+        quantile_dict[f'{sigma}sigma'] = {'left': float(sigma_quantiles[2*sigma_i]), 'right': float(sigma_quantiles[2*sigma_i+1])}
     return quantile_dict
 
 def mask_inf(var_array, var_name=None, var_inf_counter=None):
@@ -244,71 +525,70 @@ def mask_inf(var_array, var_name=None, var_inf_counter=None):
             var_inf_counter[var_name].append(np.sum(is_inf_mask) / ak.count(var_array))
     return var_array
 
-def fill_aggregators(var_array, tau_eta_array, tau_phi_array, constituent_eta_array, constituent_phi_array,
-                     var, var_type, file_i, file_name_id, cone_type, dR_tau_signal_cone, dR_tau_outer_cone,
-                     sums, sums2, counts, fill_scaling_params=False, scaling_params=None, quantile_params=None):
+def fill_aggregators(var_array, var, var_type, file_i, file_name_id, cone_type, cone_mask,
+                     moments, fill_scaling_params=False, scaling_params=None, quantile_params=None, quantile_sketches=None):
     """
-    Update `sums`, `sums2` and `counts` dictionaries with the values from `var_array` either inclusively or exclusively (based on `cone_type` argument) for inner/outer cones.
-    In the latter case, derive `constituent_dR` with respect to the tau direction of flight and define cones as:
-        - inner: `constituent_dR` <= `dR_tau_signal_cone`
-        - outer: constituent_dR` > `dR_tau_signal_cone` and `constituent_dR` < `dR_tau_outer_cone`
-    Then mask consitutents which appear in the `cone_type` and update sums/sums2/counts only using those constituents which enter the given cone.
+    Update `moments` with the values from `var_array` either inclusively or exclusively (based on `cone_type` argument) for inner/outer cones.
+    In the latter case, only those constituents which enter the given cone according to `cone_mask` (see `get_cone_masks()`) are used to update the moments.
 
-    If `fill_scaling_params` is set to `True`, also update `scaling_params` dictionary (i.e. make a "snapshot" of scaling parameters based on the current state of sums/sums2/counts)
+    If `fill_scaling_params` is set to `True`, also update `scaling_params` dictionary (i.e. make a "snapshot" of scaling parameters based on the current state of the moments)
 
     Arguments:
         - var_array: awkward array, values of a given feature for a given set of taus
-        - tau_eta_array: awkward array, eta values of taus
-        - tau_phi_array: awkward array, phi values of taus
-        - constituent_eta_array: awkward array, eta values of tau constituents
-        - constituent_phi_array: awkward array, phi values of tau constituents
         - var: string, variable name
         - var_type: string, variable type
         - file_i: int, index of the file being processed in the input file list
         - file_name_id: int, index of the file being processed taken from the corresponding file name
-        - cone_type: string, type of cone being processed, should be either inner or outer
-        - dR_tau_signal_cone: awkward array, per tau dR values defining the signal cone
-        - dR_tau_outer_cone: float, dR value defining the tau outer cone
-        - sums: dict, container for accumulating sums of features' values and to be filled based on the input `var_array`
-        - sums2: dict, container for accumulating square sums of features' values and to be filled based on the input `var_array`
-        - counts: dict, container for accumulating counts of features' values and to be filled based on the input `var_array`
-        - fill_scaling_params (optional, default=False): bool, whether to update the `scaling_params` dictionary with the values from the current state of sums/sums2/counts
+        - cone_type: string, type of cone being processed, should be either inner, outer or None (inclusive)
+        - cone_mask: awkward array, mask of the constituents entering the cone of `cone_type` (None for inclusive computation)
+        - moments: MomentAccumulator, container for accumulating moments of features' values and to be filled based on the input `var_array`
+        - fill_scaling_params (optional, default=False): bool, whether to update the `scaling_params` dictionary with the values from the current state of the moments
         - scaling_params(optional, default=None): dict, main dictionary storing scaling parameters per variable type/variable name/cone type. Used only if `fill_scaling_params` is set to `True`
         - quantile_params(optional, default=None): dict, if passed, will store in this disctionary for a given `file_i` quantile numbers for `var_array` as returned by `get_quantiles()` function
+        - quantile_sketches(optional, default=None): dict, if passed together with `quantile_params`, the quantile sketch of `var_array` is merged into the corresponding sketch of this dictionary (see `init_quantile_sketches()`)
 
     Returns:
         None
     """
     if cone_type == None:
-        sums[var_type][var][file_i] += ak.sum(var_array)
-        sums2[var_type][var][file_i] += ak.sum(var_array**2)
-        counts[var_type][var][file_i] += ak.count(var_array)
+        moments.fill(file_i, (var_type, var, 'global'), var_array)
         if fill_scaling_params:
-            mean_ = compute_mean(sums[var_type][var], counts[var_type][var], aggregate=True)
-            std_ = compute_std(sums[var_type][var], sums2[var_type][var], counts[var_type][var], aggregate=True)
+            mean_ = moments.mean((var_type, var, 'global'))
+            std_ = moments.std((var_type, var, 'global'))
             scaling_params[var_type][var]['global']['mean'] = float(format(mean_, '.4g')) # round to 4 significant digits
             scaling_params[var_type][var]['global']['std'] = float(format(std_, '.4g'))
         if quantile_params:
-            quantile_params[var_type][var]['global'][file_name_id] = get_quantiles(var_array)
+            quantile_params[var_type][var]['global'][file_name_id] = get_quantiles(var_array, None if quantile_sketches is None else quantile_sketches[var_type][var]['global'])
     elif cone_type == 'inner' or cone_type == 'outer':
-        constituent_dR = dR(tau_eta_array - constituent_eta_array, tau_phi_array - constituent_phi_array)
-        if cone_type == 'inner':
-            cone_mask = constituent_dR <= dR_tau_signal_cone
-        elif cone_type == 'outer':
-            cone_mask = (constituent_dR > dR_tau_signal_cone) & (constituent_dR < dR_tau_outer_cone)
-        sums[var_type][var][cone_type][file_i] += ak.sum(var_array[cone_mask])
-        sums2[var_type][var][cone_type][file_i] += ak.sum(var_array[cone_mask]**2)
-        counts[var_type][var][cone_type][file_i] += ak.count(var_array[cone_mask])
+        cone_array = var_array[cone_mask]
+        moments.fill(file_i, (var_type, var, cone_type), cone_array)
         if fill_scaling_params:
-            mean_ = compute_mean(sums[var_type][var][cone_type], counts[var_type][var][cone_type], aggregate=True)
-            std_ = compute_std(sums[var_type][var][cone_type], sums2[var_type][var][cone_type], counts[var_type][var][cone_type], aggregate=True)
+            mean_ = moments.mean((var_type, var, cone_type))
+            std_ = moments.std((var_type, var, cone_type))
             scaling_params[var_type][var][cone_type]['mean'] = float(format(mean_, '.4g'))
             scaling_params[var_type][var][cone_type]['std'] = float(format(std_, '.4g'))
         if quantile_params:
-            quantile_params[var_type][var][cone_type][file_name_id] = get_quantiles(var_array[cone_mask])
+            quantile_params[var_type][var][cone_type][file_name_id] = get_quantiles(cone_array, None if quantile_sketches is None else quantile_sketches[var_type][var][cone_type])
     else:
         raise ValueError(f'cone_type for {var_type} should be either inner, or outer')
 
+def update_scaling_params(moments, scaling_params):
+    """
+    Update `scaling_params` dictionary for all the features with normal scaling based on the current state of the total `moments` (i.e. make a "snapshot" of scaling parameters).
+    Features without any accumulated counts are not updated.
+
+    Arguments:
+        - moments: MomentAccumulator, container with accumulated moments of features' values
+        - scaling_params: dict, main dictionary storing scaling parameters per variable type/variable name/cone type
+
+    Returns:
+        None
+    """
+    for var_type, var, cone_type in moments.keys:
+        if moments.count((var_type, var, cone_type)) == 0: continue
+        scaling_params[var_type][var][cone_type]['mean'] = float(format(moments.mean((var_type, var, cone_type)), '.4g')) # round to 4 significant digits
+        scaling_params[var_type][var][cone_type]['std'] = float(format(moments.std((var_type, var, cone_type)), '.4g'))
+
 def dump_to_json(dict_map):
     """
     For each entry in the input `dict_map` write the corresponding dictionary into a json file with the specified path.
@@ -50,4 +50,5 @@ PRED_DIR="output/predictions/$NETWORK/step1_e$EPOCH"
 mkdir -p "$PRED_DIR"
 
 python3 TauML/Training/python/apply_training.py --input "$TUPLES_DIR" --output "$PRED_DIR" \
-    --model "$NET_DIR/${NET_FILE}.pb" --chunk-size 1000 --batch-size 100 --max-queue-size 20
+    --model "$NET_DIR/${NET_FILE}.pb" --training-cfg "TauML/Training/configs/training_v1.yaml" \
+    --scaling-cfg "TauML/Training/configs/scaling_params_v1.json" --n-workers 4 --batch-size 1000